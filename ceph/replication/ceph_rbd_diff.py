@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+#
+# helpers for the "rbd diff v1" format written by rbd export-diff and read by rbd import-diff
+#
+# The format is a header line followed by records, each starting with a one byte tag:
+#     "rbd diff v1\n"
+#     f <le32 len> <name>             from snap (only for incremental diffs)
+#     t <le32 len> <name>             to snap
+#     s <le64 size>                   image size
+#     w <le64 offset> <le64 len> <data>   data extent
+#     z <le64 offset> <le64 len>      zero (discarded) extent
+#     e                               end
+
+import errno
+import hashlib
+import heapq
+import json
+import os
+import struct
+
+HEADER = b"rbd diff v1\n"
+
+# longest fixed part of a record header ("w" and "z")
+MAX_RECORD_HEADER = 17
+
+
+# returns the total length of the record whose first bytes are in buf,
+# or None if buf is too short to tell
+def record_length(buf):
+    if len(buf) < 1:
+        return None
+    tag = buf[0:1]
+    if tag == b"e":
+        return 1
+    if tag == b"f" or tag == b"t":
+        if len(buf) < 5:
+            return None
+        return 5 + struct.unpack("<I", buf[1:5])[0]
+    if tag == b"s":
+        return 9
+    if tag == b"z":
+        return 17
+    if tag == b"w":
+        if len(buf) < 17:
+            return None
+        return 17 + struct.unpack("<Q", buf[9:17])[0]
+    raise Exception("unknown diff record tag %s" % repr(tag))
+
+
+# Follows the record boundaries of a diff file while it is being written, without reading the data;
+# only the record headers are read back (with pread, so the file position isn't disturbed).
+#
+# Call scan(end) whenever end bytes of the file are written. Then complete is the end of the last
+# complete record, which is a safe place to truncate to and resume from.
+class RecordScanner:
+    def __init__(self, fd, pos=0):
+        self.fd = fd
+        # start of the next record to parse; 0 means the header wasn't checked yet
+        self.pos = pos
+        self.complete = pos
+        self.records = 0
+        self.ended = False
+
+    def scan(self, end):
+        if self.pos == 0:
+            if end < len(HEADER):
+                return
+            if os.pread(self.fd, len(HEADER), 0) != HEADER:
+                raise Exception("not an rbd diff v1 stream")
+            self.pos = len(HEADER)
+            self.complete = self.pos
+
+        while not self.ended and self.pos < end:
+            buf = os.pread(self.fd, min(MAX_RECORD_HEADER, end - self.pos), self.pos)
+            length = record_length(buf)
+            if length is None or self.pos + length > end:
+                return
+            if buf[0:1] == b"e":
+                self.ended = True
+            self.pos += length
+            self.complete = self.pos
+            self.records += 1
+
+
+# returns the length of the record header that starts with the bytes in buf (not counting "w" data)
+# for "f" and "t" this is only known once the first 5 bytes are there; until then it returns 5
+def record_header_length(buf):
+    tag = buf[0:1]
+    if tag == b"f" or tag == b"t":
+        if len(buf) < 5:
+            return 5
+        return 5 + struct.unpack("<I", bytes(buf[1:5]))[0]
+    if tag == b"s":
+        return 9
+    if tag == b"w" or tag == b"z":
+        return 17
+    if tag == b"e":
+        return 1
+    raise Exception("unknown diff record tag %s" % repr(bytes(tag)))
+
+
+# Parses a diff that is read or written in order, in chunks of any size, without buffering the data.
+#
+# Subclasses override record() to see each record header (and the stream position right after it), and
+# data() to see the data of "w" records as it goes by; extent_done() is called at the end of each "w" record.
+class DiffParser:
+    def __init__(self):
+        # position in the stream
+        self.pos = 0
+        self.header = b""
+        self.magic_done = False
+        self.data_left = 0
+        self.from_snap = None
+        self.to_snap = None
+        self.image_size = None
+        self.ended = False
+
+    def feed(self, buf):
+        pos = 0
+        n = len(buf)
+        while pos < n:
+            if self.data_left:
+                take = min(self.data_left, n - pos)
+                self.data(buf[pos:pos+take])
+                pos += take
+                self.data_left -= take
+                if not self.data_left:
+                    self.extent_done()
+                continue
+
+            if self.ended:
+                raise Exception("trailing data after the end record")
+
+            if not self.magic_done:
+                need = len(HEADER)
+            elif self.header:
+                need = record_header_length(self.header)
+            else:
+                need = 1
+            take = min(need - len(self.header), n - pos)
+            self.header += bytes(buf[pos:pos+take])
+            pos += take
+            if len(self.header) < need:
+                continue
+            if self.magic_done and len(self.header) < record_header_length(self.header):
+                # now we know how long the snap name is
+                continue
+
+            header = self.header
+            self.header = b""
+            if not self.magic_done:
+                if header != HEADER:
+                    raise Exception("not an rbd diff v1 stream")
+                self.magic_done = True
+                continue
+
+            tag = header[0:1]
+            if tag == b"f":
+                self.from_snap = header[5:].decode("utf-8")
+            elif tag == b"t":
+                self.to_snap = header[5:].decode("utf-8")
+            elif tag == b"s":
+                self.image_size = struct.unpack("<Q", header[1:9])[0]
+            elif tag == b"w":
+                self.data_left = struct.unpack("<Q", header[9:17])[0]
+            elif tag == b"e":
+                self.ended = True
+            self.record(header, self.pos + pos)
+            if tag == b"w" and not self.data_left:
+                self.extent_done()
+        self.pos += n
+
+    def record(self, header, pos):
+        pass
+
+    def data(self, buf):
+        pass
+
+    def extent_done(self):
+        pass
+
+    # raises an exception unless the whole diff was fed
+    def check_complete(self):
+        if not self.ended or self.data_left or self.header:
+            raise Exception("diff is incomplete")
+
+
+# Computes digests of a diff while it is read or written in order: one of the whole file, and one per data extent.
+class DiffDigester(DiffParser):
+    def __init__(self, algorithm="sha256"):
+        DiffParser.__init__(self)
+        self.algorithm = algorithm
+        self.file_hash = hashlib.new(algorithm)
+        self.size = 0
+        self.extent = None
+        self.extent_hash = None
+        # [offset, length, hex digest] per "w" record, and [offset, length] per "z" record
+        self.extents = []
+        self.zeros = []
+
+    def feed(self, buf):
+        self.file_hash.update(buf)
+        self.size += len(buf)
+        DiffParser.feed(self, buf)
+
+    def record(self, header, pos):
+        tag = header[0:1]
+        if tag == b"z":
+            self.zeros += [list(struct.unpack("<QQ", header[1:17]))]
+        elif tag == b"w":
+            self.extent = struct.unpack("<QQ", header[1:17])
+            self.extent_hash = hashlib.new(self.algorithm)
+
+    def data(self, buf):
+        self.extent_hash.update(buf)
+
+    def extent_done(self):
+        self.extents += [[self.extent[0], self.extent[1], self.extent_hash.hexdigest()]]
+
+    # the digests, as saved in the sidecar file
+    def result(self):
+        self.check_complete()
+        return {"algorithm": self.algorithm, "size": self.size, "digest": self.file_hash.hexdigest(),
+            "from_snap": self.from_snap, "to_snap": self.to_snap, "image_size": self.image_size,
+            "extents": self.extents, "zeros": self.zeros}
+
+
+# Checks a diff while it is read in order: every extent must be non-empty, after the image size record, inside the
+# image, and after the end of the one before it (which is how rbd export-diff writes them), and the end record must
+# be the last thing in it. The data isn't looked at, so feeding it a memoryview of a mmapped file doesn't copy it.
+class DiffChecker(DiffParser):
+    def __init__(self):
+        DiffParser.__init__(self)
+        self.records = 0
+        self.data_bytes = 0
+        self.last_end = 0
+
+    def record(self, header, pos):
+        self.records += 1
+        tag = header[0:1]
+        if tag != b"w" and tag != b"z":
+            return
+        offset, length = struct.unpack("<QQ", header[1:17])
+        if self.image_size is None:
+            raise Exception("extent at offset %s comes before the image size" % offset)
+        if not length:
+            raise Exception("empty extent at offset %s" % offset)
+        if offset < self.last_end:
+            raise Exception("extent at offset %s overlaps or is out of order after %s" % (offset, self.last_end))
+        if offset + length > self.image_size:
+            raise Exception("extent at offset %s length %s is past the end of the image (%s)"
+                % (offset, length, self.image_size))
+        self.last_end = offset + length
+        if tag == b"w":
+            self.data_bytes += length
+
+    def result(self):
+        self.check_complete()
+        return {"from_snap": self.from_snap, "to_snap": self.to_snap, "image_size": self.image_size,
+            "records": self.records, "data": self.data_bytes, "size": self.pos}
+
+
+# the digests of a stored diff file named <snap> are kept next to it, in .<snap>.digest
+# (the name doesn't match the replication* glob, and tools skip names starting with a dot)
+def digest_path(path):
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".digest")
+
+
+def write_digest(path, digests):
+    sidecar = digest_path(path)
+    with open(sidecar + ".tmp", "w") as f:
+        json.dump(digests, f)
+    os.rename(sidecar + ".tmp", sidecar)
+
+
+# returns the saved digests for path, or None if there are none
+def read_digest(path):
+    try:
+        with open(digest_path(path), "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def remove_digest(path):
+    if os.path.exists(digest_path(path)):
+        os.remove(digest_path(path))
+
+
+# reads fileobj to the end and returns its digests (see DiffDigester.result)
+def digest_stream(fileobj, algorithm="sha256", chunk_size=1024*1024):
+    digester = DiffDigester(algorithm)
+    while True:
+        buf = fileobj.read(chunk_size)
+        if not buf:
+            break
+        digester.feed(buf)
+    return digester.result()
+
+
+# returns a list of problems found comparing actual digests with the saved ones; empty if they match
+def compare_digests(saved, actual):
+    if saved["digest"] == actual["digest"] and saved["size"] == actual["size"]:
+        return []
+
+    problems = ["file digest differs (size %s, saved size %s)" % (actual["size"], saved["size"])]
+    saved_extents = dict(((e[0], e[1]), e[2]) for e in saved["extents"])
+    for offset, length, digest in actual["extents"]:
+        if saved_extents.get((offset, length)) != digest:
+            problems += ["extent offset %s length %s differs" % (offset, length)]
+    if len(saved["extents"]) != len(actual["extents"]):
+        problems += ["%s extents, saved %s" % (len(actual["extents"]), len(saved["extents"]))]
+    return problems
+
+
+# The header and extents of a diff file, read without reading the data.
+#
+# extents is a list of (offset, length, zero, data position in the file), in the order of the file.
+class DiffIndex:
+    def __init__(self, from_snap, to_snap, image_size, extents):
+        self.from_snap = from_snap
+        self.to_snap = to_snap
+        self.image_size = image_size
+        self.extents = extents
+
+
+# reads the index of the plain (uncompressed) diff in the seekable file f, skipping over the data
+def index_diff(f):
+    if f.read(len(HEADER)) != HEADER:
+        raise Exception("not an rbd diff v1 stream")
+    from_snap = None
+    to_snap = None
+    image_size = 0
+    extents = []
+    last_offset = 0
+    while True:
+        tag = f.read(1)
+        if tag == b"f" or tag == b"t":
+            length = struct.unpack("<I", read_exact(f, 4))[0]
+            name = read_exact(f, length).decode("utf-8")
+            if tag == b"f":
+                from_snap = name
+            else:
+                to_snap = name
+        elif tag == b"s":
+            image_size = struct.unpack("<Q", read_exact(f, 8))[0]
+        elif tag == b"w" or tag == b"z":
+            offset, length = struct.unpack("<QQ", read_exact(f, 16))
+            # the same checks rbd merge-diff makes
+            if not length:
+                raise Exception("diff has an empty extent at offset %s" % offset)
+            if offset < last_offset:
+                raise Exception("diff has out-of-order offset %s after %s" % (offset, last_offset))
+            last_offset = offset
+            pos = f.tell()
+            extents += [(offset, length, tag == b"z", pos)]
+            if tag == b"w":
+                f.seek(pos + length)
+        elif tag == b"e":
+            return DiffIndex(from_snap, to_snap, image_size, extents)
+        elif not tag:
+            raise Exception("diff is incomplete")
+        else:
+            raise Exception("unknown diff record tag %s" % repr(tag))
+
+
+def read_exact(f, length):
+    buf = f.read(length)
+    if len(buf) != length:
+        raise Exception("diff is incomplete")
+    return buf
+
+
+# Returns the pieces of extents (sorted extents of one diff, as in DiffIndex) that are not in covered
+# (a sorted list of disjoint [start, end) intervals) and start below limit, cut at limit.
+def subtract_extents(extents, covered, limit):
+    ret = []
+    j = 0
+    n = len(covered)
+    for offset, length, zero, data_pos in extents:
+        end = min(offset + length, limit)
+        pos = offset
+        while pos < end:
+            while j < n and covered[j][1] <= pos:
+                j += 1
+            if j == n or covered[j][0] >= end:
+                ret += [(pos, end - pos, zero, data_pos + pos - offset)]
+                break
+            start, stop = covered[j]
+            if start > pos:
+                ret += [(pos, start - pos, zero, data_pos + pos - offset)]
+            pos = stop
+    return ret
+
+
+# returns the union of covered and the sorted extents, as a sorted list of disjoint [start, end) intervals
+def add_extents(covered, extents):
+    ret = []
+    intervals = heapq.merge(covered, [(offset, offset + length) for offset, length, zero, data_pos in extents])
+    for start, end in intervals:
+        if ret and start <= ret[-1][1]:
+            if end > ret[-1][1]:
+                ret[-1] = (ret[-1][0], end)
+        else:
+            ret += [(start, end)]
+    return ret
+
+
+# Works out the records of the merged diff of indexes (oldest first), the way a chain of rbd merge-diff
+# would: every extent loses the parts that a newer diff has, and the parts past the size of any newer diff.
+# When the image grew, the grown part is zeroed, unless a newer diff has data there.
+#
+# Returns a sorted list of (offset, length, zero, index number, data position).
+def plan_merge(indexes):
+    for older, newer in zip(indexes[0:-1], indexes[1:]):
+        if (older.to_snap or "") != (newer.from_snap or ""):
+            raise Exception("can't merge a diff to snap %s with a diff from snap %s"
+                % (older.to_snap, newer.from_snap))
+
+    pieces = []
+    covered = []
+    limit = float("inf")
+    # newest first, so the parts of each diff that survive are known when it's reached
+    for i in range(len(indexes) - 1, -1, -1):
+        index = indexes[i]
+        kept = subtract_extents(index.extents, covered, limit)
+        pieces.append([(offset, length, zero, i, data_pos) for offset, length, zero, data_pos in kept])
+        covered = add_extents(covered, index.extents)
+        if i > 0:
+            prev_size = indexes[i - 1].image_size
+            if prev_size < index.image_size:
+                grown = [(prev_size, index.image_size - prev_size, True, 0)]
+                pieces.append([(offset, length, True, i, 0)
+                    for offset, length, zero, data_pos in subtract_extents(grown, covered, limit)])
+                covered = add_extents(covered, grown)
+            limit = min(limit, index.image_size)
+    return list(heapq.merge(*pieces))
+
+
+# the header of the merged diff of indexes (oldest first): the from snap of the first, and the to snap and size
+# of the last
+def merge_header(indexes):
+    first = indexes[0]
+    last = indexes[-1]
+    buf = bytearray(HEADER)
+    if first.from_snap:
+        name = first.from_snap.encode("utf-8")
+        buf += b"f" + struct.pack("<I", len(name)) + name
+    if last.to_snap:
+        name = last.to_snap.encode("utf-8")
+        buf += b"t" + struct.pack("<I", len(name)) + name
+    buf += b"s" + struct.pack("<Q", last.image_size)
+    return bytes(buf)
+
+
+# A plain diff file to merge from, read in place.
+class DiffFile:
+    def __init__(self, f, path):
+        self.f = f
+        self.path = path
+        self.index = index_diff(f)
+
+    # returns length bytes at position pos of the file
+    def read(self, pos, length):
+        data = os.pread(self.f.fileno(), length, pos)
+        if len(data) != length:
+            raise Exception("diff %s is incomplete" % self.path)
+        return data
+
+    # copies length bytes at position pos of the file to the current position of out_fd
+    def copy(self, pos, length, out_fd):
+        copy_range(self.f.fileno(), pos, length, out_fd)
+
+    def close(self):
+        self.f.close()
+
+
+# opens the diff at path for merge_diffs(): a plain diff file, or a container (see ceph_rbd_diff_container.py),
+# which is read through its index instead of being unpacked first
+def open_diff(path):
+    # imported here, since it imports this module
+    import ceph_rbd_diff_container
+
+    f = open(path, "rb")
+    try:
+        if f.read(len(ceph_rbd_diff_container.MAGIC)) == ceph_rbd_diff_container.MAGIC:
+            return ceph_rbd_diff_container.ContainerDiff(f)
+        f.seek(0)
+        return DiffFile(f, path)
+    except:
+        f.close()
+        raise
+
+
+# Returns (bytes read, bytes written) for merge_diffs(paths), working it out from the record headers only.
+# The merge reads the record headers and the data that survives, and writes the merged diff.
+def merge_cost(paths):
+    indexes = []
+    for path in paths:
+        diff = open_diff(path)
+        try:
+            indexes += [diff.index]
+        finally:
+            diff.close()
+    pieces = plan_merge(indexes)
+    data = sum([length for offset, length, zero, i, data_pos in pieces if not zero])
+    read = sum([len(index.extents) for index in indexes]) * MAX_RECORD_HEADER + data
+    written = len(merge_header(indexes)) + len(pieces) * MAX_RECORD_HEADER + data + 1
+    return read, written
+
+
+def write_all(fd, buf):
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# copies length bytes at offset in the file in_fd to the current position of out_fd
+def copy_range(in_fd, offset, length, out_fd):
+    while length:
+        copied = None
+        # os.copy_file_range is only in python 3.8 and newer
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = os.copy_file_range(in_fd, out_fd, length, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        if not copied:
+            # not supported here (or the input is shorter than its index says, which the read will catch)
+            buf = os.pread(in_fd, min(length, MERGE_CHUNK_SIZE), offset)
+            if not buf:
+                raise Exception("diff is incomplete")
+            write_all(out_fd, buf)
+            copied = len(buf)
+        offset += copied
+        length -= copied
+
+
+# extents smaller than this are copied through the output buffer instead of with copy_file_range
+MERGE_SMALL_EXTENT = 64*1024
+MERGE_CHUNK_SIZE = 4*1024*1024
+
+
+# Merges the diff files in paths (oldest first) into one diff written to out_path, in one pass over the
+# inputs, with the same output as chaining rbd merge-diff over them. Data is copied with copy_file_range, so it
+# doesn't go through Python (and may be shared on filesystems that support reflinks). The inputs can be plain
+# diffs or containers, but not otherwise compressed.
+def merge_diffs(paths, out_path):
+    diffs = []
+    try:
+        for path in paths:
+            diffs += [open_diff(path)]
+        indexes = [diff.index for diff in diffs]
+
+        buf = bytearray(merge_header(indexes))
+
+        with open(out_path, "wb") as out:
+            out_fd = out.fileno()
+            for offset, length, zero, i, data_pos in plan_merge(indexes):
+                buf += (b"z" if zero else b"w") + struct.pack("<QQ", offset, length)
+                if not zero and length < MERGE_SMALL_EXTENT:
+                    buf += diffs[i].read(data_pos, length)
+                elif not zero:
+                    write_all(out_fd, buf)
+                    buf = bytearray()
+                    diffs[i].copy(data_pos, length, out_fd)
+                if len(buf) >= MERGE_CHUNK_SIZE:
+                    write_all(out_fd, buf)
+                    buf = bytearray()
+            buf += b"e"
+            write_all(out_fd, buf)
+    finally:
+        for diff in diffs:
+            diff.close()
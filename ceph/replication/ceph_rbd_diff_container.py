@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+#
+# an indexed, compressed container for stored rbd diffs (file suffix .rbdx)
+#
+# The container holds the exact bytes of an "rbd diff v1" stream, cut into blocks that are compressed
+# independently, followed by an index of every extent in the diff. So the extents a diff touches can be
+# listed, and one extent read, without decompressing the whole file; and export gives back the original
+# stream byte for byte, for rbd import-diff or rbd merge-diff.
+#
+#     "rbd diff container v1\n"
+#     blocks:  <le32 compressed len> <le32 uncompressed len> <zlib data>
+#              ... <le32 0> <le32 0>  (end of blocks, so the stream can be exported without seeking)
+#     index:   per extent <le64 offset> <le64 len> <le64 block file position> <le32 position in block> <u8 zero>
+#     footer:  <le64 index file position> <le64 extent count> "RBDXIDX1"
+#
+# The position of an extent is where its data starts in the uncompressed block; the data can go on into the
+# following blocks. Zero ("z") extents have no data; their position is just past their record.
+#
+# usage:
+#     ceph_rbd_diff_container.py pack [infile [outfile]]      (stdin/stdout by default)
+#     ceph_rbd_diff_container.py export [infile [outfile]]      (stdin/stdout by default)
+#     ceph_rbd_diff_container.py index infile
+
+import argparse
+import bisect
+import io
+import struct
+import sys
+import zlib
+
+import ceph_rbd_diff
+
+MAGIC = b"rbd diff container v1\n"
+FOOTER_MAGIC = b"RBDXIDX1"
+BLOCK_HEADER = struct.Struct("<II")
+INDEX_ENTRY = struct.Struct("<QQQIB")
+FOOTER = struct.Struct("<QQ8s")
+
+BLOCK_SIZE = 4*1024*1024
+DEFAULT_LEVEL = 1
+
+
+# an extent from the index; data_pos is the position of its data in the v1 stream (only used while writing)
+class Extent:
+    def __init__(self, offset, length, zero, block_pos=None, block_offset=None, data_pos=None):
+        self.offset = offset
+        self.length = length
+        self.zero = zero
+        self.block_pos = block_pos
+        self.block_offset = block_offset
+        self.data_pos = data_pos
+
+
+# collects the extents of the diff being packed, with their positions in the v1 stream
+class ExtentCollector(ceph_rbd_diff.DiffParser):
+    def __init__(self):
+        ceph_rbd_diff.DiffParser.__init__(self)
+        self.extents = []
+
+    def record(self, header, pos):
+        tag = header[0:1]
+        if tag == b"w" or tag == b"z":
+            offset, length = struct.unpack("<QQ", header[1:17])
+            self.extents += [Extent(offset, length, tag == b"z", data_pos=pos)]
+
+
+# Writes a container to the file f; give it the v1 stream with write(), in chunks of any size, then call close().
+class ContainerWriter:
+    def __init__(self, f, level=DEFAULT_LEVEL, block_size=BLOCK_SIZE):
+        self.f = f
+        self.level = level
+        self.block_size = block_size
+        self.buf = bytearray()
+        self.parser = ExtentCollector()
+        # (file position, stream position) of each block
+        self.blocks = []
+        self.file_pos = len(MAGIC)
+        self.stream_pos = 0
+        f.write(MAGIC)
+
+    def write(self, buf):
+        self.parser.feed(buf)
+        self.buf += buf
+        while len(self.buf) >= self.block_size:
+            self.write_block(self.buf[0:self.block_size])
+            del self.buf[0:self.block_size]
+
+    def write_block(self, block):
+        data = zlib.compress(bytes(block), self.level)
+        self.f.write(BLOCK_HEADER.pack(len(data), len(block)))
+        self.f.write(data)
+        self.blocks += [(self.file_pos, self.stream_pos)]
+        self.file_pos += BLOCK_HEADER.size + len(data)
+        self.stream_pos += len(block)
+
+    def close(self):
+        self.parser.check_complete()
+        if self.buf:
+            self.write_block(self.buf)
+            self.buf = bytearray()
+
+        self.f.write(BLOCK_HEADER.pack(0, 0))
+        index_pos = self.file_pos + BLOCK_HEADER.size
+        block = 0
+        # extents are in stream order, so the matching block only moves forward
+        for extent in self.parser.extents:
+            while block + 1 < len(self.blocks) and self.blocks[block + 1][1] <= extent.data_pos:
+                block += 1
+            block_pos, block_start = self.blocks[block]
+            self.f.write(INDEX_ENTRY.pack(extent.offset, extent.length, block_pos,
+                extent.data_pos - block_start, extent.zero))
+        self.f.write(FOOTER.pack(index_pos, len(self.parser.extents), FOOTER_MAGIC))
+
+
+# yields the uncompressed blocks read from f, up to the end of blocks
+def read_blocks(f):
+    while True:
+        header = f.read(BLOCK_HEADER.size)
+        if len(header) != BLOCK_HEADER.size:
+            raise Exception("rbd diff container is truncated")
+        compressed_length, length = BLOCK_HEADER.unpack(header)
+        if not compressed_length:
+            return
+        block = zlib.decompress(f.read(compressed_length))
+        if len(block) != length:
+            raise Exception("rbd diff container block is corrupt")
+        yield block
+
+
+# Reads the index and single extents of a container in the seekable file f.
+class ContainerReader:
+    def __init__(self, f):
+        self.f = f
+        f.seek(0)
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("not an rbd diff container")
+        f.seek(-FOOTER.size, 2)
+        self.index_pos, self.count, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != FOOTER_MAGIC:
+            raise Exception("rbd diff container has no index; it is probably incomplete")
+        # (file position, stream position, length) of each block, see block_table()
+        self.table = None
+        self.starts = None
+        # the last block read_at() decompressed, and its number
+        self.cached = None
+        self.cached_block = None
+
+    # returns the list of Extents, in the order of the diff
+    def extents(self):
+        self.f.seek(self.index_pos)
+        data = self.f.read(self.count * INDEX_ENTRY.size)
+        ret = []
+        for offset, length, block_pos, block_offset, zero in INDEX_ENTRY.iter_unpack(data):
+            ret += [Extent(offset, length, bool(zero), block_pos, block_offset)]
+        return ret
+
+    # yields the uncompressed blocks starting with the one at file position pos
+    def blocks(self, pos):
+        self.f.seek(pos)
+        return read_blocks(self.f)
+
+    # returns the data of a "w" extent, only decompressing the blocks it is in
+    def read_extent(self, extent):
+        if extent.zero:
+            return bytes(extent.length)
+        ret = bytearray()
+        skip = extent.block_offset
+        for block in self.blocks(extent.block_pos):
+            ret += block[skip:skip + extent.length - len(ret)]
+            skip = 0
+            if len(ret) == extent.length:
+                break
+        return bytes(ret)
+
+    # returns the (file position, stream position, length) of every block, reading only the block headers
+    def block_table(self):
+        if self.table is not None:
+            return self.table
+        self.table = []
+        file_pos = len(MAGIC)
+        stream_pos = 0
+        while True:
+            self.f.seek(file_pos)
+            header = self.f.read(BLOCK_HEADER.size)
+            if len(header) != BLOCK_HEADER.size:
+                raise Exception("rbd diff container is truncated")
+            compressed_length, length = BLOCK_HEADER.unpack(header)
+            if not compressed_length:
+                break
+            self.table += [(file_pos, stream_pos, length)]
+            file_pos += BLOCK_HEADER.size + compressed_length
+            stream_pos += length
+        self.starts = [stream_pos for file_pos, stream_pos, length in self.table]
+        return self.table
+
+    # returns length bytes at position pos of the v1 stream; the last block used stays decompressed, so reading
+    # through the stream in order decompresses each block once
+    def read_at(self, pos, length):
+        table = self.block_table()
+        ret = bytearray()
+        i = bisect.bisect_right(self.starts, pos) - 1
+        while len(ret) < length:
+            if i < 0 or i >= len(table):
+                raise Exception("rbd diff container is truncated")
+            if self.cached != i:
+                self.cached_block = next(self.blocks(table[i][0]))
+                self.cached = i
+            skip = pos + len(ret) - table[i][1]
+            ret += self.cached_block[skip:skip + length - len(ret)]
+            i += 1
+        return bytes(ret)
+
+    # returns the ceph_rbd_diff.DiffIndex of the diff, with data positions in the v1 stream, for
+    # ceph_rbd_diff.merge_diffs; only the start of the first block is needed besides the index
+    def diff_index(self):
+        table = self.block_table()
+        block_starts = {}
+        for file_pos, stream_pos, length in table:
+            block_starts[file_pos] = stream_pos
+        extents = []
+        for extent in self.extents():
+            extents += [(extent.offset, extent.length, extent.zero,
+                block_starts[extent.block_pos] + extent.block_offset)]
+        # the header records are everything before the first extent record, or before the "e" record
+        if extents:
+            header_length = extents[0][3] - ceph_rbd_diff.MAX_RECORD_HEADER
+        else:
+            header_length = sum([length for file_pos, stream_pos, length in table]) - 1
+        index = ceph_rbd_diff.index_diff(io.BytesIO(self.read_at(0, header_length) + b"e"))
+        index.extents = extents
+        return index
+
+
+# A container to merge from, with the methods of ceph_rbd_diff.DiffFile. Only the blocks that hold data
+# which survives the merge are decompressed.
+class ContainerDiff:
+    def __init__(self, f):
+        self.f = f
+        self.reader = ContainerReader(f)
+        self.index = self.reader.diff_index()
+
+    def read(self, pos, length):
+        return self.reader.read_at(pos, length)
+
+    def copy(self, pos, length, out_fd):
+        while length:
+            chunk = min(length, BLOCK_SIZE)
+            ceph_rbd_diff.write_all(out_fd, self.reader.read_at(pos, chunk))
+            pos += chunk
+            length -= chunk
+
+    def close(self):
+        self.f.close()
+
+
+# A file object that reads the original v1 stream of the container in f, decompressing it as it goes, so a
+# stored container can be read like any diff without running the export command.
+class ContainerStream(io.RawIOBase):
+    def __init__(self, f):
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("not an rbd diff container")
+        self.blocks = read_blocks(f)
+        self.buf = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.buf = memoryview(block)
+        n = min(len(b), len(self.buf))
+        b[0:n] = self.buf[0:n]
+        self.buf = self.buf[n:]
+        return n
+
+# packs the v1 stream read from fin into a container written to fout
+def pack(fin, fout, level=DEFAULT_LEVEL):
+    writer = ContainerWriter(fout, level)
+    while True:
+        buf = fin.read(BLOCK_SIZE)
+        if not buf:
+            break
+        writer.write(buf)
+    writer.close()
+
+
+# writes the original v1 stream of the container read from fin to fout; fin doesn't need to be seekable
+def export(fin, fout):
+    if fin.read(len(MAGIC)) != MAGIC:
+        raise Exception("not an rbd diff container")
+    for block in read_blocks(fin):
+        fout.write(block)
+
+
+def print_index(fin):
+    for extent in ContainerReader(fin).extents():
+        print("%s %s %s %s+%s" % ("z" if extent.zero else "w", extent.offset, extent.length,
+            extent.block_pos, extent.block_offset))
+
+
+def open_arg(path, mode, default):
+    if path is None or path == "-":
+        return default
+    return open(path, mode)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert between rbd diff v1 streams and indexed, compressed rbd diff containers.")
+    parser.add_argument('command', choices=["pack", "export", "index"],
+                    help="pack a v1 stream into a container, export a container back to a v1 stream, or list a container's extents")
+    parser.add_argument('infile', nargs="?", default=None,
+                    help="input file (default stdin; index needs a seekable file)")
+    parser.add_argument('outfile', nargs="?", default=None,
+                    help="output file (default stdout)")
+    parser.add_argument('--level', dest='level', action='store',
+                    type=int, default=DEFAULT_LEVEL,
+                    help="zlib compression level for pack (default %s)" % DEFAULT_LEVEL)
+    args = parser.parse_args()
+
+    if args.command == "index":
+        with open(args.infile, "rb") as fin:
+            print_index(fin)
+        exit(0)
+
+    fin = open_arg(args.infile, "rb", sys.stdin.buffer)
+    fout = open_arg(args.outfile, "wb", sys.stdout.buffer)
+    try:
+        if args.command == "pack":
+            pack(fin, fout, args.level)
+        else:
+            export(fin, fout)
+        fout.flush()
+    finally:
+        if fin is not sys.stdin.buffer:
+            fin.close()
+        if fout is not sys.stdout.buffer:
+            fout.close()
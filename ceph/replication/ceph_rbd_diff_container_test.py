@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# checks ceph_rbd_diff_container.py: a diff packed into a container gives back the same bytes through export,
+# ContainerStream and ContainerReader.read_at, and its index finds the same extents and data as the diff's
+#
+#     python3 -m unittest ceph_rbd_diff_container_test
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import ceph_rbd_diff
+import ceph_rbd_diff_container
+import ceph_rbd_diff_test
+import ceph_snaprotator_bench
+
+BLOCK = ceph_snaprotator_bench.BLOCK
+
+
+# returns a diff with extents of odd sizes, some of them zero, so records don't line up with the blocks
+def make_diff(path, seed):
+    rng = random.Random(seed)
+    data = ceph_snaprotator_bench.DataSource(rng)
+    extents = []
+    offset = 0
+    for i in range(40):
+        length = rng.choice([BLOCK, 5 * BLOCK, 40 * BLOCK]) + rng.randrange(1, 512)
+        extents += [(offset, length, rng.random() < 0.2)]
+        offset += length + rng.randrange(0, 4) * BLOCK
+    ceph_snaprotator_bench.write_diff(path, "replication-1", "replication-2", offset, extents, data)
+    return ceph_rbd_diff_test.read_file(path)
+
+
+# packs diff with small blocks, writing it in chunks of odd sizes; returns the container
+def pack(diff, block_size=16 * BLOCK):
+    out = io.BytesIO()
+    writer = ceph_rbd_diff_container.ContainerWriter(out, block_size=block_size)
+    pos = 0
+    rng = random.Random(len(diff))
+    while pos < len(diff):
+        n = rng.randrange(1, 3 * block_size)
+        writer.write(diff[pos:pos + n])
+        pos += n
+    writer.close()
+    return out.getvalue()
+
+
+class ContainerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="ceph_rbd_diff_container_test.")
+        self.path = os.path.join(self.dir, "diff")
+        self.diff = make_diff(self.path, 1)
+        self.container = pack(self.diff)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_export(self):
+        out = io.BytesIO()
+        ceph_rbd_diff_container.export(io.BytesIO(self.container), out)
+        self.assertEqual(out.getvalue(), self.diff)
+
+    def test_stream(self):
+        stream = io.BufferedReader(ceph_rbd_diff_container.ContainerStream(io.BytesIO(self.container)))
+        self.assertEqual(stream.read(), self.diff)
+
+    def test_pack_function(self):
+        out = io.BytesIO()
+        ceph_rbd_diff_container.pack(io.BytesIO(self.diff), out)
+        exported = io.BytesIO()
+        ceph_rbd_diff_container.export(io.BytesIO(out.getvalue()), exported)
+        self.assertEqual(exported.getvalue(), self.diff)
+
+    def test_extents(self):
+        with open(self.path, "rb") as f:
+            index = ceph_rbd_diff.index_diff(f)
+        reader = ceph_rbd_diff_container.ContainerReader(io.BytesIO(self.container))
+        extents = reader.extents()
+        self.assertEqual([(e.offset, e.length, e.zero) for e in extents],
+            [(offset, length, zero) for offset, length, zero, data_pos in index.extents])
+        for extent, (offset, length, zero, data_pos) in zip(extents, index.extents):
+            expected = bytes(length) if zero else self.diff[data_pos:data_pos + length]
+            self.assertEqual(reader.read_extent(extent), expected)
+
+    def test_diff_index(self):
+        with open(self.path, "rb") as f:
+            expected = ceph_rbd_diff.index_diff(f)
+        index = ceph_rbd_diff_container.ContainerReader(io.BytesIO(self.container)).diff_index()
+        self.assertEqual((index.from_snap, index.to_snap, index.image_size),
+            (expected.from_snap, expected.to_snap, expected.image_size))
+        # zero extents have no data; only the data positions of "w" extents matter
+        self.assertEqual([e if not e[2] else e[0:3] for e in index.extents],
+            [e if not e[2] else e[0:3] for e in expected.extents])
+
+    def test_read_at(self):
+        reader = ceph_rbd_diff_container.ContainerReader(io.BytesIO(self.container))
+        rng = random.Random(2)
+        for i in range(200):
+            pos = rng.randrange(0, len(self.diff))
+            length = rng.randrange(1, min(len(self.diff) - pos, 100 * BLOCK) + 1)
+            self.assertEqual(reader.read_at(pos, length), self.diff[pos:pos + length])
+
+    def test_diff_without_extents(self):
+        diff = ceph_rbd_diff_test.make_diff("replication-1", "replication-2", 64 * BLOCK, [])
+        container = pack(diff)
+        index = ceph_rbd_diff_container.ContainerReader(io.BytesIO(container)).diff_index()
+        self.assertEqual((index.from_snap, index.to_snap, index.image_size, index.extents),
+            ("replication-1", "replication-2", 64 * BLOCK, []))
+        out = io.BytesIO()
+        ceph_rbd_diff_container.export(io.BytesIO(container), out)
+        self.assertEqual(out.getvalue(), diff)
+
+    def test_incomplete_container(self):
+        with self.assertRaises(Exception):
+            ceph_rbd_diff_container.ContainerReader(io.BytesIO(self.container[0:-1]))
+        with self.assertRaises(Exception):
+            ceph_rbd_diff_container.export(io.BytesIO(self.container[0:len(self.container) // 2]), io.BytesIO())
+
+    def test_incomplete_diff(self):
+        writer = ceph_rbd_diff_container.ContainerWriter(io.BytesIO())
+        writer.write(self.diff[0:-1])
+        with self.assertRaises(Exception):
+            writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# checks ceph_rbd_diff.merge_diffs on synthetic chains (see ceph_snaprotator_bench.py): merging a chain in one go
+# must give the same file as merging part of it first and then merging the result with the rest, which is what
+# the rotator does over time, and the same image as applying every diff in turn
+#
+# and byte for byte on small diff pairs with zero, shrink and grow records (MERGE_CASES), against merged diffs
+# written out by hand from how rbd merge-diff merges; where rbd is installed, they are checked against it too
+#
+#     python3 -m unittest ceph_rbd_diff_test
+
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+import ceph_rbd_diff
+import ceph_rbd_diff_container
+import ceph_snaprotator_bench
+
+BLOCK = ceph_snaprotator_bench.BLOCK
+
+
+# writes a chain of count diffs to image_path, with the image growing and shrinking now and then;
+# returns the paths, oldest first
+def write_chain(image_path, count, seed):
+    rng = random.Random(seed)
+    data = ceph_snaprotator_bench.DataSource(rng)
+    os.makedirs(image_path)
+    paths = []
+    prev = None
+    image_size = 256 * BLOCK
+    for i in range(count):
+        name = "replication-%04d" % i
+        if prev is not None and rng.random() < 0.3:
+            image_size = rng.randrange(64, 512) * BLOCK
+        if prev is None:
+            extents = [(0, image_size // 2, False)]
+        else:
+            hot_size = image_size // 8
+            extents = ceph_snaprotator_bench.make_extents(rng, image_size, 0, hot_size, rng.randrange(1, 64) * BLOCK)
+        path = os.path.join(image_path, name)
+        ceph_snaprotator_bench.write_diff(path, prev, name, image_size, extents, data)
+        paths += [path]
+        prev = name
+    return paths
+
+
+# returns the image that results from applying the diffs at paths to an empty image, in turn
+def apply_diffs(paths):
+    image = bytearray()
+    for path in paths:
+        with open(path, "rb") as f:
+            index = ceph_rbd_diff.index_diff(f)
+            del image[index.image_size:]
+            image += bytes(index.image_size - len(image))
+            for offset, length, zero, data_pos in index.extents:
+                if zero:
+                    image[offset:offset + length] = bytes(length)
+                else:
+                    f.seek(data_pos)
+                    image[offset:offset + length] = f.read(length)
+    return bytes(image)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# returns a diff with the records, each ("w", offset, data) or ("z", offset, length)
+def make_diff(from_snap, to_snap, size, records):
+    buf = bytearray(ceph_rbd_diff.HEADER)
+    for tag, name in [(b"f", from_snap), (b"t", to_snap)]:
+        if name:
+            buf += tag + struct.pack("<I", len(name)) + name.encode("utf-8")
+    buf += b"s" + struct.pack("<Q", size)
+    for record in records:
+        if record[0] == "w":
+            buf += b"w" + struct.pack("<QQ", record[1], len(record[2])) + record[2]
+        else:
+            buf += b"z" + struct.pack("<QQ", record[1], record[2])
+    return bytes(buf + b"e")
+
+
+K = 1024
+
+# (name, older diff, newer diff, merged), each diff as the arguments of make_diff. In the merged diff, the newer
+# diff wins where they overlap, the older diff's records are cut at a smaller new size, and the part the image
+# grew by is zeroed where the newer diff has nothing.
+MERGE_CASES = [
+    ("zero",
+        (None, "s1", 64*K, [("w", 0, b"a" * 8*K), ("w", 16*K, b"b" * 8*K), ("z", 32*K, 8*K)]),
+        ("s1", "s2", 64*K, [("z", 4*K, 16*K), ("w", 36*K, b"c" * 4*K)]),
+        (None, "s2", 64*K, [("w", 0, b"a" * 4*K), ("z", 4*K, 16*K), ("w", 20*K, b"b" * 4*K), ("z", 32*K, 4*K),
+            ("w", 36*K, b"c" * 4*K)])),
+    ("shrink",
+        (None, "s1", 64*K, [("w", 0, b"a" * 8*K), ("w", 28*K, b"c" * 8*K), ("w", 40*K, b"b" * 8*K)]),
+        ("s1", "s2", 32*K, [("w", 8*K, b"d" * 4*K)]),
+        (None, "s2", 32*K, [("w", 0, b"a" * 8*K), ("w", 8*K, b"d" * 4*K), ("w", 28*K, b"c" * 4*K)])),
+    ("grow",
+        ("s0", "s1", 32*K, [("w", 0, b"a" * 4*K), ("w", 28*K, b"b" * 4*K)]),
+        ("s1", "s2", 64*K, [("w", 40*K, b"c" * 4*K)]),
+        ("s0", "s2", 64*K, [("w", 0, b"a" * 4*K), ("w", 28*K, b"b" * 4*K), ("z", 32*K, 8*K), ("w", 40*K, b"c" * 4*K),
+            ("z", 44*K, 20*K)])),
+]
+
+
+class MergeCasesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="ceph_rbd_diff_test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # writes the two diffs of a case; returns their paths, the output path and the expected bytes
+    def write_case(self, name, older, newer, merged):
+        paths = []
+        for suffix, diff in [("older", older), ("newer", newer)]:
+            path = os.path.join(self.dir, "%s.%s" % (name, suffix))
+            with open(path, "wb") as f:
+                f.write(make_diff(*diff))
+            paths += [path]
+        return paths, os.path.join(self.dir, name + ".merged"), make_diff(*merged)
+
+    def test_merge_diffs(self):
+        for name, older, newer, merged in MERGE_CASES:
+            paths, out, expected = self.write_case(name, older, newer, merged)
+            ceph_rbd_diff.merge_diffs(paths, out)
+            self.assertEqual(read_file(out), expected, name)
+
+    @unittest.skipUnless(shutil.which("rbd"), "needs rbd")
+    def test_rbd_merge_diff(self):
+        for name, older, newer, merged in MERGE_CASES:
+            paths, out, expected = self.write_case(name, older, newer, merged)
+            subprocess.check_call(["rbd", "merge-diff"] + paths + [out])
+            self.assertEqual(read_file(out), expected, name)
+
+
+class MergeDiffsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="ceph_rbd_diff_test.")
+        self.paths = write_chain(os.path.join(self.dir, "image"), 12, 1)
+        self.whole = os.path.join(self.dir, "whole")
+        ceph_rbd_diff.merge_diffs(self.paths, self.whole)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def merge(self, paths, name):
+        out = os.path.join(self.dir, name)
+        ceph_rbd_diff.merge_diffs(paths, out)
+        return out
+
+    def test_same_image_as_applying_each_diff(self):
+        self.assertEqual(apply_diffs([self.whole]), apply_diffs(self.paths))
+
+    def test_merging_in_steps(self):
+        expected = read_file(self.whole)
+        for k in range(2, len(self.paths) - 1):
+            # merge(a..n) == merge(merge(a..k), k+1..n)
+            first = self.merge(self.paths[0:k], "first")
+            self.assertEqual(read_file(self.merge([first] + self.paths[k:], "chained")), expected, "k = %s" % k)
+            # and the same with the newer part merged first
+            last = self.merge(self.paths[k:], "last")
+            self.assertEqual(read_file(self.merge(self.paths[0:k] + [last], "chained")), expected, "k = %s" % k)
+
+    def test_merging_containers(self):
+        paths = []
+        for i, path in enumerate(self.paths):
+            if i % 2:
+                # small blocks, so extents span blocks
+                with open(path, "rb") as fin, open(path + ".rbdx", "wb") as fout:
+                    writer = ceph_rbd_diff_container.ContainerWriter(fout, block_size=16 * BLOCK)
+                    writer.write(fin.read())
+                    writer.close()
+                path += ".rbdx"
+            paths += [path]
+        self.assertEqual(read_file(self.merge(paths, "containers")), read_file(self.whole))
+
+    def test_without_copy_file_range(self):
+        copy_file_range = getattr(os, "copy_file_range", None)
+        if copy_file_range:
+            del os.copy_file_range
+        try:
+            self.assertEqual(read_file(self.merge(self.paths, "copied")), read_file(self.whole))
+        finally:
+            if copy_file_range:
+                os.copy_file_range = copy_file_range
+
+    def test_broken_chain(self):
+        with self.assertRaises(Exception):
+            self.merge(self.paths[0:2] + self.paths[3:], "broken")
+
+
+if __name__ == "__main__":
+    unittest.main()
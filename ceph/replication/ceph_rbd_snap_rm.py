@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+#
+# removes many rbd snapshots: the snaps of an image are removed in batches (one process, or one ssh connection,
+# per batch instead of one per snap; with the python rbd bindings, one cluster connection and one open of the
+# image per batch too), several images at a time, and a new batch waits while too many PGs of the
+# cluster are trimming snaps, so the trimming doesn't swamp client I/O
+#
+# used by ceph_snaprotator.py, and by ceph_repl_cleanup.bash, which gives it image@snap lines on stdin:
+#     ceph_rbd_snap_rm.py --host ceph1 --pool proxmox < list
+#
+# with a catalog (see ceph_repl_catalog.py), the removed snaps are removed from it too
+
+import argparse
+import concurrent.futures
+import json
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+import ceph_repl_catalog
+
+BATCH_SIZE = 20
+JOBS = 4
+MAX_SNAPTRIM_PGS = 32
+SNAPTRIM_CHECK_INTERVAL = 10
+
+# exit code of REMOVE_PYTHON when the python rbd bindings (python3-rbd) aren't installed
+NO_BINDINGS = 100
+
+# removes the snaps given as arguments after the pool/image, going on after a failure: with the rbd bindings, all
+# of them with one cluster connection and one open of the image; rbd snap rm connects and opens it for each snap
+REMOVE_PYTHON = """
+import sys
+try:
+    import rados, rbd
+except ImportError:
+    sys.exit(%s)
+pool, name = sys.argv[1].split("/", 1)
+rc = 0
+with rados.Rados(conffile="") as cluster, cluster.open_ioctx(pool) as ioctx, rbd.Image(ioctx, name) as image:
+    for snap in sys.argv[2:]:
+        try:
+            image.remove_snap(snap)
+        except rbd.Error as e:
+            sys.stderr.write("%%s@%%s: %%s\\n" %% (sys.argv[1], snap, e))
+            rc = 1
+sys.exit(rc)
+""" % NO_BINDINGS
+REMOVE_SCRIPT = 'image="$1"; shift; rc=0; for snap in "$@"; do rbd snap rm "$image@$snap" || rc=1; done; exit $rc'
+
+# the threads print whole lines
+print_lock = threading.Lock()
+
+
+def log_info(message):
+    with print_lock:
+        print("INFO: %s" % message)
+        sys.stdout.flush()
+
+
+def log_error(message):
+    with print_lock:
+        print("ERROR: %s" % message)
+        sys.stdout.flush()
+
+
+# runs pargs locally, or on host over ssh; returns (returncode, stdout, stderr)
+def run_command(host, pargs):
+    if host:
+        pargs = ["ssh", host, " ".join(shlex.quote(arg) for arg in pargs)]
+    p = subprocess.run(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return p.returncode, p.stdout.decode("utf-8"), p.stderr.decode("utf-8")
+
+
+# returns how many PGs are trimming snaps or waiting to
+def count_snaptrim_pgs(host):
+    returncode, out, err = run_command(host, ["ceph", "pg", "ls", "snaptrim", "snaptrim_wait", "--format", "json"])
+    if returncode != 0:
+        raise Exception("Failed to list snaptrim PGs:\n%s" % err)
+    pgs = json.loads(out or "[]")
+    if isinstance(pgs, dict):
+        # newer releases wrap the list
+        pgs = pgs.get("pg_stats") or []
+    return len(pgs)
+
+
+# Makes removals wait while more than max_pgs PGs are trimming snaps. The count is shared by all the threads and
+# checked at most every interval seconds. If it can't be read, there's no pacing.
+class SnapTrimPacer:
+    def __init__(self, host, max_pgs, interval=SNAPTRIM_CHECK_INTERVAL):
+        self.host = host
+        self.max_pgs = max_pgs
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.count = None
+        self.checked = None
+
+    # the lock is only held for the check, so one thread runs the ceph command while the others wait for its
+    # answer, and no thread sleeps holding it
+    def wait(self):
+        while True:
+            with self.lock:
+                if not self.max_pgs:
+                    return
+                checked = False
+                if self.checked is None or time.time() - self.checked >= self.interval:
+                    self.checked = time.time()
+                    checked = True
+                    try:
+                        self.count = count_snaptrim_pgs(self.host)
+                    except Exception as e:
+                        log_error("%s\nremoving snaps without waiting for snap trimming" % e)
+                        self.max_pgs = None
+                        return
+                if self.count <= self.max_pgs:
+                    return
+                count = self.count
+                delay = self.checked + self.interval - time.time()
+            if checked:
+                log_info("%s PGs are trimming snaps, waiting for them to get down to %s" % (count, self.max_pgs))
+            time.sleep(max(delay, 0))
+
+
+# Removes the snaps of many images; see remove(). With a ceph_repl_catalog.Catalog, each batch that was removed is
+# removed from it at location (eg. "rbd:ceph").
+class SnapRemover:
+    def __init__(self, host=None, jobs=JOBS, batch_size=BATCH_SIZE, max_snaptrim_pgs=MAX_SNAPTRIM_PGS, catalog=None,
+            location=None):
+        self.host = host
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.pacer = SnapTrimPacer(host, max_snaptrim_pgs)
+        self.catalog = catalog
+        self.location = location
+        # False once the rbd bindings turned out to be missing, so the rest goes straight to rbd snap rm
+        self.bindings = True
+        self.bindings_lock = threading.Lock()
+
+    # removals is a list of (image path, list of snap names)
+    # returns a list of errors, empty if all the snaps were removed
+    def remove(self, removals):
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [pool.submit(self.remove_image, image_path, snaps) for image_path, snaps in removals if snaps]
+            for future in futures:
+                errors += future.result()
+        return errors
+
+    def remove_image(self, image_path, snaps):
+        errors = []
+        for i in range(0, len(snaps), self.batch_size):
+            batch = snaps[i:i + self.batch_size]
+            self.pacer.wait()
+            log_info("removing %s snaps of %s: %s" % (len(batch), image_path, " ".join(batch)))
+            returncode, out, err = self.remove_batch(image_path, batch)
+            if returncode != 0:
+                error = "Failed to remove snaps of \"%s\":\n%s" % (image_path, err)
+                log_error(error)
+                errors += [error]
+                # eg. a snap the catalog has is already gone; the image is listed again next time
+                self.forget(image_path)
+            else:
+                self.uncatalog(image_path, batch)
+        return errors
+
+    def remove_batch(self, image_path, snaps):
+        if self.bindings:
+            returncode, out, err = run_command(self.host, ["python3", "-c", REMOVE_PYTHON, image_path] + snaps)
+            if returncode != NO_BINDINGS:
+                return returncode, out, err
+            with self.bindings_lock:
+                if self.bindings:
+                    log_info("no python rbd bindings%s, removing snaps with rbd snap rm" %
+                        (" on %s" % self.host if self.host else ""))
+                    self.bindings = False
+        return run_command(self.host, ["bash", "-c", REMOVE_SCRIPT, "-", image_path] + snaps)
+
+    def uncatalog(self, image_path, snaps):
+        if not self.catalog:
+            return
+        pool, image = image_path.split("/", 1)
+        try:
+            self.catalog.remove(self.location, pool, image, snaps)
+        except Exception as e:
+            # the snaps are gone anyway; the catalog is only a cache
+            log_error("could not update catalog %s: %s" % (self.catalog.path, e))
+
+    def forget(self, image_path):
+        if not self.catalog:
+            return
+        pool, image = image_path.split("/", 1)
+        try:
+            self.catalog.forget_image(self.location, pool, image)
+        except Exception as e:
+            log_error("could not update catalog %s: %s" % (self.catalog.path, e))
+
+
+# reads image@snap lines, and returns them grouped by image, as a list of (image path, list of snap names)
+def read_removals(fileobj, pool=None):
+    ret = {}
+    for line in fileobj:
+        line = line.strip()
+        if not line:
+            continue
+        image, snap = line.split("@", 1)
+        if pool:
+            image = "%s/%s" % (pool, image)
+        ret.setdefault(image, []).append(snap)
+    return list(ret.items())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove the rbd snaps listed on stdin (image@snap lines), in batches, several images at a time, paced by the cluster's snap trimming.")
+    parser.add_argument('--host', dest='host', action='store',
+                    default=None,
+                    help='run the rbd and ceph commands on this host with ssh (default local)')
+    parser.add_argument('--pool', dest='pool', action='store',
+                    default=None,
+                    help='pool of the images, if the lines don\'t have it')
+    parser.add_argument('-j', '--jobs', dest='jobs', action='store',
+                    type=int, default=JOBS,
+                    help='remove snaps of this many images at the same time (default %s)' % JOBS)
+    parser.add_argument('--batch', dest='batch_size', action='store',
+                    type=int, default=BATCH_SIZE,
+                    help='remove up to this many snaps of an image with one command (default %s)' % BATCH_SIZE)
+    parser.add_argument('--max-snaptrim', dest='max_snaptrim_pgs', action='store',
+                    type=int, default=MAX_SNAPTRIM_PGS,
+                    help='wait before each batch while more PGs than this are trimming snaps; 0 to not wait (default %s)' % MAX_SNAPTRIM_PGS)
+    parser.add_argument('--catalog', dest='catalog', action='store',
+                    default=None,
+                    help='remove the snaps from this snapshot catalog too (see ceph_repl_catalog.py; default none)')
+    parser.add_argument('--location', dest='location', action='store',
+                    default=None,
+                    help='location of the snaps in the catalog, eg. rbd:ceph (rbd:<cluster>, the cluster name ceph_repl.py uses)')
+    args = parser.parse_args()
+
+    catalog = None
+    if args.catalog:
+        if not args.location:
+            parser.error("--catalog needs --location")
+        try:
+            catalog = ceph_repl_catalog.Catalog(args.catalog)
+        except Exception as e:
+            log_error("could not open catalog %s, going on without it: %s" % (args.catalog, e))
+    remover = SnapRemover(args.host, args.jobs, args.batch_size, args.max_snaptrim_pgs, catalog, args.location)
+    errors = remover.remove(read_removals(sys.stdin, args.pool))
+    if errors:
+        exit(1)
@@ -17,7 +17,6 @@
 # TODO:
 # a temp clean feature? just scan through image names on src, and for each image on dest, remove temp files
 # a log feature, to a file instead of stdout, and no log for when can't get a lock
-# lz4 for import-diff method
 
 import datetime
 import socket
@@ -25,47 +24,60 @@ import subprocess
 import sys
 import json
 import argparse
+import collections
+import asyncio
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
+import errno
 import fcntl
+import fnmatch
 import os
 import glob
+import mmap
+import shlex
+import signal
+import tempfile
+import threading
 import traceback
 import time
 
+import ceph_rbd_diff
+import ceph_rbd_diff_container
+import ceph_repl_catalog
+import ceph_repl_compression
+from ceph_repl_util import format_bytes
 
+
+# one write per line, so lines from background threads (--pipeline) don't get mixed up
 def log_error(message):
-    print("ERROR: %s" % message)
+    sys.stdout.write("ERROR: %s\n" % message)
     sys.stdout.flush()
 
 
 def log_debug(message):
     if debug:
-        print("DEBUG: %s" % message)
+        sys.stdout.write("DEBUG: %s\n" % message)
         sys.stdout.flush()
 
 
 def log_info(message):
-    print("INFO: %s" % message)
+    sys.stdout.write("INFO: %s\n" % message)
     sys.stdout.flush()
     
 
-def format_bytes(count):
-    if count >= 1000 * 1000 * 1000 * 1000:
-        return "%sTB" % (int(float(count)/1000000000)/1000)
-    if count >= 1000 * 1000 * 1000:
-        return "%sGB" % (int(float(count)/1000000)/1000)
-    if count >= 1000 * 1000:
-        return "%sMB" % (int(float(count)/1000)/1000)
-    if count >= 1000:
-        return "%skB" % (int(float(count))/1000)
-    return "%sB" % count
+# extra ssh options, eg. for connection sharing in daemon mode
+ssh_options = []
+
+def ssh_command(remote_host):
+    return ["ssh"] + ssh_options + [remote_host]
 
 
 def ssh_test(remote_host):
-    p = subprocess.Popen(["ssh", remote_host, "hostname -s"], 
-        stdout=subprocess_devnull, stderr=subprocess_devnull)
-    p.wait()
+    returncode, out, err = run_command(ssh_command(remote_host) + ["hostname -s"], 60)
     
-    if( p.returncode == 0 ):
+    if( returncode == 0 ):
         return True
     
     return False
@@ -95,6 +107,9 @@ def findhost(remote_cluster):
 
 def read_file(fileobj):
     ret = ""
+    if fileobj.seekable():
+        # stderr of a stream process, see stream_popen()
+        fileobj.seek(0)
     for line in fileobj:
         if type(line) != str:
             line = line.decode("utf-8")
@@ -112,65 +127,145 @@ def set_direction(host, pargs):
     
     # it is expected that when direction+host means "me" the host/xxx_host values are None
     if cfg.direction == "pull" and host == cfg.src_host:
-        pargs = ["ssh", host] + nice + pargs
+        pargs = ssh_command(host) + nice + pargs
     elif cfg.direction == "pull" and host == cfg.dest_host:
         pargs = nice + pargs
     elif cfg.direction == "push" and host == cfg.src_host:
         pargs = nice + pargs
     elif cfg.direction == "push" and host == cfg.dest_host:
-        pargs = ["ssh", host] + nice + pargs
+        pargs = ssh_command(host) + nice + pargs
     else: 
-        raise Exception("unexpected direction = %s, host = %s" % (direction, host))
+        raise Exception("unexpected direction = %s, host = %s" % (cfg.direction, host))
     
     log_debug("host = %s, pargs = %s" % (host, pargs))
     return pargs
 
 
-def get_images(pool, host=None):
-    args = set_direction(host, ["rbd", "ls", pool])
+# like set_direction(), but for a list of commands that are piped together on host
+# the pipeline fails if any of the commands fails, not only the last one, so a failed export can't hide behind a compressor
+def pipeline_command(host, commands):
+    if len(commands) == 1:
+        return set_direction(host, commands[0])
 
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    if( p.returncode == 0 ):
-        ret = []
-        for line in p.stdout:
-            line = line.decode("utf-8").splitlines()[0]
-            ret += [line]
-        return ret
+    return script_command(host, "set -o pipefail; " + pipeline_script(commands))
+
+
+def pipeline_script(commands):
+    return " | ".join([" ".join([shlex.quote(a) for a in c]) for c in commands])
+
+
+# like set_direction(), but for a bash script
+def script_command(host, script):
+    if host:
+        # ssh joins its arguments and the remote shell splits them again
+        script = shlex.quote(script)
+    return set_direction(host, ["bash", "-c", script])
+
+
+# Short commands (listings, metadata, snapshots) run through asyncio, which reads their stdout and stderr
+# while waiting for them, so a chatty stderr can't fill the pipe and hang the wait; and a command that
+# hangs (eg. ssh to a dead host, or rbd on a cluster without quorum) is killed after command_timeout.
+# Several commands can run at once on one event loop without a thread each, see run_commands().
+#
+# The streams (export-diff and friends) still use Popen, so the data can be spliced; their stderr goes to a
+# temp file instead, see stream_popen().
+command_timeout = 10*60
+
+async def run_command_async(pargs, timeout):
+    p = await asyncio.create_subprocess_exec(*pargs, stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        out, err = await asyncio.wait_for(p.communicate(), timeout)
+    except asyncio.TimeoutError:
+        p.kill()
+        await p.wait()
+        return -1, "", "\"%s\" timed out after %ss" % (" ".join(pargs), timeout)
+    except BaseException:
+        # cancelled, eg. by SIGTERM
+        p.kill()
+        await p.wait()
+        raise
+    return p.returncode, out.decode("utf-8", "replace"), err.decode("utf-8", "replace")
+
+
+# runs the commands (lists of args) at the same time, and returns a list of (returncode, stdout, stderr)
+def run_commands(commands, timeout=None):
+    if timeout is None:
+        timeout = command_timeout
+
+    async def run_all():
+        return await asyncio.gather(*[run_command_async(pargs, timeout or None) for pargs in commands])
+    return asyncio.run(run_all())
+
+
+def run_command(pargs, timeout=None):
+    return run_commands([pargs], timeout)[0]
+
+
+# starts a long running process whose stderr goes to a temp file instead of a pipe, so it can't fill up
+# and block the process while we're busy with its stdout; read_file(p.stderr) reads it from the start
+def stream_popen(pargs, **kwargs):
+    stderr = tempfile.TemporaryFile()
+    p = subprocess.Popen(pargs, stderr=stderr, **kwargs)
+    p.stderr = stderr
+    return p
+
+
+# kills the stream processes that are still running and waits for them, and for the thread pumping between
+# them (see start_decompressor), so a transfer that failed halfway doesn't leave ssh or export-diff behind
+def stop_streams(processes, pump=None):
+    for p in processes:
+        if p and p.poll() is None:
+            p.kill()
+    for p in processes:
+        if p:
+            p.wait()
+    if pump:
+        pump.join()
+
+
+def get_images(pool, host=None):
+    returncode, out, err = run_command(set_direction(host, ["rbd", "ls", pool]))
+    if( returncode == 0 ):
+        return out.splitlines()
     
-    raise Exception("Failed to get list of rbd images:\n%s" % read_file(p.stderr))
+    raise Exception("Failed to get list of rbd images:\n%s" % err)
 
 
 def snap_create(snap_path, host=None):
-    args = set_direction(host, ["rbd", "snap", "create", snap_path])
-
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    if( p.returncode == 0 ):
+    returncode, out, err = run_command(set_direction(host, ["rbd", "snap", "create", snap_path]))
+    if( returncode == 0 ):
         return
     
-    raise Exception("Failed to create snapshot \"%s\":\n%s" % (snap_path, read_file(p.stderr)))
+    raise Exception("Failed to create snapshot \"%s\":\n%s" % (snap_path, err))
 
 
 def snap_rm(snap_path, host=None):
-    args = set_direction(host, ["rbd", "snap", "rm", snap_path])
-
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    if( p.returncode == 0 ):
+    returncode, out, err = run_command(set_direction(host, ["rbd", "snap", "rm", snap_path]))
+    if( returncode == 0 ):
+        if host == cfg.src_host:
+            image_path, snap_name = snap_path.split("@")
+            pool, image = image_path.split("/")
+            catalog_call("remove", src_location(), pool, image, [snap_name])
         return
     
-    raise Exception("Failed to rm snapshot \"%s\":\n%s" % (snap_path, read_file(p.stderr)))
+    raise Exception("Failed to rm snapshot \"%s\":\n%s" % (snap_path, err))
+
+
+def size_command(image_path, host=None):
+    return set_direction(host, ["rbd", "info", image_path, "--format", "json"])
 
 
 # return size in MiB (just like argument to rbd create --size ...)
 def get_size(image_path, host=None):
-    args = set_direction(host, ["rbd", "info", image_path, "--format", "json"])
-        
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    if( p.returncode == 0 ):
-        o = json.loads( read_file(p.stdout) )
+    return parse_size(image_path, run_command(size_command(image_path, host)))
+
+
+# parses the result of size_command(); see run_commands()
+def parse_size(image_path, result):
+    returncode, out, err = result
+    if( returncode == 0 ):
+        o = json.loads(out)
         size = o["size"]
         sizeMB = size/1024/1024
         ret = int(sizeMB)
@@ -179,16 +274,22 @@ def get_size(image_path, host=None):
             ret+=1
         return ret
     
-    raise Exception("Failed to get size of \"%s\":\n%s" % (image_path, read_file(p.stderr)))
+    raise Exception("Failed to get size of \"%s\":\n%s" % (image_path, err))
+
+
+def latest_snap_command(image_path, host=None):
+    return set_direction(host, ["rbd", "snap", "ls", image_path, "--format", "json"])
 
 
 def get_latest_snap(image_path, host=None):
-    args = set_direction(host, ["rbd", "snap", "ls", image_path, "--format", "json"])
-        
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    if( p.returncode == 0 ):
-        o = json.loads( read_file(p.stdout) )
+    return parse_latest_snap(image_path, run_command(latest_snap_command(image_path, host)))
+
+
+# parses the result of latest_snap_command(); see run_commands()
+def parse_latest_snap(image_path, result):
+    returncode, out, err = result
+    if( returncode == 0 ):
+        o = json.loads(out)
         obj = None
         
         for obj in o:
@@ -198,146 +299,864 @@ def get_latest_snap(image_path, host=None):
             return None
         return obj["name"]
     
-    raise Exception("Failed to get latest snap of \"%s\":\n%s" % (image_path, read_file(p.stderr)))
+    raise Exception("Failed to get latest snap of \"%s\":\n%s" % (image_path, err))
+
+
+# returns the number of bytes changed in image_path since from_snap, rounded up to whole objects
+# (uses the object map when fast-diff is enabled, so it doesn't need to read the image data)
+# from_snap None means everything allocated, ie. the size of a full export
+def get_diff_size(image_path, from_snap, host=None):
+    pargs = ["rbd", "diff"]
+    if from_snap:
+        pargs += ["--from-snap", from_snap]
+    returncode, out, err = run_command(set_direction(host, pargs + ["--whole-object", image_path, "--format", "json"]))
+    if( returncode == 0 ):
+        total = 0
+        for extent in json.loads(out):
+            total += extent["length"]
+        return total
+
+    raise Exception("Failed to get diff size of \"%s\" from snap \"%s\":\n%s" % (image_path, from_snap, err))
 
 
 def rbd_create(image_path, size, host=None):
-    args = set_direction(host, ["rbd", "create", image_path, "--size", str(size)])
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    if( p.returncode == 0 ):
+    returncode, out, err = run_command(set_direction(host, ["rbd", "create", image_path, "--size", str(size)]))
+    if( returncode == 0 ):
         return
     
-    raise Exception("Failed to create destination image \"%s\" size \"%s\" MB:\n%s" % (image_path, size, read_file(p.stderr)))
+    raise Exception("Failed to create destination image \"%s\" size \"%s\" MB:\n%s" % (image_path, size, err))
 
 
-def repl(snap_path, dest_image_path, prev_snap_name=None):
+def repl(snap_path, dest_image_path, prev_snap_name=None, job=None):
     global cfg
     
     log_info("Starting replication for snap src \"%s\" prev snap \"%s\" dest \"%s\"" 
         % (snap_path, prev_snap_name, dest_image_path))
     
-    args = ["rbd", "export-diff"]
+    export_args = ["rbd", "export-diff"]
     if prev_snap_name:
-        args += ["--from-snap", prev_snap_name]
-    args += [snap_path, "-"]
-    args = set_direction(cfg.src_host, args)
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        export_args += ["--from-snap", prev_snap_name]
+    export_args += [snap_path, "-"]
+    import_args = ["rbd", "import-diff", "-", dest_image_path]
+
+    if codec:
+        args = pipeline_command(cfg.src_host, [export_args, codec.compress_command()])
+    else:
+        args = pipeline_command(cfg.src_host, [export_args])
+    p = stream_popen(args, stdout=subprocess.PIPE)
 
-    args = set_direction(cfg.dest_host, ["rbd", "import-diff", "-", dest_image_path])
-    p2 = subprocess.Popen(args, stdin=p.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if codec:
+        args = pipeline_command(cfg.dest_host, [codec.decompress_command(), import_args])
+    else:
+        args = pipeline_command(cfg.dest_host, [import_args])
+    # the stream goes through us (spliced, so it's cheap) to be counted and throttled
+    total = 0
+    p2 = stream_popen(args, stdin=subprocess.PIPE, stdout=subprocess_devnull)
+    try:
+        total = copy_stream(p.stdout, p2.stdin, throttle)
+        log_info("read %s" % format_bytes(total))
+        # what goes through here is still compressed; the diff size isn't known here
+        set_stream_stats(total, None if codec else total)
+    except OSError as e:
+        # import-diff died; the return codes below tell why
+        log_debug("copy to import-diff failed: %s" % e)
+    try:
+        p2.stdin.close()
+    except OSError:
+        pass
+    # so export-diff gets SIGPIPE if import-diff died
+    p.stdout.close()
 
     p2.wait()
-    if( p2.returncode == 0 ):
+    p.wait()
+    if( p.returncode == 0 and p2.returncode == 0 ):
+        mark_committed(job)
         log_info("replication successful \"%s\" -> \"%s\"" % (snap_path, dest_image_path))
+        dest_pool, image = dest_image_path.split("/")
+        catalog_call("add", dest_location(), dest_pool, image, snap_path.split("@")[-1], None, None, prev_snap_name)
 
         # clean up remote snap for better cluster performance... only keep one snap
         if prev_snap_name:
-            log_info("removing snap \"%s\"" % (prev_snap_name))
             prev_snap_path = snap_path.split("@")[0] + "@" + prev_snap_name
-            snap_rm(prev_snap_path, cfg.src_host)
-        return
-    raise Exception("failed to export/import diff the stream, src \"%s\" prev snap \"%s\" dest \"%s\":\n%s" % 
-                    (snap_path, prev_snap_name, dest_image_path, read_file(p2.stderr)) )
+            remove_old_snap(prev_snap_path)
+        return total
+    raise Exception("failed to export/import diff the stream, src \"%s\" prev snap \"%s\" dest \"%s\":\nexport returned %s\n%s\nimport returned %s\n%s" % 
+                    (snap_path, prev_snap_name, dest_image_path, p.returncode, read_file(p.stderr), p2.returncode, read_file(p2.stderr)) )
 
 
-def repl_to_directory(snap_path, dest_image_dir_path):
-    global cfg, args
-    
-    newest = None
-    prev_snap_name = None
+COPY_CHUNK_SIZE = 1024*1024
+
+# F_SETPIPE_SZ is only in the fcntl module since python 3.10; the value is the same on all linux arches
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+
+# try to make the pipe buffer as big as one copy chunk, so each splice moves a full chunk
+def set_pipe_size(fd, size=COPY_CHUNK_SIZE):
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except Exception as e:
+        # not linux, or size is above /proc/sys/fs/pipe-max-size for an unprivileged user
+        log_debug("could not set pipe size to %s: %s" % (size, e))
+
+
+# parses sizes like "500k", "20M" or "1G" into a number of bytes (powers of 1000, like format_bytes)
+def parse_bytes(text):
+    units = {"k": 1000, "m": 1000*1000, "g": 1000*1000*1000, "t": 1000*1000*1000*1000}
+    text = text.strip()
+    if text[-1:].lower() in units:
+        return int(float(text[0:-1]) * units[text[-1:].lower()])
+    return int(text)
+
+
+# returns the current status of the source cluster, eg. "HEALTH_OK"
+def get_health():
+    global cfg
+
+    returncode, out, err = run_command(set_direction(cfg.src_host, ["ceph", "health"]))
+    if( returncode == 0 ):
+        return out.split(" ")[0].strip()
+
+    raise Exception("Failed to get cluster health:\n%s" % err)
+
+
+# A token bucket rate limiter for the replication streams.
+#
+# schedule is a comma separated list of rates in bytes/s, where each one can be limited to a time of day, eg.
+#     "08:00-18:00=20M,200M" is 20MB/s during business hours and 200MB/s otherwise
+# A rate of 0 is unlimited. Windows may wrap around midnight, eg. "22:00-06:00=0".
+#
+# If pause_health is given (a list of statuses like ["HEALTH_ERR"]), the stream is also paused while
+# "ceph health" on the source reports one of them, checked at most every health_interval seconds.
+class Throttle:
+    def __init__(self, schedule, pause_health=None, health_interval=30):
+        self.windows = []
+        self.default_rate = 0
+        for item in schedule.split(","):
+            if not item.strip():
+                continue
+            if "=" in item:
+                when, rate = item.split("=", 1)
+                start, end = when.split("-", 1)
+                self.windows += [(self.parse_time(start), self.parse_time(end), parse_bytes(rate))]
+            else:
+                self.default_rate = parse_bytes(item)
+
+        self.pause_health = pause_health or []
+        self.health_interval = health_interval
+        self.last_health_check = 0
+
+        self.tokens = 0
+        self.last = time.time()
+
+    # returns minutes since midnight for "HH:MM"
+    def parse_time(self, text):
+        hour, minute = text.strip().split(":")
+        return int(hour)*60 + int(minute)
+
+    # returns the rate in bytes/s for the given datetime, 0 meaning unlimited
+    def get_rate(self, now):
+        minute = now.hour*60 + now.minute
+        for start, end, rate in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.default_rate
+
+    # blocks while the cluster is in one of the pause_health states
+    def wait_healthy(self):
+        if not self.pause_health or time.time() - self.last_health_check < self.health_interval:
+            return
+
+        paused = False
+        while True:
+            self.last_health_check = time.time()
+            try:
+                health = get_health()
+            except Exception as e:
+                log_error("could not check cluster health, not pausing: %s" % e)
+                break
+            if health not in self.pause_health:
+                break
+            if not paused:
+                log_info("cluster is %s, pausing replication" % health)
+                paused = True
+            time.sleep(self.health_interval)
+
+        if paused:
+            log_info("cluster is %s, resuming replication" % health)
+            # don't let the pause count as saved up bandwidth
+            self.tokens = 0
+            self.last = time.time()
+
+    # called after count bytes were sent; sleeps as long as needed to keep to the current rate
+    def consume(self, count):
+        self.wait_healthy()
+
+        now = time.time()
+        rate = self.get_rate(datetime.datetime.now())
+        if not rate:
+            self.tokens = 0
+            self.last = now
+            return
+
+        # refill the bucket, allowing at most one second of burst
+        self.tokens = min(rate, self.tokens + (now - self.last) * rate)
+        self.last = now
+        self.tokens -= count
+        if self.tokens < 0:
+            time.sleep(-self.tokens / rate)
+            self.tokens = 0
+            self.last = time.time()
+
+
+# copies everything from the pipe src into the file dest, and returns the number of bytes copied
+# if throttle is given, its rate limit and health pause apply to the copy
+# every observer's update() is called with the running total after every chunk (see Checkpoint and FileDigest)
+#
+# On linux this uses splice(2) so the data goes pipe -> page cache without being copied through python.
+# (sendfile(2) can't be used because it needs an mmap-able input, and a pipe isn't)
+# Otherwise, or if the destination filesystem doesn't support splice, it uses readinto with a memoryview
+# so no new bytes object is made for every chunk.
+def copy_stream(src, dest, throttle=None, observers=()):
+    total = 0
+
+    src_fd = src.fileno()
+    if hasattr(os, "splice"):
+        set_pipe_size(src_fd)
+        dest.flush()
+        dest_fd = dest.fileno()
+        try:
+            while True:
+                r = os.splice(src_fd, dest_fd, COPY_CHUNK_SIZE)
+                if not r:
+                    return total
+                total += r
+                if throttle:
+                    throttle.consume(r)
+                for observer in observers:
+                    observer.update(total)
+        except OSError as e:
+            log_debug("splice failed after %s, falling back to read/write: %s" % (format_bytes(total), e))
+
+    buf = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        r = src.readinto(buf)
+        if not r:
+            break
+        dest.write(view[0:r])
+        total += r
+        if throttle:
+            throttle.consume(r)
+        for observer in observers:
+            observer.update(total)
+
+    return total
+
+
+# Starts the local decompressor for the compressed stream from p1. With a throttle, the compressed stream goes
+# through a thread of ours on its way in, so the throttle counts the bytes that cross the link, as in repl(),
+# instead of the decompressed ones.
+# returns (the decompressor, that thread or None); copy from the decompressor without the throttle if there's a thread
+def start_decompressor(p1, throttle):
+    if not throttle:
+        p2 = stream_popen(codec.decompress_command(), stdin=p1.stdout, stdout=subprocess.PIPE, bufsize=1024*1024)
+        p1.stdout.close()
+        return p2, None
+    p2 = stream_popen(codec.decompress_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=1024*1024)
+    pump = threading.Thread(target=pump_stream, args=(p1.stdout, p2.stdin, throttle), daemon=True)
+    pump.start()
+    return p2, pump
+
+
+def pump_stream(src, dest, throttle):
+    try:
+        copy_stream(src, dest, throttle)
+    except OSError as e:
+        # the decompressor died; its return code tells why
+        log_debug("copy to the decompressor failed: %s" % e)
+    finally:
+        for f in [dest, src]:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+
+# O_DIRECT needs buffers, file positions and lengths aligned to the logical block size; 4k covers all
+# the filesystems and disks we use
+DIRECT_IO_ALIGNMENT = 4096
+
+# like copy_stream, but into the file f at offset, with O_DIRECT, so the data doesn't go through the page cache
+#
+# The buffer is an anonymous mmap, which is page aligned. The parts that can't be aligned (up to the first
+# aligned position when resuming, and the end of the stream) are written without O_DIRECT. If the
+# filesystem doesn't support O_DIRECT at all, everything is written normally.
+# A FileDigest among the observers is fed from the buffer, so nothing has to be read back from disk.
+def copy_stream_direct(src, f, offset, throttle=None, observers=()):
+    fd = f.fileno()
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    digests = [observer for observer in observers if isinstance(observer, FileDigest)]
+    buf = mmap.mmap(-1, COPY_CHUNK_SIZE)
+    view = memoryview(buf)
+    direct = [hasattr(os, "O_DIRECT")]
+
+    def write(data, pos, aligned):
+        use_direct = aligned and direct[0]
+        try:
+            # some filesystems already refuse O_DIRECT here, others only on write
+            fcntl.fcntl(fd, fcntl.F_SETFL, (flags | os.O_DIRECT) if use_direct else flags)
+            while len(data):
+                n = os.pwrite(fd, data, pos)
+                data = data[n:]
+                pos += n
+        except OSError as e:
+            if not use_direct or e.errno != errno.EINVAL:
+                raise
+            log_info("O_DIRECT is not supported here, writing normally: %s" % e)
+            direct[0] = False
+            write(data, pos, False)
+        finally:
+            # the observers (Checkpoint, FileDigest) pread the fd at any offset, which O_DIRECT refuses
+            if use_direct:
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+    pos = offset
+    fill = 0
+    total = 0
+    eof = False
+    try:
+        while not eof:
+            r = src.readinto(view[fill:])
+            if not r:
+                eof = True
+            else:
+                for digest in digests:
+                    digest.feed(view[fill:fill+r])
+                fill += r
+                total += r
+                if throttle:
+                    throttle.consume(r)
+                if fill < COPY_CHUNK_SIZE:
+                    continue
+
+            # get to an aligned file position first; the data is moved back to the start of the buffer,
+            # because the memory has to be aligned too
+            head = min((-pos) % DIRECT_IO_ALIGNMENT, fill)
+            if head:
+                write(view[0:head], pos, False)
+                view[0:fill - head] = view[head:fill]
+                pos += head
+                fill -= head
+
+            # write what can be written aligned, and keep the rest for the next round
+            aligned_end = fill // DIRECT_IO_ALIGNMENT * DIRECT_IO_ALIGNMENT
+            if aligned_end:
+                write(view[0:aligned_end], pos, True)
+            if eof and aligned_end < fill:
+                write(view[aligned_end:fill], pos + aligned_end, False)
+                aligned_end = fill
+            view[0:fill - aligned_end] = view[aligned_end:fill]
+            pos += aligned_end
+            fill -= aligned_end
+            for observer in observers:
+                observer.update(pos - offset)
+    finally:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+        view.release()
+        buf.close()
+    return total
+
+
+FALLOC_FL_KEEP_SIZE = 1
+
+# reserves length bytes of space at offset in the file f, so a long streamed write isn't fragmented
+#
+# This calls fallocate(2) with FALLOC_FL_KEEP_SIZE, so the file size still says how much was written, which
+# the checkpoint and resume logic rely on. (os.posix_fallocate would change the size, and where the
+# filesystem can't preallocate, eg. ZFS, glibc emulates it by writing zeros, which is much worse than nothing.)
+def preallocate(f, offset, length):
+    if length <= 0:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        if libc.fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+            e = ctypes.get_errno()
+            log_debug("could not preallocate %s: %s" % (format_bytes(length), os.strerror(e)))
+            return False
+    except (OSError, AttributeError) as e:
+        # not linux
+        log_debug("could not preallocate: %s" % e)
+        return False
+    log_debug("preallocated %s" % format_bytes(length))
+    return True
+
+
+DROP_CACHE_INTERVAL = 64*1024*1024
+
+# Drops what was written from the page cache as the file grows, so a big streamed backup doesn't evict
+# everything else on the backup host.
+#
+# Dirty pages can't be dropped, so every DROP_CACHE_INTERVAL it syncs the data first. It has to come after
+# a FileDigest in the observers, which reads the data back from the cache.
+class CacheDropper:
+    def __init__(self, f, offset=0):
+        self.fd = f.fileno()
+        self.offset = offset
+        self.dropped = 0
+
+    # called by copy_stream with the number of bytes copied so far in this attempt
+    def update(self, total):
+        if self.offset + total - self.dropped >= DROP_CACHE_INTERVAL:
+            self.drop(self.offset + total)
+
+    def drop(self, end):
+        if not hasattr(os, "posix_fadvise"):
+            return
+        os.fdatasync(self.fd)
+        os.posix_fadvise(self.fd, self.dropped, end - self.dropped, os.POSIX_FADV_DONTNEED)
+        self.dropped = end
+
+
+# details of the last stream in this thread, for the journal: wire_bytes is how much came over the link
+# (compressed), and data_bytes how much diff that was; either is None if not known
+stream_stats = threading.local()
+
+def set_stream_stats(wire_bytes, data_bytes):
+    stream_stats.wire_bytes = wire_bytes
+    stream_stats.data_bytes = data_bytes
+
+# returns the number of bytes the local decompressor process p read, ie. the compressed size of the stream,
+# or None if that can't be found out. Call it before p.wait(); it works on linux, even after p exited.
+def get_read_bytes(p):
+    try:
+        with open("/proc/%s/io" % p.pid, "r") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+# returns the name of the newest complete snapshot file in a directory target, or None
+# host is where the directory is, None for here (see set_direction)
+def get_latest_dir_snap(dest_image_dir_path, host=None):
+    key = dir_catalog_key(dest_image_dir_path, host)
+    latest = catalog_call("latest", *key)
+    # the file is checked, which is cheaper than listing; remotely with one command
+    if latest and host and remote_snap_file_exists(dest_image_dir_path, host, latest):
+        return latest
+    if latest and not host and ceph_repl_compression.find_snap_file(dest_image_dir_path, latest):
+        return latest
 
-    log_debug("repl_to_directory, snap_path = \"%s\" dest_image_dir_path = \"%s\"" 
-        % (snap_path, dest_image_dir_path))
-    
     try:
+        if host:
+            names = list_remote_dir(dest_image_dir_path, host)
+        else:
+            names = [os.path.basename(path) for path in glob.iglob(dest_image_dir_path+"/replication*")]
         newest = None
-        for snap in sorted(glob.iglob(dest_image_dir_path+"/replication*"), key=os.path.basename):
-            if not snap.endswith(".tmp"):
+        snaps = []
+        for snap in sorted(names):
+            if snap.startswith("replication") and not snap.endswith(".tmp"):
                 newest = snap
+                snaps += [{"snap": ceph_repl_compression.strip_suffix(snap), "file": snap}]
+        catalog_call("replace_image", key[0], key[1], key[2], snaps)
         if newest:
-            prev_snap_name = newest.split("/")[-1]
+            return ceph_repl_compression.strip_suffix(newest)
     except:
         pass
-    
-    log_info("Starting replication for snap src \"%s\" prev snap \"%s\" dest \"%s\"" 
-        % (snap_path, prev_snap_name, dest_image_dir_path))
+    return None
+
+
+# returns whether the directory path on host has a stored diff file for snap_name, compressed or not
+def remote_snap_file_exists(path, host, snap_name):
+    tests = ["test -e %s" % shlex.quote(os.path.join(path, name)) for name in ceph_repl_compression.snap_file_names(snap_name)]
+    returncode, out, err = run_command(script_command(host, " || ".join(tests)))
+    return returncode == 0
+
+
+# returns the names in a directory on host; an empty list if it doesn't exist
+def list_remote_dir(path, host):
+    returncode, out, err = run_command(script_command(host, "[ ! -e %s ] || ls -1 -- %s" % (shlex.quote(path), shlex.quote(path))))
+    if returncode != 0:
+        raise Exception("Failed to list \"%s\" on %s:\n%s" % (path, host, err))
+    return out.splitlines()
+
+
+# returns the name of the last snapshot that was replicated for image, or None if there is none yet
+# (or, with cfg.destinations, if they don't all have the same one)
+def get_last_replicated_snap(image):
+    global cfg
+
+    if cfg.destinations:
+        prev_snaps = set([sink.get_prev_snap(image) for sink in make_sinks()])
+        if len(prev_snaps) == 1:
+            return prev_snaps.pop()
+        return None
+
+    if cfg.dest_directory:
+        return get_latest_dir_snap(os.path.join(cfg.dest_directory, cfg.src_pool, image), cfg.dest_host)
+
+    dest_image_path = "%s/%s" % (cfg.dest_pool, image)
+    try:
+        return get_latest_snap(dest_image_path, cfg.dest_host)
+    except:
+        return None
+
+
+# returns True if the image changed less than args.skip_threshold bytes since the last replicated snap,
+# so we don't make (and later trim) a snapshot just to send an empty diff
+def is_unchanged(image):
+    global cfg, args, skip_stats
+
+    prev_snap_name = get_last_replicated_snap(image)
+    if not prev_snap_name:
+        return False
+
+    src_image_path = "%s/%s" % (cfg.src_pool, image)
+    try:
+        changed = get_diff_size(src_image_path, prev_snap_name, cfg.src_host)
+    except Exception as e:
+        log_debug("could not estimate diff size, replicating anyway: %s" % e)
+        return False
+
+    log_debug("%s changed %s since %s" % (src_image_path, format_bytes(changed), prev_snap_name))
+    if changed >= args.skip_threshold:
+        return False
+
+    log_info("skipping \"%s\", only %s changed since \"%s\"" % (src_image_path, format_bytes(changed), prev_snap_name))
+    skip_stats["count"] += 1
+    skip_stats["bytes"] += changed
+    return True
+
 
-    ##############################   
-    #OLD BAD CODE
-#    pargs = ["rbd", "export-diff"]
-#    if prev_snap_name:
-#        pargs += ["--from-snap", prev_snap_name]
-#    pargs += [snap_path, "-"]
+CHECKPOINT_INTERVAL = 256*1024*1024
+
+# Keeps track of how much of a directory-mode transfer is safely on disk, so an interrupted transfer
+# can be resumed instead of starting over.
 #
-#    if args.compression == True:
-#        pargs += ["|", "lz4"]  # FIXME: this pipe here means that the first popen returns 0 always
-# 
-#    pargs = set_direction(cfg.src_host, pargs)
-#    
-#    p1 = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1024*1024)
-#    p=p1
+# The checkpoint file holds the from/to snaps and the end of the last complete diff record that was fsynced.
+# export-diff between the same two snapshots always produces the same stream, so on resume the file is
+# truncated there and the first offset bytes of the new stream are skipped.
+class Checkpoint:
+    def __init__(self, path, f, from_snap, to_snap, offset=0):
+        self.path = path
+        self.f = f
+        self.from_snap = from_snap
+        self.to_snap = to_snap
+        self.offset = offset
+        self.scanner = ceph_rbd_diff.RecordScanner(f.fileno(), offset)
+        self.last_saved = offset
+
+    # called by copy_stream with the number of bytes copied so far in this attempt
+    def update(self, total):
+        if self.offset + total - self.last_saved >= CHECKPOINT_INTERVAL:
+            self.save(self.offset + total)
+
+    # end is the number of bytes in the file, by default all of it
+    def save(self, end=None):
+        self.f.flush()
+        if end is None:
+            end = os.fstat(self.f.fileno()).st_size
+        self.scanner.scan(end)
+        os.fsync(self.f.fileno())
+
+        tmp_path = self.path + ".new"
+        with open(tmp_path, "w") as f:
+            json.dump({"from_snap": self.from_snap, "to_snap": self.to_snap, "offset": self.scanner.complete}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.last_saved = end
+        log_debug("checkpoint %s at %s" % (self.path, self.scanner.complete))
+
+
+# Computes the digests of a diff file while it is being written (see ceph_rbd_diff.DiffDigester), so
+# they can be checked later with one sequential read (ceph_snap_check.py --verify-digests).
 #
-#    p2=None
-#    if args.compression:
-#        pargs = ["lz4", "-d", "-c"]# FIXME: this here means that popen returns 0 always... lz4 doesn't care that the file is 0 bytes and the prev command fails
-#        p2 = subprocess.Popen(, stdin=p1.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1024*1024)
-#        p=p2
-    ##############################   
-    # test new code
-    # note: unsupported and untested with push mode
-    # This is done as a string (shell script) instead of a chain of Popens because there is no way to check the returncode of any process except the last... and we don't want to corrupt our files if the export fails
-    remote_command = "ssh %s 'rbd export-diff" % cfg.src_host
-    if prev_snap_name:
-        remote_command += " --from-snap " + prev_snap_name
-    remote_command += " " + snap_path + " -"
-    if args.compression == True:
-        remote_command += " | lz4; exit ${PIPESTATUS[0]}"
-    remote_command += "'"
-    if args.compression == True:
-        remote_command += " | lz4 -d -c; exit ${PIPESTATUS[0]}"
-
-    log_debug("remote_command = %s" % remote_command)
-    pargs = [remote_command]
-    p1 = subprocess.Popen(pargs, shell=True, executable='/bin/bash', stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1024*1024)
-    p2 = None
-    p=p1
-    ##############################   
+# The new data is read back with pread right after it is written, while it's still in the page cache;
+# that way the splice path in copy_stream still works. When resuming, what is already in the file is
+# read once first.
+class FileDigest:
+    def __init__(self, f, offset=0):
+        self.fd = f.fileno()
+        self.offset = offset
+        self.pos = 0
+        self.digester = ceph_rbd_diff.DiffDigester()
+        # set if the data isn't a valid diff; the record scanner in the Checkpoint reports that
+        self.error = None
+        self.read_to(offset)
 
-    total=0
+    # called by copy_stream with the number of bytes copied so far in this attempt
+    def update(self, total):
+        self.read_to(self.offset + total)
+
+    # for data that doesn't have to be read back (see copy_stream_direct)
+    def feed(self, buf):
+        if not self.error:
+            try:
+                self.digester.feed(buf)
+            except Exception as e:
+                self.error = str(e)
+        self.pos += len(buf)
+
+    def read_to(self, end):
+        while not self.error and self.pos < end:
+            buf = os.pread(self.fd, min(COPY_CHUNK_SIZE, end - self.pos), self.pos)
+            if not buf:
+                self.error = "file is shorter than expected reading it back"
+                break
+            try:
+                self.digester.feed(buf)
+            except Exception as e:
+                self.error = str(e)
+            self.pos += len(buf)
+
+    # returns the digests, or None if there was an error
+    def result(self):
+        if not self.error:
+            try:
+                return self.digester.result()
+            except Exception as e:
+                self.error = str(e)
+        log_error("no digest for this diff: %s" % self.error)
+        return None
+
+
+# returns the checkpoint dict saved in path, or None
+def read_checkpoint(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except:
+        return None
+
+
+# returns the snap name of an interrupted transfer for image that can be resumed, or None
+def get_resume_snap(image):
+    global cfg, args
+
+    # in push mode the directory is on the other side; those transfers aren't resumable
+    if not cfg.dest_directory or cfg.direction == "push" or (codec and args.compress_at_rest):
+        return None
+
+    dest_image_dir_path = os.path.join(cfg.dest_directory, cfg.src_pool, image)
+    for path in sorted(glob.iglob(dest_image_dir_path + "/.replication*.tmp.checkpoint")):
+        checkpoint = read_checkpoint(path)
+        if checkpoint:
+            return checkpoint["to_snap"]
+    return None
+
+
+def remove_if_exists(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# returns how many bytes the diff from prev_snap_name to snap_path is expected to have from offset on,
+# from rbd diff --whole-object (quick with fast-diff); 0 if that fails
+def get_expected_size(snap_path, prev_snap_name, offset):
+    global cfg
+
+    try:
+        size = get_diff_size(snap_path, prev_snap_name, cfg.src_host)
+    except Exception as e:
+        log_debug("could not estimate the diff size: %s" % e)
+        return 0
+    # whole objects overestimate the data anyway, so the record headers are covered
+    return max(size - offset, 0)
+
+
+# packs the finished plain diff file tmp_path into a container at outfile, and removes tmp_path
+#
+# The plain file is written first so the transfer stays resumable and the digest can be computed
+# the same way; packing it right after reads it back while it's mostly still in the page cache.
+def pack_container(tmp_path, outfile):
+    packed_tmp = tmp_path + ceph_repl_compression.container_suffix
+    try:
+        with open(tmp_path, "rb") as fin, open(packed_tmp, "wb") as fout:
+            ceph_rbd_diff_container.pack(fin, fout)
+        os.rename(packed_tmp, outfile)
+    finally:
+        remove_if_exists(packed_tmp)
+        remove_if_exists(tmp_path)
+
+
+def repl_to_directory(snap_path, dest_image_dir_path, job=None):
+    global cfg, args
+    
+    newest = None
+    prev_snap_name = None
+
+    log_debug("repl_to_directory, snap_path = \"%s\" dest_image_dir_path = \"%s\"" 
+        % (snap_path, dest_image_dir_path))
+    
+    prev_snap_name = get_latest_dir_snap(dest_image_dir_path)
+    
+    log_info("Starting replication for snap src \"%s\" prev snap \"%s\" dest \"%s\"" 
+        % (snap_path, prev_snap_name, dest_image_dir_path))
 
     snap_name = snap_path[ snap_path.index("@")+1: ]
     
     outfile = "%s/%s" % (dest_image_dir_path, snap_name)
+    if codec and args.compress_at_rest:
+        outfile += codec.suffix
+    elif args.container:
+        outfile += ceph_repl_compression.container_suffix
     #prefix dot prevents above glob from matching
     outfiletmp = "%s/.%s.tmp" % (dest_image_dir_path, snap_name)
+
+    # compressed files can't be checked for record boundaries, so those aren't resumable
+    resumable = not (codec and args.compress_at_rest)
+    checkpoint_path = outfiletmp + ".checkpoint"
+    offset = 0
+    if resumable:
+        saved = read_checkpoint(checkpoint_path)
+        if saved and saved["from_snap"] == prev_snap_name and saved["to_snap"] == snap_name \
+                and os.path.exists(outfiletmp) and os.path.getsize(outfiletmp) >= saved["offset"]:
+            offset = saved["offset"]
+            log_info("resuming at %s" % format_bytes(offset))
+        else:
+            remove_if_exists(checkpoint_path)
+
+    # (this is the pull mode version; see repl_to_remote_directory for push mode)
+    # The remote side is a pipefail pipeline (see pipeline_command) and the decompressor is a separate process,
+    # so we can check every return code... we don't want to corrupt our files if the export fails
+    pargs = ["rbd", "export-diff"]
+    if prev_snap_name:
+        pargs += ["--from-snap", prev_snap_name]
+    pargs += [snap_path, "-"]
+    commands = [pargs]
+    if offset:
+        # skip what we already have on the source side, so it doesn't cross the link again
+        # (ceph still reads it; export-diff can't start at an offset)
+        commands += [["tail", "-c", "+%s" % (offset+1)]]
+    if codec:
+        commands += [codec.compress_command()]
+    pargs = pipeline_command(cfg.src_host, commands)
+
+    p1 = stream_popen(pargs, stdout=subprocess.PIPE, bufsize=1024*1024)
+    p2 = None
+    pump = None
+    p=p1
+    if codec and not args.compress_at_rest:
+        p2, pump = start_decompressor(p1, throttle)
+        p=p2
+    # the throttle counts what crosses the link
+    stream_throttle = None if pump else throttle
+
+    total=0
+    checkpoint = None
+    digest = None
+    digests = None
+    # False when what we got can't be the diff we asked for, so resuming from it makes no sense
+    stream_ok = True
+    # False when the diff has no end record
+    stream_complete = True
     
-    with open(outfiletmp, "wb") as f:
-        buf = bytearray(1024*1024)
-        while True:
-            r = p.stdout.readinto(buf)
-            if not r:
-                break
-            
-            f.write(buf[0:r])
-            
-            total += r
-        f.flush()
+    if offset:
+        f = open(outfiletmp, "r+b")
+        f.truncate(offset)
+        f.seek(offset)
+    else:
+        # readable too, for the record scanner
+        f = open(outfiletmp, "w+b")
+    with f:
+        preallocated = args.preallocate and preallocate(f, offset, get_expected_size(snap_path, prev_snap_name, offset))
+        observers = []
+        if resumable:
+            checkpoint = Checkpoint(checkpoint_path, f, prev_snap_name, snap_name, offset)
+            observers += [checkpoint]
+            # a compressed file would need decompressing to digest, so only plain files get one
+            if args.digests:
+                digest = FileDigest(f, offset)
+                observers += [digest]
+        if args.drop_cache and not args.direct_io:
+            observers += [CacheDropper(f, offset)]
+        try:
+            if args.direct_io:
+                total = copy_stream_direct(p.stdout, f, offset, stream_throttle, observers)
+            else:
+                total = copy_stream(p.stdout, f, stream_throttle, observers)
+            f.flush()
+            if checkpoint:
+                # make sure the file ends with exactly one complete "e" record; this also catches a resume
+                # that doesn't fit what was already there
+                checkpoint.scanner.scan(offset + total)
+                if not checkpoint.scanner.ended:
+                    log_error("diff stream ended early after %s records" % checkpoint.scanner.records)
+                    stream_complete = False
+                elif checkpoint.scanner.complete != offset + total:
+                    log_error("diff stream has trailing data after %s records" % checkpoint.scanner.records)
+                    stream_ok = False
+            if digest and stream_ok and stream_complete:
+                digest.update(total)
+                digests = digest.result()
+        except:
+            try:
+                if checkpoint:
+                    try:
+                        checkpoint.save()
+                    except Exception as e:
+                        # not a valid diff; the last saved checkpoint (if any) is still good
+                        log_error("could not save checkpoint: %s" % e)
+            finally:
+                stop_streams([p1, p2], pump)
+            raise
+
+        if p2:
+            set_stream_stats(get_read_bytes(p2), total)
+        elif codec:
+            set_stream_stats(total, None)
+        else:
+            set_stream_stats(total, total)
+        p.wait()
+        if p2:
+            p1.wait()
+        if pump:
+            pump.join()
+        success = stream_ok and stream_complete and p1.returncode == 0 and (not p2 or p2.returncode == 0)
+        # keep the partial file for the next run, unless nothing new arrived (eg. the snap is gone)
+        # or what arrived doesn't fit; then start over next time
+        keep_partial = not success and stream_ok and checkpoint and total > 0
+        if keep_partial:
+            checkpoint.save()
+            log_info("saved checkpoint at %s for resuming" % format_bytes(checkpoint.scanner.complete))
+        if success and preallocated:
+            # give back what the estimate reserved beyond the end
+            f.truncate(offset + total)
+        if success and args.drop_cache and not args.direct_io:
+            CacheDropper(f).drop(offset + total)
 
     log_info("read %s" % format_bytes(total))
-    p.wait()
-    if( p.returncode == 0 ):
-        os.rename(outfiletmp, outfile)
+    if success:
+        if digest and digests:
+            ceph_rbd_diff.write_digest(outfile, digests)
+        else:
+            # there might be one left from an earlier file with the same name
+            ceph_rbd_diff.remove_digest(outfile)
+        if args.container:
+            pack_container(outfiletmp, outfile)
+        else:
+            os.rename(outfiletmp, outfile)
+        mark_committed(job)
+        remove_if_exists(checkpoint_path)
+        record_dir_snap(dest_image_dir_path, None, snap_name, prev_snap_name, outfile, digests if digest else None)
 
         # clean up remote snap for better cluster performance... only keep one snap
         if prev_snap_name:
-            log_info("removing snap \"%s\"" % (prev_snap_name))
             prev_snap_path = snap_path.split("@")[0] + "@" + prev_snap_name
-            snap_rm(prev_snap_path, cfg.src_host)
+            remove_old_snap(prev_snap_path)
     else:
-        os.remove(outfiletmp)
+        if not keep_partial:
+            os.remove(outfiletmp)
+            remove_if_exists(checkpoint_path)
         if p2:
-            error_message = "rbd returned %s\n%s\nlz4 returned %s\n%s" % (p1.returncode, read_file(p1.stderr), p2.returncode, read_file(p2.stderr))
+            error_message = "rbd returned %s\n%s\n%s returned %s\n%s" % (p1.returncode, read_file(p1.stderr), codec.name, p2.returncode, read_file(p2.stderr))
         else:
             error_message = "rbd returned %s\n%s" % (p1.returncode, read_file(p1.stderr) )
 
@@ -346,25 +1165,377 @@ def repl_to_directory(snap_path, dest_image_dir_path):
     return total
         
     
-def do_import(args):
-    config_file = args.config_file
-    
-    if config_file.endswith(".py"):
-        config_file = config_file[:len(config_file)-3]
-    if "/" in config_file:
-        config_file = config_file.split("/")[-1]
-    global cfg
-    cfg = __import__(config_file, globals(), locals())
-    
-    try:
-        cfg.dest_cluster
-    except:
-        cfg.dest_cluster = None
-        
-    try:
-        cfg.dest_directory
-    except:
-        cfg.dest_directory = None
+# Push mode version of repl_to_directory(): the directory is on cfg.dest_host, and the diff is made here.
+#
+# The stream goes through us (to be counted and throttled, like repl()) into one ssh session that
+# decompresses it if needed and writes the temp file. Only if the export and that session both succeeded
+# is the temp file renamed into place, so a failed export can't leave a truncated diff that looks complete.
+# Resume, digests, containers and the write options are for local files only, so they don't apply here.
+def repl_to_remote_directory(snap_path, dest_image_dir_path, job=None):
+    global cfg, args
+
+    host = cfg.dest_host
+    prev_snap_name = get_latest_dir_snap(dest_image_dir_path, host)
+    log_info("Starting replication for snap src \"%s\" prev snap \"%s\" dest \"%s:%s\""
+        % (snap_path, prev_snap_name, host, dest_image_dir_path))
+
+    snap_name = snap_path[ snap_path.index("@")+1: ]
+    outfile = "%s/%s" % (dest_image_dir_path, snap_name)
+    if codec and args.compress_at_rest:
+        outfile += codec.suffix
+    #prefix dot prevents the replication* glob from matching
+    outfiletmp = "%s/.%s.tmp" % (dest_image_dir_path, snap_name)
+
+    pargs = ["rbd", "export-diff"]
+    if prev_snap_name:
+        pargs += ["--from-snap", prev_snap_name]
+    pargs += [snap_path, "-"]
+    commands = [pargs]
+    if codec:
+        commands += [codec.compress_command()]
+    p = stream_popen(pipeline_command(cfg.src_host, commands), stdout=subprocess.PIPE)
+
+    write_commands = [["cat"]]
+    if codec and not args.compress_at_rest:
+        write_commands = [codec.decompress_command()]
+    script = "set -o pipefail; mkdir -p %s && %s > %s" % (shlex.quote(dest_image_dir_path),
+        pipeline_script(write_commands), shlex.quote(outfiletmp))
+    p2 = stream_popen(script_command(host, script), stdin=subprocess.PIPE, stdout=subprocess_devnull)
+
+    total = 0
+    try:
+        total = copy_stream(p.stdout, p2.stdin, throttle)
+        log_info("read %s" % format_bytes(total))
+        set_stream_stats(total, None if codec else total)
+    except OSError as e:
+        # the writer died; the return codes below tell why
+        log_debug("copy to %s failed: %s" % (host, e))
+    try:
+        p2.stdin.close()
+    except OSError:
+        pass
+    # so export-diff gets SIGPIPE if the writer died
+    p.stdout.close()
+    p2.wait()
+    p.wait()
+
+    success = p.returncode == 0 and p2.returncode == 0
+    if success:
+        finish = ["mv", "--", outfiletmp, outfile]
+    else:
+        finish = ["rm", "-f", "--", outfiletmp]
+    finish_returncode, out, finish_err = run_command(set_direction(host, finish))
+    if success and finish_returncode == 0:
+        mark_committed(job)
+        log_info("replication successful \"%s\" -> \"%s:%s\"" % (snap_path, host, outfile))
+        record_dir_snap(dest_image_dir_path, host, snap_name, prev_snap_name, file=os.path.basename(outfile))
+        # clean up remote snap for better cluster performance... only keep one snap
+        if prev_snap_name:
+            remove_old_snap(snap_path.split("@")[0] + "@" + prev_snap_name)
+        return total
+
+    raise Exception("failed to export-diff the stream or save the file, src \"%s\" prev snap \"%s\" dest \"%s:%s\":\nexport returned %s\n%s\nwriting returned %s\n%s\n%s returned %s\n%s" %
+                    (snap_path, prev_snap_name, host, outfiletmp, p.returncode, read_file(p.stderr),
+                     p2.returncode, read_file(p2.stderr), finish[0], finish_returncode, finish_err))
+
+
+# A destination for the fan-out mode (cfg.destinations); see repl_fan_out().
+#
+# open() returns a file (or anything with write()) to write the diff stream to, and close() returns None on success or an error message.
+class PoolSink:
+    def __init__(self, dest_pool):
+        self.dest_pool = dest_pool
+        self.p = None
+
+    def __str__(self):
+        return "pool %s" % self.dest_pool
+
+    def get_prev_snap(self, image):
+        try:
+            return get_latest_snap("%s/%s" % (self.dest_pool, image), cfg.dest_host)
+        except:
+            return None
+
+    def open(self, image, snap_name, prev_snap_name, src_size):
+        self.image = image
+        self.snap_name = snap_name
+        self.prev_snap_name = prev_snap_name
+        dest_image_path = "%s/%s" % (self.dest_pool, image)
+        if not prev_snap_name:
+            try:
+                dest_size = get_size(dest_image_path, cfg.dest_host)
+            except:
+                dest_size = None
+            if not dest_size:
+                rbd_create(dest_image_path, src_size, host=cfg.dest_host)
+
+        self.p = stream_popen(pipeline_command(cfg.dest_host, [["rbd", "import-diff", "-", dest_image_path]]),
+            stdin=subprocess.PIPE, stdout=subprocess_devnull)
+        return self.p.stdin
+
+    def close(self, stream_ok):
+        try:
+            self.p.stdin.close()
+        except OSError:
+            pass
+        self.p.wait()
+        if self.p.returncode != 0:
+            return "import-diff returned %s\n%s" % (self.p.returncode, read_file(self.p.stderr))
+        if not stream_ok:
+            # import-diff only makes the end snap if it got the whole stream, so this shouldn't happen
+            return "the export failed"
+        catalog_call("add", dest_location(), self.dest_pool, self.image, self.snap_name, None, None, self.prev_snap_name)
+        return None
+
+    def forget(self, image):
+        catalog_call("forget_image", dest_location(), self.dest_pool, image)
+
+
+class DirectorySink:
+    def __init__(self, dest_directory):
+        self.dest_directory = dest_directory
+        self.f = None
+        self.digester = None
+
+    def __str__(self):
+        return "directory %s" % self.dest_directory
+
+    def get_prev_snap(self, image):
+        return get_latest_dir_snap(os.path.join(self.dest_directory, cfg.src_pool, image))
+
+    def open(self, image, snap_name, prev_snap_name, src_size):
+        if cfg.direction == "push":
+            raise Exception("directory destinations only work in pull mode with fan-out")
+        dest_image_dir_path = os.path.join(self.dest_directory, cfg.src_pool, image)
+        if not os.path.exists(dest_image_dir_path):
+            os.makedirs(dest_image_dir_path)
+        self.dest_image_dir_path = dest_image_dir_path
+        self.snap_name = snap_name
+        self.prev_snap_name = prev_snap_name
+        self.outfile = "%s/%s" % (dest_image_dir_path, snap_name)
+        if args.container:
+            self.outfile += ceph_repl_compression.container_suffix
+        #prefix dot prevents the replication* glob from matching
+        self.outfiletmp = "%s/.%s.tmp" % (dest_image_dir_path, snap_name)
+        self.f = open(self.outfiletmp, "wb")
+        if args.digests:
+            # the data passes through python here anyway, so it's digested on the way (see FileDigest)
+            self.digester = ceph_rbd_diff.DiffDigester()
+        return self
+
+    def write(self, buf):
+        self.f.write(buf)
+        if self.digester:
+            try:
+                self.digester.feed(buf)
+            except Exception as e:
+                log_error("no digest for %s: %s" % (self.outfile, e))
+                self.digester = None
+
+    def close(self, stream_ok):
+        error = "the export failed"
+        try:
+            self.f.close()
+        except (IOError, OSError) as e:
+            stream_ok = False
+            error = str(e)
+        digests = None
+        if stream_ok and self.digester:
+            try:
+                digests = self.digester.result()
+            except Exception as e:
+                log_error("no digest for %s: %s" % (self.outfile, e))
+        if stream_ok:
+            if digests:
+                ceph_rbd_diff.write_digest(self.outfile, digests)
+            else:
+                ceph_rbd_diff.remove_digest(self.outfile)
+            if args.container:
+                pack_container(self.outfiletmp, self.outfile)
+            else:
+                os.rename(self.outfiletmp, self.outfile)
+            record_dir_snap(self.dest_image_dir_path, None, self.snap_name, self.prev_snap_name, self.outfile, digests)
+            return None
+        remove_if_exists(self.outfiletmp)
+        return error
+
+    def forget(self, image):
+        catalog_call("forget_image", *dir_catalog_key(os.path.join(self.dest_directory, cfg.src_pool, image)))
+
+
+def make_sinks():
+    sinks = []
+    for dest in cfg.destinations:
+        if "dest_directory" in dest:
+            sinks += [DirectorySink(dest["dest_directory"])]
+        elif "dest_pool" in dest:
+            sinks += [PoolSink(dest["dest_pool"])]
+        else:
+            raise Exception("destination %s needs dest_pool or dest_directory" % dest)
+    return sinks
+
+
+# copies the pipe src to every sink's file; a sink that fails to write is dropped, and the rest go on
+# returns the number of bytes read; stops reading when every sink has failed, so the caller should then stop
+# what writes to src (see stop_streams)
+def tee_stream(src, sinks, files, errors, throttle=None):
+    total = 0
+    active = list(range(len(sinks)))
+    buf = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(buf)
+    while active:
+        r = src.readinto(buf)
+        if not r:
+            break
+        for i in list(active):
+            try:
+                files[i].write(view[0:r])
+            except (IOError, OSError) as e:
+                log_error("writing to %s failed, going on without it: %s" % (sinks[i], e))
+                errors[i] = str(e)
+                active.remove(i)
+        total += r
+        if throttle:
+            throttle.consume(r)
+    return total
+
+
+# Replicates to all of cfg.destinations with one snapshot and, when they are all at the same previous snap
+# (the normal case), one export-diff read of the source, teed to every destination.
+#
+# Destinations that are at different previous snaps (eg. one failed last time) get one stream per distinct
+# previous snap. Each destination fails on its own. An old snap is only removed from the source when no
+# destination needs it anymore, and the new one is removed if no destination got it.
+def repl_fan_out(src_snap_path, image, src_size, job=None):
+    global cfg
+
+    snap_name = src_snap_path[ src_snap_path.index("@")+1: ]
+    src_image_path = src_snap_path.split("@")[0]
+    sinks = make_sinks()
+
+    prev_snaps = [sink.get_prev_snap(image) for sink in sinks]
+    groups = collections.OrderedDict()
+    for i, prev_snap_name in enumerate(prev_snaps):
+        groups.setdefault(prev_snap_name, []).append(i)
+
+    errors = [None] * len(sinks)
+    total = 0
+    wire_bytes = 0
+    for prev_snap_name, group in groups.items():
+        group_sinks = [sinks[i] for i in group]
+        log_info("Starting replication for snap src \"%s\" prev snap \"%s\" dest %s"
+            % (src_snap_path, prev_snap_name, ", ".join([str(sink) for sink in group_sinks])))
+
+        files = []
+        opened = []
+        for i in group:
+            try:
+                files += [sinks[i].open(image, snap_name, prev_snap_name, src_size)]
+                opened += [i]
+            except Exception as e:
+                log_error("could not open %s: %s" % (sinks[i], e))
+                errors[i] = str(e)
+        if not opened:
+            continue
+
+        pargs = ["rbd", "export-diff"]
+        if prev_snap_name:
+            pargs += ["--from-snap", prev_snap_name]
+        pargs += [src_snap_path, "-"]
+        if codec:
+            pargs = pipeline_command(cfg.src_host, [pargs, codec.compress_command()])
+        else:
+            pargs = pipeline_command(cfg.src_host, [pargs])
+        p1 = stream_popen(pargs, stdout=subprocess.PIPE, bufsize=1024*1024)
+        p = p1
+        p2 = None
+        pump = None
+        if codec:
+            p2, pump = start_decompressor(p1, throttle)
+            p = p2
+
+        group_errors = [None] * len(opened)
+        # the throttle counts what crosses the link
+        group_total = tee_stream(p.stdout, [sinks[i] for i in opened], files, group_errors, None if pump else throttle)
+        total += group_total
+        if p2 and wire_bytes is not None:
+            read_bytes = get_read_bytes(p2)
+            wire_bytes = None if read_bytes is None else wire_bytes + read_bytes
+        elif wire_bytes is not None:
+            wire_bytes += group_total
+        if all(group_errors):
+            # nothing left to write to; the export would otherwise block on the full pipe
+            log_error("every destination of the stream from \"%s\" failed, stopping it" % src_snap_path)
+            stop_streams([p1, p2], pump)
+            stream_ok = False
+        else:
+            p.wait()
+            if p2:
+                p1.wait()
+            if pump:
+                pump.join()
+            stream_ok = p1.returncode == 0 and (not p2 or p2.returncode == 0)
+            if not stream_ok:
+                log_error("export-diff of \"%s\" returned %s\n%s" % (src_snap_path, p1.returncode, read_file(p1.stderr)))
+
+        for n, i in enumerate(opened):
+            error = sinks[i].close(stream_ok and not group_errors[n])
+            errors[i] = group_errors[n] or error
+            if errors[i]:
+                log_error("replication to %s failed:\n%s" % (sinks[i], errors[i]))
+            else:
+                mark_committed(job)
+                log_info("replication successful \"%s\" -> %s" % (src_snap_path, sinks[i]))
+
+    log_info("read %s" % format_bytes(total))
+    set_stream_stats(wire_bytes, total)
+
+    # each destination now needs either the new snap or, if it failed, the one it had
+    needed = set()
+    for i in range(len(sinks)):
+        if errors[i]:
+            needed.add(prev_snaps[i])
+        else:
+            needed.add(snap_name)
+    for old in set(prev_snaps) - needed:
+        if old:
+            remove_old_snap("%s@%s" % (src_image_path, old))
+    if snap_name not in needed:
+        log_info("no destination got \"%s\", removing it" % snap_name)
+        snap_rm(src_snap_path, cfg.src_host)
+
+    failed = [str(sinks[i]) for i in range(len(sinks)) if errors[i]]
+    if failed:
+        raise Exception("failed to replicate \"%s\" to %s" % (src_snap_path, ", ".join(failed)))
+    return total
+
+
+def do_import(args):
+    config_file = args.config_file
+    
+    if config_file.endswith(".py"):
+        config_file = config_file[:len(config_file)-3]
+    if "/" in config_file:
+        config_file = config_file.split("/")[-1]
+    global cfg
+    cfg = __import__(config_file, globals(), locals())
+    
+    try:
+        cfg.dest_cluster
+    except:
+        cfg.dest_cluster = None
+        
+    try:
+        cfg.dest_directory
+    except:
+        cfg.dest_directory = None
+
+    try:
+        cfg.destinations
+    except:
+        # eg. [{"dest_pool": "backup-ceph-rbd"}, {"dest_directory": "/data/ceph-repl"}]
+        # to read each diff once and send it to all of them (see repl_fan_out)
+        cfg.destinations = None
     
     try:
         cfg.image_excludes
@@ -374,6 +1545,12 @@ def do_import(args):
         else:
             cfg.image_excludes = args.image_excludes.split(",")
 
+    try:
+        cfg.image_intervals
+    except:
+        # eg. {"vm-1*-disk-*": "15m", "archive-*": "1d"}, for daemon mode; the first matching pattern wins
+        cfg.image_intervals = {}
+
     try:
         cfg.image_includes
     except:
@@ -389,13 +1566,366 @@ def do_import(args):
         cfg.dest_pool = "backup-%s-%s" % (cfg.src_cluster, cfg.src_pool)
 
 
+LINK_TEST_SIZE = 64*1000*1000
+
+# returns how many bytes/s we can read from remote_host over ssh
+def measure_link_speed(remote_host):
+    p = subprocess.Popen(ssh_command(remote_host) + ["head -c %s /dev/zero" % LINK_TEST_SIZE],
+        stdout=subprocess.PIPE, stderr=subprocess_devnull)
+
+    # start timing at the first byte, so ssh connection setup isn't counted as slow link
+    buf = bytearray(COPY_CHUNK_SIZE)
+    p.stdout.readinto(buf)
+    start = time.time()
+    total = 0
+    while True:
+        r = p.stdout.readinto(buf)
+        if not r:
+            break
+        total += r
+    elapsed = time.time() - start
+    p.wait()
+
+    if p.returncode != 0 or total == 0 or elapsed <= 0:
+        raise Exception("Failed to measure link speed to \"%s\"" % remote_host)
+    return total / elapsed
+
+
+# picks a compression level by benchmarking the codec on the host that compresses (the source),
+# and comparing that with the link speed
+def auto_compression_level(codec):
+    global cfg
+
+    remote_host = cfg.src_host or cfg.dest_host
+    link_speed = measure_link_speed(remote_host)
+
+    pargs = set_direction(cfg.src_host, codec.benchmark_command())
+    p = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.communicate()[0]
+    benchmarks = ceph_repl_compression.parse_benchmark(out.decode("utf-8", "replace"))
+    if p.returncode != 0 or len(benchmarks) == 0:
+        raise Exception("Failed to benchmark %s:\n%s" % (codec.name, out.decode("utf-8", "replace")))
+
+    for level, ratio, speed in benchmarks:
+        log_debug("%s level %s: ratio %s, %s/s" % (codec.name, level, ratio, format_bytes(speed)))
+    level = ceph_repl_compression.pick_level(benchmarks, link_speed)
+    log_info("link to %s does %s/s, picked %s level %s" % (remote_host, format_bytes(link_speed), codec.name, level))
+    return level
+
+
+def setup_codec():
+    global codec, args
+
+    codec = None
+    if args.container and args.compress_at_rest:
+        raise Exception("--container and --compress-at-rest can't be used together; containers are already compressed")
+    if not args.compression:
+        return
+    if not args.codec and not cfg.dest_directory and not cfg.destinations:
+        # pool to pool was never compressed, and needs the codec on both hosts; only if asked for
+        return
+
+    level = None
+    if args.compression_level and args.compression_level != "auto":
+        level = int(args.compression_level)
+    codec = ceph_repl_compression.get_codec(args.codec or "lz4", level, args.compression_threads)
+
+    if codec and args.compression_level == "auto":
+        try:
+            codec.level = auto_compression_level(codec)
+        except Exception as e:
+            log_error("could not pick a compression level, using the default: %s" % e)
+    log_info("compression: %s" % codec)
+
+
+def setup_throttle():
+    global throttle, args
+
+    throttle = None
+    pause_health = [s.strip() for s in args.pause_health.split(",") if s.strip()]
+    if args.bwlimit or pause_health:
+        throttle = Throttle(args.bwlimit or "", pause_health, args.health_interval)
+
+
+# parses durations like "90m", "24h" or "7d" into seconds
+def parse_duration(text):
+    units = {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60}
+    text = text.strip()
+    if text[-1:].lower() in units:
+        return int(float(text[0:-1]) * units[text[-1:].lower()])
+    return int(text)
+
+
+# parses "HH:MM" (the next time it is that time) or "YYYY-MM-DDTHH:MM" into a unix time
+def parse_deadline(text, now):
+    if "T" in text:
+        return time.mktime(datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M").timetuple())
+
+    hour, minute = text.split(":")
+    start = datetime.datetime.fromtimestamp(now)
+    deadline = start.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    if deadline <= start:
+        deadline += datetime.timedelta(days=1)
+    return time.mktime(deadline.timetuple())
+
+
+# Per image replication history, kept in args.history_file (if given) as json:
+#     { "<src_cluster>/<src_pool>/<image>": {
+#         "last_success": unix time of the snapshot that was last replicated,
+#         "last_attempt": unix time,
+#         "last_check": unix time it was last skipped for having no changes (see --skip-threshold),
+#         "bytes": bytes transferred by the last diff,
+#         "duration": seconds a replication takes (moving average),
+#         "churn": bytes/s the image changes (moving average of bytes / time between snaps),
+#         "failures": failed attempts since the last success } }
+def history_key(image):
+    global cfg
+    return "%s/%s/%s" % (cfg.src_cluster, cfg.src_pool, image)
+
+
+def load_history(path):
+    if not path:
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_history(path, history):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path + ".tmp", "w") as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def moving_average(old, new, weight=0.5):
+    if old is None:
+        return new
+    return old * (1 - weight) + new * weight
+
+
+# an image skipped because it didn't change wasn't replicated, so last_success stays (churn and the RPO are
+# about the last replicated snapshot); last_check is when it was found unchanged
+def record_skip(history, image, start):
+    with history_lock:
+        entry = history.setdefault(history_key(image), {})
+        entry["last_attempt"] = start
+        entry["last_check"] = start
+        entry["failures"] = 0
+
+
+def save_history_or_log(history):
+    if not args.history_file:
+        return
+    try:
+        with history_lock:
+            save_history(args.history_file, history)
+    except Exception as e:
+        log_error("could not save history to %s: %s" % (args.history_file, e))
+
+
+# start is when the snapshot was made; duration is how long the image itself took, which in pipelined mode
+# is less than end - start (its preparation overlapped the previous image's stream)
+def record_history(history, image, start, end, total, ok, duration=None):
+    if duration is None:
+        duration = end - start
+    with history_lock:
+        record_history_locked(history, image, start, total, ok, duration)
+
+
+# in pipelined mode, prepare_image() may record a skip while the main thread records or saves
+history_lock = threading.RLock()
+
+def record_history_locked(history, image, start, total, ok, duration):
+    entry = history.setdefault(history_key(image), {})
+    entry["last_attempt"] = start
+    if not ok:
+        entry["failures"] = entry.get("failures", 0) + 1
+        return
+
+    if entry.get("last_success"):
+        rate = total / max(start - entry["last_success"], 1)
+        entry["churn"] = moving_average(entry.get("churn"), rate)
+    entry["bytes"] = total
+    entry["duration"] = moving_average(entry.get("duration"), duration)
+    # the snapshot is made at the start, so that's the point we can now recover to
+    entry["last_success"] = start
+    entry["failures"] = 0
+
+
+# The snapshot catalog (see ceph_repl_catalog.py), or None if disabled. Like the journal, a catalog that can't
+# be used doesn't stop replication; that's logged, and where it has nothing the directories are listed as before.
+catalog = None
+
+def catalog_call(method, *pargs):
+    if not catalog:
+        return None
+    try:
+        return getattr(catalog, method)(*pargs)
+    except Exception as e:
+        log_error("could not use catalog %s: %s" % (args.catalog, e))
+        return None
+
+
+def src_location():
+    return ceph_repl_catalog.rbd_location(cfg.src_cluster)
+
+
+def dest_location():
+    return ceph_repl_catalog.rbd_location(cfg.dest_cluster)
+
+
+# returns the catalog key (location, pool, image) for the image directory dest_directory/pool/image;
+# host is where the directory is, None for here
+def dir_catalog_key(dest_image_dir_path, host=None):
+    return ceph_repl_catalog.dir_key(dest_image_dir_path, cfg.dest_cluster if host else None)
+
+
+# records a diff file that was stored; path is given if it's here, so its size is known, otherwise its file name
+def record_dir_snap(dest_image_dir_path, host, snap_name, prev_snap_name, path=None, digests=None, file=None):
+    size = None
+    if path:
+        size = os.path.getsize(path)
+        file = os.path.basename(path)
+    digest = None
+    if digests:
+        digest = digests["digest"]
+    location, pool, image = dir_catalog_key(dest_image_dir_path, host)
+    catalog_call("add", location, pool, image, snap_name, size, digest, prev_snap_name, file)
+
+
+# forgets what the catalog knows about image at the destinations, after replicating it failed, so the next
+# run lists them again instead of trusting something that may be wrong
+def forget_dest(image):
+    if cfg.destinations:
+        for sink in make_sinks():
+            sink.forget(image)
+    elif cfg.dest_directory:
+        catalog_call("forget_image", *dir_catalog_key(os.path.join(cfg.dest_directory, cfg.src_pool, image), cfg.dest_host))
+    else:
+        catalog_call("forget_image", dest_location(), cfg.dest_pool, image)
+
+
+# The journal gets one json line per image per run, appended, for ceph_repl_journal.py to summarize.
+# run is when the run (or daemon) started, so lines can be grouped by run.
+journal_run = None
+
+def write_journal(entry):
+    if not args.journal:
+        return
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    try:
+        dirname = os.path.dirname(args.journal)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # one write with O_APPEND, so lines never interleave
+        fd = os.open(args.journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        log_error("could not write journal %s: %s" % (args.journal, e))
+
+
+# returns a journal entry for image; job is from prepare_image() if it got that far
+def journal_entry(image, job, outcome, start, end, total=0, stream_time=None, error=None):
+    global cfg
+
+    entry = {"run": journal_run, "image": "%s/%s" % (cfg.src_pool, image), "outcome": outcome,
+        "start": start, "wall_time": end - start, "bytes": total}
+    if job:
+        entry["snap"] = job["src_snap_path"].split("@")[-1]
+        entry["snapshot_time"] = job["snapshot_time"]
+        entry["metadata_time"] = job["metadata_time"]
+    if stream_time is not None:
+        entry["stream_time"] = stream_time
+        if stream_time > 0:
+            entry["mb_per_s"] = total / stream_time / 1000 / 1000
+    wire_bytes = getattr(stream_stats, "wire_bytes", None)
+    data_bytes = getattr(stream_stats, "data_bytes", None)
+    if stream_time is not None and wire_bytes:
+        entry["wire_bytes"] = wire_bytes
+        if data_bytes is not None:
+            entry["compression_ratio"] = data_bytes / wire_bytes
+    if error:
+        entry["error"] = error
+    return entry
+
+
+def get_expected_duration(image, history):
+    return (history.get(history_key(image)) or {}).get("duration") or 0
+
+
+# a prepared image that won't be streamed after all (deadline) shouldn't leave its new snapshot behind
+def discard_prepared(prepared):
+    try:
+        job = prepared.result()
+    except Exception:
+        return
+    if job:
+        log_info("not streaming %s after all" % job["image"])
+        remove_unfinished_snap(job)
+
+
+# called by the repl functions once a destination has the new snapshot's diff, so from then on the snapshot is
+# the base for the next run and must stay, even if we are interrupted before the bookkeeping is done
+def mark_committed(job):
+    if job:
+        job["committed"] = True
+
+
+# removes the new snapshot of a job that didn't finish, unless an interrupted transfer can resume from it,
+# or a destination already has it (see mark_committed())
+def remove_unfinished_snap(job):
+    if job.get("committed") or get_resume_snap(job["image"]):
+        return
+    log_info("removing new snapshot \"%s\"" % job["src_snap_path"])
+    snap_rm_logged(job["src_snap_path"], cfg.src_host)
+
+
+# so images that don't change still get ordered by staleness
+MIN_CHURN = 1.0
+
+# roughly how many bytes an image changed since it was last replicated, ie. how much is at risk
+# images never replicated come first
+def image_priority(entry, now):
+    if not entry or not entry.get("last_success"):
+        return float("inf")
+    return (now - entry["last_success"]) * max(entry.get("churn") or 0, MIN_CHURN)
+
+
+def order_images(images, history, now):
+    return sorted(images, key=lambda image: -image_priority(history.get(history_key(image)), now))
+
+
+# logs the images that have no replicated snapshot newer than args.rpo seconds
+def report_rpo(images, history, now):
+    missed = []
+    for image in images:
+        entry = history.get(history_key(image)) or {}
+        last_success = entry.get("last_success")
+        if not last_success or now - last_success > args.rpo:
+            missed += [image]
+            if last_success:
+                age = "last replicated %s ago" % datetime.timedelta(seconds=int(now - last_success))
+            else:
+                age = "never replicated"
+            log_info("missed RPO: %s/%s, %s" % (cfg.src_pool, image, age))
+    log_info("%s of %s images missed the RPO of %s" % (len(missed), len(images), datetime.timedelta(seconds=args.rpo)))
+
+
 def create_snap_name():
     now = datetime.datetime.now(datetime.timezone.utc)
     nowstr = now.strftime("%Y-%m-%dT%H:%M:%S")
     snapname = "replication-%s" % nowstr
     return snapname
     
-def run():
+def setup_run():
     global subprocess_devnull, cfg
     
     if hasattr(subprocess, "DEVNULL"):
@@ -404,16 +1934,29 @@ def run():
         # python 3.2.3 (Ubuntu 12.04) doesn't have DEVNULL... so use PIPE
         subprocess_devnull = subprocess.PIPE
 
+    find_hosts()
+    setup_codec()
+    setup_throttle()
+
+
+def find_hosts():
+    global cfg
+
     if cfg.direction == "pull":
         cfg.src_host = findhost(cfg.src_cluster)
         cfg.dest_host = None
     else:
         cfg.src_host = None
-        cfg.dest_host = findhost(dest_cluster)
+        cfg.dest_host = findhost(cfg.dest_cluster)
+
+
+# returns the source images to replicate, according to the includes and excludes
+def list_images():
+    global cfg
 
     log_debug("image_includes = %s" % cfg.image_includes)
     log_debug("image_excludes = %s" % cfg.image_excludes)
-    found_resume = None
+    images = []
     for image in get_images(cfg.src_pool, cfg.src_host):
         if len(cfg.image_includes) != 0 and image not in cfg.image_includes:
             log_debug("skipping non-included %s" % image)
@@ -424,55 +1967,441 @@ def run():
         if image.endswith(".old"):
             log_debug("skipping .old %s" % image)
             continue
-        if not found_resume and args.resume:
+        images += [image]
+    return images
+
+
+# replicates one image, and records the result in history
+# returns the number of bytes read, or None if it failed
+# The part of replicating an image that comes before the stream: the skip check, the snapshot, and
+# metadata from both sides. In pipelined mode this runs in the background while the previous image streams.
+# returns a dict describing the job, or None if the image is skipped
+def prepare_image(image, history):
+    global cfg, args
+
+    start = time.time()
+    resume_snap = get_resume_snap(image)
+    if args.skip_threshold and not resume_snap and is_unchanged(image):
+        record_skip(history, image, start)
+        save_history_or_log(history)
+        return None
+
+    if resume_snap:
+        snapname = resume_snap
+    else:
+        snapname = create_snap_name()
+    
+    job = {"image": image, "start": start}
+    job["src_snap_path"] = src_snap_path = "%s/%s@%s" % (cfg.src_pool, image, snapname)
+    src_image_path = "%s/%s" % (cfg.src_pool, image)
+    
+    if resume_snap:
+        log_info("Resuming interrupted transfer of snapshot: %s" % src_snap_path)
+    else:
+        log_info("Making snapshot: %s" % src_snap_path)
+        snap_create(src_snap_path, cfg.src_host)
+        catalog_call("add", src_location(), cfg.src_pool, image, snapname)
+    metadata_start = time.time()
+    job["snapshot_time"] = metadata_start - start
+
+    try:
+        if cfg.destinations or cfg.dest_directory:
+            job["src_size"] = get_size(src_image_path, cfg.src_host)
+        else:
+            dest_image_path = "%s/%s" % (cfg.dest_pool,image)
+
+            # all at once; the latest snap is only needed if the dest image exists
+            src_result, dest_result, snaps_result = run_commands([size_command(src_image_path, cfg.src_host),
+                size_command(dest_image_path, cfg.dest_host), latest_snap_command(dest_image_path, cfg.dest_host)])
+            job["src_size"] = parse_size(src_image_path, src_result)
+            try:
+                job["dest_size"] = parse_size(dest_image_path, dest_result)
+            except:
+                job["dest_size"] = None
+
+            log_debug("src size = %s, dest size = %s" % (job["src_size"], job["dest_size"]))
+
+            if job["dest_size"]:
+                # figure out prev_snap_name
+                job["prev_snap_name"] = parse_latest_snap(dest_image_path, snaps_result)
+    except BaseException:
+        if not resume_snap:
+            remove_unfinished_snap(job)
+        raise
+    job["metadata_time"] = time.time() - metadata_start
+    return job
+
+
+# sends the diff for a job from prepare_image(), and returns the number of bytes read
+def stream_image(job):
+    global cfg
+
+    image = job["image"]
+    src_snap_path = job["src_snap_path"]
+    if cfg.destinations:
+        return repl_fan_out(src_snap_path, image, job["src_size"], job=job)
+    elif cfg.dest_directory:
+        dest_image_path = os.path.join(cfg.dest_directory, cfg.src_pool, image)
+        if cfg.direction == "push":
+            return repl_to_remote_directory(src_snap_path, dest_image_path, job=job)
+
+        if not os.path.exists(dest_image_path):
+            os.makedirs(dest_image_path)
+       
+        return repl_to_directory(src_snap_path, dest_image_path, job=job)
+    else:
+        dest_image_path = "%s/%s" % (cfg.dest_pool,image)
+        
+        if not job["dest_size"]:
+            rbd_create(dest_image_path, job["src_size"], host=cfg.dest_host)
+            return repl(src_snap_path, dest_image_path, job=job)
+        else:
+            return repl(src_snap_path, dest_image_path, prev_snap_name=job["prev_snap_name"], job=job)
+
+
+# replicates one image, and records the result in history
+# prepared is a future for prepare_image(image, history) if that was already started, eg. in pipelined mode
+# returns the number of bytes read, or None if it failed
+def replicate_image(image, history, prepared=None):
+    global cfg, args
+
+    if throttle:
+        # don't even start a new image while the cluster is unhealthy
+        throttle.wait_healthy()
+    image_start = time.time()
+    size_read = 0
+    ok = False
+    job = None
+    stream_start = None
+    error = None
+    set_stream_stats(None, None)
+    try: 
+        if prepared:
+            job = prepared.result()
+        else:
+            job = prepare_image(image, history)
+        if not job:
+            write_journal(journal_entry(image, None, "skipped", image_start, time.time()))
+            return 0
+        image_start = job["start"]
+        stream_start = time.time()
+        size_read = stream_image(job)
+        ok = True
+    except Exception as e:
+        error = str(e)
+        traceback.print_exc()
+    except BaseException:
+        # SIGTERM (see exit_on_sigterm) or ^C
+        if job:
+            remove_unfinished_snap(job)
+        elif prepared:
+            discard_prepared(prepared)
+        raise
+    end = time.time()
+    if not ok:
+        forget_dest(image)
+    stream_time = None
+    duration = None
+    if stream_start:
+        stream_time = end - stream_start
+        # not end - image_start: a prepare_image() started in the background also waited for the previous stream
+        duration = job["snapshot_time"] + job["metadata_time"] + stream_time
+    record_history(history, image, image_start, end, size_read, ok, duration)
+    save_history_or_log(history)
+    write_journal(journal_entry(image, job, "ok" if ok else "failed", image_start, end, size_read or 0,
+        stream_time, error))
+    if not ok:
+        return None
+    return size_read
+
+
+# in pipelined mode, runs prepare_image() for the next image and snap removals in the background
+background = None
+background_futures = []
+
+def snap_rm_logged(snap_path, host):
+    try:
+        snap_rm(snap_path, host)
+    except Exception as e:
+        log_error(str(e))
+
+
+# removes an old snap from the source after its replacement was replicated; in the background in pipelined mode
+def remove_old_snap(snap_path):
+    global cfg
+
+    log_info("removing snap \"%s\"" % (snap_path.split("@")[-1]))
+    if background:
+        background_futures.append(background.submit(snap_rm_logged, snap_path, cfg.src_host))
+    else:
+        snap_rm(snap_path, cfg.src_host)
+
+
+def wait_background():
+    global background_futures
+
+    concurrent.futures.wait(background_futures)
+    background_futures = []
+
+
+def run():
+    global cfg, skip_stats
+
+    setup_run()
+    images = list_images()
+
+    history = load_history(args.history_file)
+    start_time = time.time()
+    global journal_run
+    journal_run = start_time
+    # --resume skips the images before it in ls order; the priority order changes from run to run
+    if args.order == "priority" and not args.resume:
+        images = order_images(images, history, start_time)
+        log_debug("image order = %s" % images)
+    deadline = None
+    if args.deadline:
+        deadline = parse_deadline(args.deadline, start_time)
+        log_info("not starting new images after %s" % datetime.datetime.fromtimestamp(deadline))
+
+    if args.resume:
+        for n, image in enumerate(images):
             if image == args.resume or "%s/%s"%(cfg.src_pool,image) == args.resume:
-                found_resume = True
-            else:
-                log_debug("resume is set, and skipping %s" % image)
-                continue
-        size_read = 0
-        try: 
-            snapname = create_snap_name()
-            
-            src_snap_path = "%s/%s@%s" % (cfg.src_pool, image, snapname)
-            dest_snap_path = "%s/%s@%s" % (cfg.dest_pool, image, snapname)
-            src_image_path = "%s/%s" % (cfg.src_pool, image)
-            
-            log_info("Making snapshot: %s" % src_snap_path)
-            snap_create(src_snap_path, cfg.src_host)
-
-            src_size = get_size(src_image_path, cfg.src_host)
-
-            if cfg.dest_directory:
-                dest_image_path = os.path.join(cfg.dest_directory, cfg.src_pool, image)
-                
-                if not os.path.exists(dest_image_path):
-                    os.makedirs(dest_image_path)
-               
-                size_read = repl_to_directory(src_snap_path, dest_image_path)
-            else:
-                dest_image_path = "%s/%s" % (cfg.dest_pool,image)
-                
+                log_debug("resume is set, and skipping %s" % images[0:n])
+                images = images[n:]
+                break
+        else:
+            log_debug("resume is set, and skipping %s" % images)
+            images = []
+
+    global background
+    if args.pipeline:
+        background = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    skip_stats = {"count": 0, "bytes": 0}
+    not_started = []
+    prepared = None
+    try:
+        for n, image in enumerate(images):
+            if deadline:
+                # skip images that won't finish in time, but keep trying smaller ones
+                expected = get_expected_duration(image, history)
+                if time.time() + expected > deadline:
+                    log_info("not starting %s, expected to take %ss which would overrun the deadline" % (image, int(expected)))
+                    not_started += [image]
+                    now = time.time()
+                    write_journal(journal_entry(image, None, "not_started", now, now))
+                    if prepared:
+                        prepared.cancel()
+                        discard_prepared(prepared)
+                    prepared = None
+                    continue
+            current = prepared
+            prepared = None
+            if background and n+1 < len(images):
+                # make the next image's snapshot and get its metadata while this one streams,
+                # unless it's already clear that it would overrun the deadline
+                next_image = images[n+1]
+                if not deadline or time.time() + get_expected_duration(image, history) + get_expected_duration(next_image, history) <= deadline:
+                    if current is None:
+                        current = background.submit(prepare_image, image, history)
+                    prepared = background.submit(prepare_image, next_image, history)
+            size_read = replicate_image(image, history, current)
+            if args.sleep and args.sleep != 0 and (size_read == None or size_read > 1000000):
+                log_info("sleeping %ss" % args.sleep)
+                time.sleep(args.sleep)
+    except BaseException:
+        # SIGTERM or ^C; the next image may already have its snapshot
+        if prepared:
+            prepared.cancel()
+            discard_prepared(prepared)
+        raise
+
+    if background:
+        wait_background()
+        background.shutdown()
+        background = None
+
+    if args.skip_threshold:
+        log_info("skipped %s unchanged images (%s changed in total was not replicated)"
+            % (skip_stats["count"], format_bytes(skip_stats["bytes"])))
+    if not_started:
+        log_info("%s images not started because of the deadline: %s" % (len(not_started), ", ".join(not_started)))
+    if args.rpo:
+        report_rpo(images, history, time.time())
+
+
+LOCK_FILE = "/var/run/ceph_repl.lock"
+DAEMON_LOCK_FILE = "/var/run/ceph_repl_daemon.lock"
+
+# used in daemon mode, so one ssh connection per host is reused for everything
+SSH_CONTROL_OPTIONS = ["-o", "ControlMaster=auto", "-o", "ControlPath=/var/run/ceph_repl_ssh_%r@%h:%p",
+    "-o", "ControlPersist=15m"]
+
+# how long to wait before retrying an image that failed, unless its interval is shorter
+RETRY_DELAY = 10*60
+
+# how long to wait before listing the images again after that failed; doubled for each failure in a row, up to
+# args.inventory_interval
+INVENTORY_RETRY_DELAY = 30
+
+
+# returns the replication interval in seconds for image, from cfg.image_intervals or args.interval
+def get_interval(image):
+    global cfg, args
+
+    for pattern in sorted(cfg.image_intervals):
+        if fnmatch.fnmatch(image, pattern):
+            return parse_duration(cfg.image_intervals[pattern])
+    return args.interval
+
+
+# returns the unix time when image should be replicated next
+def get_next_due(image, history):
+    entry = history.get(history_key(image)) or {}
+    interval = get_interval(image)
+    # an image that was found unchanged is checked again an interval later
+    due = max(entry.get("last_success") or 0, entry.get("last_check") or 0) + interval
+    if entry.get("failures") and entry.get("last_attempt"):
+        due = max(due, entry["last_attempt"] + min(interval, RETRY_DELAY))
+    return due
+
+
+# waits for the same lock the cron jobs (ceph_snaprotator.py, ceph_repl_cleanup.bash) take,
+# so the daemon only holds it while replicating an image, and rotation can run in between
+@contextlib.contextmanager
+def repl_lock(lock_file):
+    while True:
+        f = open(lock_file, "ab")
+        if not try_flock(f):
+            log_debug("waiting for lock %s" % lock_file)
+            fcntl.flock(f, fcntl.LOCK_EX)
+        # the others remove the file when they are done, so make sure we locked the file that is there now
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(lock_file).st_ino:
+                break
+        except OSError:
+            pass
+        f.close()
+    try:
+        yield
+    finally:
+        f.close()
+
+
+def try_flock(f):
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except: # python3.4.x has BlockingIOError here, but python 3.2.x has IOError here... so just don't use those class names
+        return False
+
+
+# serves the daemon status as json to anyone who connects to the unix socket at path, eg. with
+#     socat - UNIX-CONNECT:/var/run/ceph_repl.sock
+def start_status_server(path, get_status):
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+
+    def serve():
+        while True:
+            conn = server.accept()[0]
+            try:
+                conn.sendall((json.dumps(get_status(), indent=1, sort_keys=True) + "\n").encode("utf-8"))
+            except Exception as e:
+                log_debug("status socket: %s" % e)
+            finally:
+                conn.close()
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+    return server
+
+
+# Runs forever, replicating each image whenever its interval (see get_interval) has passed since its
+# last replicated snap. The ssh connection and image list are kept between images; the list is
+# refreshed every args.inventory_interval seconds to pick up new and removed images.
+def daemon():
+    global cfg, args, ssh_options, skip_stats
+
+    ssh_options = SSH_CONTROL_OPTIONS
+    setup_run()
+
+    history = load_history(args.history_file)
+    global journal_run
+    journal_run = time.time()
+    skip_stats = {"count": 0, "bytes": 0}
+    images = []
+    next_inventory = 0
+    inventory_failures = 0
+    current = [None]
+
+    # runs in the status server's thread; the history is copied under the lock, and encoded after
+    def get_status():
+        ret = {"pid": os.getpid(), "src_host": cfg.src_host, "dest_host": cfg.dest_host,
+            "current": current[0], "images": {}}
+        with history_lock:
+            for image in images:
+                entry = copy.deepcopy(history.get(history_key(image)) or {})
+                entry["interval"] = get_interval(image)
+                entry["next_due"] = get_next_due(image, history)
+                ret["images"][image] = entry
+        return ret
+
+    if args.status_socket:
+        start_status_server(args.status_socket, get_status)
+
+    while True:
+        now = time.time()
+        if now >= next_inventory:
+            try:
                 try:
-                    dest_size = get_size(dest_image_path, cfg.dest_host)
-                except:
-                    dest_size = None
-
-                log_debug("src size = %s, dest size = %s" % (src_size, dest_size))
-                
-                if not dest_size:
-                    rbd_create(dest_image_path, src_size, host=cfg.dest_host)
-                    size_read = repl(src_snap_path, dest_image_path)
-                else:
-                    # figure out prev_snap_name
-                    prev_snap_name = get_latest_snap(dest_image_path, cfg.dest_host)
-                    
-                    size_read = repl(src_snap_path, dest_image_path, prev_snap_name=prev_snap_name)
-        except Exception as e:
-            traceback.print_exc()
-        if args.sleep and args.sleep != 0 and (size_read == None or size_read > 1000000):
-            log_info("sleeping %ss" % args.sleep)
-            time.sleep(args.sleep)
+                    new_images = list_images()
+                except Exception as e:
+                    log_error("could not list images, looking for a host again: %s" % e)
+                    find_hosts()
+                    new_images = list_images()
+            except Exception as e:
+                # keep going with the images we had; a cluster or host that is down for a while shouldn't stop
+                # the daemon
+                inventory_failures += 1
+                delay = min(INVENTORY_RETRY_DELAY * 2 ** (inventory_failures - 1), args.inventory_interval)
+                log_error("could not list images (%s times in a row), trying again in %ss: %s" %
+                    (inventory_failures, delay, e))
+                next_inventory = now + delay
+            else:
+                inventory_failures = 0
+                for image in sorted(set(new_images) - set(images)):
+                    log_info("new image %s, interval %ss" % (image, get_interval(image)))
+                for image in sorted(set(images) - set(new_images)):
+                    log_info("image %s is gone" % image)
+                images = new_images
+                next_inventory = now + args.inventory_interval
+
+        due = [image for image in images if get_next_due(image, history) <= now]
+        if due:
+            image = order_images(due, history, now)[0]
+            current[0] = image
+            with repl_lock(LOCK_FILE):
+                replicate_image(image, history)
+            current[0] = None
+            continue
+
+        next_due = min([get_next_due(image, history) for image in images] + [next_inventory])
+        wait = max(1, min(next_due - time.time(), args.inventory_interval))
+        log_debug("nothing due, sleeping %ss" % int(wait))
+        time.sleep(wait)
+
+
+# SIGTERM should run the finally blocks, like removing temp files and the new snapshot of an unfinished image;
+# running asyncio commands are killed (see run_command_async)
+def exit_on_sigterm():
+    # the usual status for a process killed by a signal, so callers can still tell it didn't finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signal.SIGTERM))
+
 
 def boolarg(parser, name):
     opt = name.replace("_", "-")
@@ -496,7 +2425,41 @@ if __name__ == "__main__":
                     help='Config file')
     parser.add_argument('--resume', dest='resume', action='store',
                     type=str,
-                    help='Name of an image to resume from; any image encountered before this one is skipped.')
+                    help='Name of an image to resume from; any image encountered before this one (in rbd ls order) is skipped.')
+    parser.add_argument('--order', dest='order', action='store',
+                    choices=["priority", "ls"], default="priority",
+                    help="order to replicate images in: priority (most changed since last replicated first, based on the history file) or ls (rbd ls order, always used with --resume)")
+    parser.add_argument('--deadline', dest='deadline', action='store',
+                    type=str, default=None,
+                    help="don't start images after this time (HH:MM or YYYY-MM-DDTHH:MM), or if they are expected to finish after it")
+    parser.add_argument('--rpo', dest='rpo', action='store',
+                    type=parse_duration, default=None,
+                    help="report images without a replicated snapshot newer than this, eg. 24h")
+    parser.add_argument('--history-file', dest='history_file', action='store',
+                    type=str, default=None,
+                    help="where to keep per image replication history between runs, eg. /var/lib/ceph_repl/history.json; without it the history only lasts for one run, or for the life of a --daemon (default none)")
+    parser.add_argument('--journal', dest='journal', action='store',
+                    type=str, default=None,
+                    help="json lines file to append a record per image per run to, with timings, throughput and outcome, eg. /var/lib/ceph_repl/journal.jsonl; see ceph_repl_journal.py (default none)")
+    parser.add_argument('--catalog', dest='catalog', action='store',
+                    type=str, default=None,
+                    help="sqlite snapshot catalog shared with ceph_snaprotator.py and ceph_repl_cleanup.bash, used instead of listing directories, eg. /var/lib/ceph_repl/catalog.sqlite; see ceph_repl_catalog.py (default none)")
+    parser.add_argument('--command-timeout', dest='command_timeout', action='store',
+                    type=int, default=10*60,
+                    help="seconds after which short rbd/ssh commands (not the streams) are killed, 0 for never (default 600)")
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                    help="make the next image's snapshot and get its metadata while the current image streams, and remove old snapshots in the background")
+    parser.add_argument('--daemon', dest='daemon', action='store_true',
+                    help="keep running, and replicate each image whenever its interval has passed (see --interval and image_intervals in the config)")
+    parser.add_argument('--interval', dest='interval', action='store',
+                    type=parse_duration, default=24*60*60,
+                    help="daemon mode: default replication interval per image, eg. 15m or 1d (default 1d)")
+    parser.add_argument('--inventory-interval', dest='inventory_interval', action='store',
+                    type=parse_duration, default=10*60,
+                    help="daemon mode: how often to look for new and removed images (default 10m)")
+    parser.add_argument('--status-socket', dest='status_socket', action='store',
+                    type=str, default=None,
+                    help="daemon mode: unix socket that serves the status of every image as json, eg. /var/run/ceph_repl.sock")
     parser.add_argument('--image-includes', dest='image_includes', action='store',
                     type=str, default="",
                     help="comma separated names of images to include")
@@ -506,9 +2469,43 @@ if __name__ == "__main__":
     parser.add_argument('--sleep', dest='sleep', action='store',
                     type=int, default=30,
                     help="experimental - seconds to sleep between each backup")
+    parser.add_argument('--skip-threshold', dest='skip_threshold', action='store',
+                    type=int, default=0,
+                    help="skip images where fewer than this many bytes changed since the last replicated snap (estimated with rbd diff --whole-object, which uses fast-diff if enabled); 1 skips only unchanged images, 0 disables (default)")
+    parser.add_argument('--codec', dest='codec', action='store',
+                    choices=ceph_repl_compression.codec_names, default=None,
+                    help="compression codec for the replication stream (default lz4 for dest_directory and destinations, none from pool to pool); --no-compression is the same as none")
+    parser.add_argument('--compression-level', dest='compression_level', action='store',
+                    type=str, default=None,
+                    help="compression level, or \"auto\" to pick one from a benchmark of the source CPU and the link speed (default is the codec's default)")
+    parser.add_argument('--compression-threads', dest='compression_threads', action='store',
+                    type=int, default=0,
+                    help="zstd worker threads, 0 means one per core (default 0)")
+    parser.add_argument('--compress-at-rest', dest='compress_at_rest', action='store_true',
+                    help="for dest_directory, store the diff files compressed instead of decompressing them")
+    parser.add_argument('--container', dest='container', action='store_true',
+                    help="for dest_directory, store the diff files as indexed, compressed containers (.rbdx, see ceph_rbd_diff_container.py)")
+    parser.add_argument('--preallocate', dest='preallocate', action='store_true',
+                    help="for dest_directory, reserve the expected size of each diff file up front (from rbd diff --whole-object), against fragmentation")
+    parser.add_argument('--direct-io', dest='direct_io', action='store_true',
+                    help="for dest_directory, write diff files with O_DIRECT, bypassing the page cache")
+    parser.add_argument('--drop-cache', dest='drop_cache', action='store_true',
+                    help="for dest_directory, drop written diff data from the page cache as it goes (posix_fadvise DONTNEED)")
+    parser.add_argument('--bwlimit', dest='bwlimit', action='store',
+                    type=str, default=None,
+                    help="limit the replication stream to this many bytes/s, eg. 50M, optionally per time of day, eg. \"08:00-18:00=20M,200M\" (0 is unlimited)")
+    parser.add_argument('--pause-health', dest='pause_health', action='store',
+                    type=str, default="",
+                    help="comma separated cluster health states to pause replication in, eg. HEALTH_ERR or HEALTH_WARN,HEALTH_ERR")
+    parser.add_argument('--health-interval', dest='health_interval', action='store',
+                    type=int, default=30,
+                    help="seconds between ceph health checks for --pause-health (default 30)")
     boolarg(parser, "skip_lock")
     boolarg(parser, "compression")
     boolarg(parser, "nice")
+    boolarg(parser, "digests")
+    # every byte is read back and hashed, so only when asked for
+    parser.set_defaults(digests=False)
 
     global args
     args = parser.parse_args()
@@ -516,9 +2513,28 @@ if __name__ == "__main__":
     debug = args.debug
    
     do_import(args)
+    command_timeout = args.command_timeout
+    if args.catalog:
+        try:
+            catalog = ceph_repl_catalog.Catalog(args.catalog)
+        except Exception as e:
+            log_error("could not open catalog %s, going on without it: %s" % (args.catalog, e))
+    exit_on_sigterm()
     
+    if args.daemon:
+        with open(DAEMON_LOCK_FILE, "wb") as f:
+            if not try_flock(f):
+                print("Could not obtain daemon lock; another daemon already running? quitting")
+                exit(1)
+            try:
+                daemon()
+            finally:
+                if args.status_socket and os.path.exists(args.status_socket):
+                    os.remove(args.status_socket)
+        exit(0)
+
     got_lock = False
-    lockFile = "/var/run/ceph_repl.lock"
+    lockFile = LOCK_FILE
     try:
         with open(lockFile, "wb") as f:
             try:
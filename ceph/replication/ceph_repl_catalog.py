@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+#
+# a catalog of the snapshots and stored diffs of each image, in an sqlite database shared by ceph_repl.py,
+# ceph_snaprotator.py and ceph_rbd_snap_rm.py (which ceph_repl_cleanup.bash uses)
+#
+# Each row is a snap of an image in a pool, at a location:
+#     rbd:<cluster>              snapshots in a cluster (the source, or the backup pool)
+#     dir:<path>                 diff files in a directory (dir:<cluster>:<path> for a directory on a remote host)
+# with what is known about it: size (of the diff file), digest (sha256 of the diff file), from_snap (the snap
+# the diff starts at), created (the time in the snap name) and file (the diff file's name, with the compression
+# suffix if any).
+#
+# Every tool records its changes as it makes them. An image whose snaps were all listed at some point is marked
+# as listed (the "listed" table); from then on its rows are all there is, and the tools read them instead of
+# listing again: ceph_repl.py for the latest snap of a directory (checking that the one file is there),
+# ceph_snaprotator.py for the snaps to rotate, and ceph_repl_cleanup.bash for the source snaps and what the backup
+# has. It's a cache: when an image isn't marked, the tools list it and fill it in, and when something turns out
+# wrong (replicating or removing fails, a file to merge is gone) the image is forgotten, so it's listed again.
+#
+# usage:
+#     ceph_repl_catalog.py --catalog PATH list [location [pool [image]]]
+#     ceph_repl_catalog.py --catalog PATH sync-dir DIRECTORY POOL        (re-read a pool's files, eg. after manual changes)
+#     ceph_repl_catalog.py --catalog PATH snaps LOCATION POOL            (image@ and image@snap lines of the listed images)
+#     ceph_repl_catalog.py --catalog PATH unlisted LOCATION POOL         (images that have rows but need listing)
+#     ceph_repl_catalog.py --catalog PATH fill LOCATION POOL             (replace images with the image@snap lines on
+#                                                                         stdin; "image@" for an image without snaps)
+#     ceph_repl_catalog.py shell-config CONFIG                           (the locations of a ceph_repl.py config, as
+#                                                                         shell variables)
+
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import os
+import shlex
+import sqlite3
+import sys
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snaps (
+    location TEXT NOT NULL,
+    pool TEXT NOT NULL,
+    image TEXT NOT NULL,
+    snap TEXT NOT NULL,
+    size INTEGER,
+    digest TEXT,
+    from_snap TEXT,
+    created REAL,
+    updated REAL NOT NULL,
+    file TEXT,
+    PRIMARY KEY (location, pool, image, snap)
+);
+CREATE TABLE IF NOT EXISTS listed (
+    location TEXT NOT NULL,
+    pool TEXT NOT NULL,
+    image TEXT NOT NULL,
+    listed REAL NOT NULL,
+    PRIMARY KEY (location, pool, image)
+);
+"""
+
+COLUMNS = ["location", "pool", "image", "snap", "size", "digest", "from_snap", "created", "updated", "file"]
+
+
+def rbd_location(cluster):
+    return "rbd:%s" % cluster
+
+
+# cluster is where the directory is, if not here
+def dir_location(path, cluster=None):
+    path = os.path.normpath(path)
+    if cluster:
+        return "dir:%s:%s" % (cluster, path)
+    return "dir:%s" % path
+
+
+# returns the key (location, pool, image) of the diff files in image_dir_path, which is <directory>/<pool>/<image>
+def dir_key(image_dir_path, cluster=None):
+    image_dir_path = os.path.normpath(image_dir_path)
+    pool_path = os.path.dirname(image_dir_path)
+    return dir_location(os.path.dirname(pool_path), cluster), os.path.basename(pool_path), os.path.basename(image_dir_path)
+
+
+# returns the time in a snap name like replication-2020-01-31T00:20:00 as a unix time, or None
+def snap_time(snap):
+    try:
+        return time.mktime(datetime.datetime.fromisoformat(snap[snap.find("-")+1:]).timetuple())
+    except ValueError:
+        return None
+
+
+# The catalog in the sqlite database at path. It can be used from several threads; every change is one
+# transaction, and other processes wait for each other's (up to timeout seconds).
+class Catalog:
+    def __init__(self, path, timeout=60):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.lock = threading.Lock()
+        # autocommit, with transactions started explicitly
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # readers don't block the writer, and the other way around
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        # catalogs made before the file column
+        if "file" not in [row["name"] for row in self.db.execute("PRAGMA table_info(snaps)")]:
+            self.db.execute("ALTER TABLE snaps ADD COLUMN file TEXT")
+
+    def close(self):
+        self.db.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, params)]
+
+    # adds or replaces a snap; file is the name of its diff file, for a directory
+    def add(self, location, pool, image, snap, size=None, digest=None, from_snap=None, file=None):
+        with self.transaction() as db:
+            insert_snap(db, location, pool, image, snap, size, digest, from_snap, file)
+
+    def remove(self, location, pool, image, snaps):
+        with self.transaction() as db:
+            db.executemany("DELETE FROM snaps WHERE location = ? AND pool = ? AND image = ? AND snap = ?",
+                [(location, pool, image, snap) for snap in snaps])
+
+    # replaces what is known about an image with rows, a list of dicts with at least "snap", from listing all
+    # its snaps; the image is marked as listed
+    def replace_image(self, location, pool, image, rows):
+        with self.transaction() as db:
+            db.execute("DELETE FROM snaps WHERE location = ? AND pool = ? AND image = ?", (location, pool, image))
+            for row in rows:
+                insert_snap(db, location, pool, image, row["snap"], row.get("size"), row.get("digest"),
+                    row.get("from_snap"), row.get("file"))
+            db.execute("INSERT OR REPLACE INTO listed (location, pool, image, listed) VALUES (?, ?, ?, ?)",
+                (location, pool, image, time.time()))
+
+    # forgets an image, so the tools list it again
+    def forget_image(self, location, pool, image):
+        with self.transaction() as db:
+            db.execute("DELETE FROM snaps WHERE location = ? AND pool = ? AND image = ?", (location, pool, image))
+            db.execute("DELETE FROM listed WHERE location = ? AND pool = ? AND image = ?", (location, pool, image))
+
+    # returns the snaps of an image as dicts, oldest first, if it is marked as listed; otherwise None,
+    # and the caller has to list it (and should replace_image() with what it found)
+    def listed_snaps(self, location, pool, image):
+        with self.lock:
+            listed = self.db.execute("SELECT 1 FROM listed WHERE location = ? AND pool = ? AND image = ?",
+                (location, pool, image)).fetchone()
+        if not listed:
+            return None
+        return self.snaps(location, pool, image)
+
+    # returns the names of the images in a pool that are marked as listed
+    def listed_images(self, location, pool):
+        return [row["image"] for row in self.query("SELECT image FROM listed WHERE location = ? AND pool = ? ORDER BY image",
+            (location, pool))]
+
+    # returns the names of the images in a pool that have snaps here, but were never listed (eg. added to since
+    # the catalog was made, or forgotten)
+    def unlisted_images(self, location, pool):
+        return [row["image"] for row in self.query("SELECT DISTINCT image FROM snaps WHERE location = ? AND pool = ? "
+            "AND image NOT IN (SELECT image FROM listed WHERE location = ? AND pool = ?) ORDER BY image",
+            (location, pool, location, pool))]
+
+    # returns the snaps of an image as dicts, oldest first
+    def snaps(self, location, pool, image):
+        return self.query("SELECT * FROM snaps WHERE location = ? AND pool = ? AND image = ? ORDER BY snap",
+            (location, pool, image))
+
+    # returns the name of the newest snap of an image, or None if there is none
+    def latest(self, location, pool, image):
+        rows = self.query("SELECT snap FROM snaps WHERE location = ? AND pool = ? AND image = ? ORDER BY snap DESC LIMIT 1",
+            (location, pool, image))
+        if rows:
+            return rows[0]["snap"]
+        return None
+
+
+def insert_snap(db, location, pool, image, snap, size, digest, from_snap, file=None):
+    db.execute("INSERT OR REPLACE INTO snaps (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % ", ".join(COLUMNS),
+        (location, pool, image, snap, size, digest, from_snap, snap_time(snap), time.time(), file))
+
+
+# re-reads the diff files of a pool in a directory (directory/pool/image/snap) into the catalog
+def sync_dir(catalog, directory, pool):
+    # here, so the tools that only record rbd snaps don't need the diff helpers
+    import ceph_rbd_diff
+    import ceph_repl_compression
+
+    location = dir_location(directory)
+    pool_path = os.path.join(directory, pool)
+    for image in sorted(os.listdir(pool_path)):
+        rows = []
+        for entry in sorted(os.scandir(os.path.join(pool_path, image)), key=lambda e: e.name):
+            if not entry.name.startswith("replication") or ".tmp" in entry.name:
+                continue
+            digests = ceph_rbd_diff.read_digest(entry.path) or {}
+            rows += [{"snap": ceph_repl_compression.strip_suffix(entry.name), "size": entry.stat().st_size,
+                "digest": digests.get("digest"), "from_snap": digests.get("from_snap"), "file": entry.name}]
+        catalog.replace_image(location, pool, image, rows)
+        print("%s/%s: %s snaps" % (pool, image, len(rows)))
+
+
+# prints image@snap for every snap of the listed images in a pool
+# prints image@snap lines for the listed images of a pool, each after an "image@" line, the format fill() reads
+def print_listed_snaps(catalog, location, pool):
+    for image in catalog.listed_images(location, pool):
+        print("%s@" % image)
+        for row in catalog.snaps(location, pool, image):
+            print("%s@%s" % (image, row["snap"]))
+
+
+# replaces the images named in the image@snap lines read from fileobj with their snaps; a line "image@" is an
+# image that has none
+def fill(catalog, location, pool, fileobj):
+    images = {}
+    for line in fileobj:
+        line = line.strip()
+        if not line:
+            continue
+        image, snap = line.split("@", 1)
+        images.setdefault(image, [])
+        if snap:
+            images[image] += [{"snap": snap}]
+    for image, rows in images.items():
+        catalog.replace_image(location, pool, image, rows)
+
+
+# loads a ceph_repl.py config file (a python module), and fills in the defaults ceph_repl.py uses
+def load_config(path):
+    spec = importlib.util.spec_from_file_location("ceph_repl_config", path)
+    cfg = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cfg)
+    for name in ["dest_cluster", "dest_directory", "destinations"]:
+        if not hasattr(cfg, name):
+            setattr(cfg, name, None)
+    if not hasattr(cfg, "dest_pool"):
+        cfg.dest_pool = "backup-%s-%s" % (cfg.src_cluster, cfg.src_pool)
+    return cfg
+
+
+# returns the (location, pool, directory or None) of each destination of a ceph_repl.py config, as ceph_repl.py
+# names them in the catalog; the directory is only given if it is here (the fan-out ones always are, a single
+# one is on the destination host in push mode)
+def config_destinations(cfg):
+    if cfg.destinations:
+        destinations = cfg.destinations
+    elif cfg.dest_directory:
+        destinations = [{"dest_directory": cfg.dest_directory}]
+    else:
+        destinations = [{"dest_pool": cfg.dest_pool}]
+    remote = not cfg.destinations and cfg.direction == "push"
+
+    ret = []
+    for destination in destinations:
+        directory = destination.get("dest_directory")
+        if directory and remote:
+            ret += [(dir_location(directory, cfg.dest_cluster), cfg.src_pool, None)]
+        elif directory:
+            ret += [(dir_location(directory), cfg.src_pool, directory)]
+        else:
+            ret += [(rbd_location(cfg.dest_cluster), destination.get("dest_pool", cfg.dest_pool), None)]
+    return ret
+
+
+# prints shell variable assignments for a ceph_repl.py config, for ceph_repl_cleanup.bash
+def print_shell_config(path):
+    cfg = load_config(path)
+    values = [("src_cluster", cfg.src_cluster), ("src_pool", cfg.src_pool),
+        ("src_location", rbd_location(cfg.src_cluster))]
+    for name, value in values:
+        print("%s=%s" % (name, shlex.quote(value)))
+    destinations = config_destinations(cfg)
+    for name, n in [("dest_locations", 0), ("dest_pools", 1), ("dest_directories", 2)]:
+        print("%s=(%s)" % (name, " ".join([shlex.quote(destination[n] or "") for destination in destinations])))
+
+
+def print_snaps(catalog, location=None, pool=None, image=None):
+    where = []
+    params = []
+    for column, value in [("location", location), ("pool", pool), ("image", image)]:
+        if value:
+            where += ["%s = ?" % column]
+            params += [value]
+    sql = "SELECT * FROM snaps"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    for row in catalog.query(sql + " ORDER BY location, pool, image, snap", params):
+        print("%s %s/%s@%s size %s from %s" % (row["location"], row["pool"], row["image"], row["snap"],
+            row["size"], row["from_snap"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show or rebuild the snapshot catalog shared by the ceph_repl tools.")
+    parser.add_argument('--catalog', dest='catalog', action='store',
+                    default=None,
+                    help='catalog file, as given to the other tools with --catalog; needed by all the commands but shell-config')
+    parser.add_argument('command', choices=["list", "sync-dir", "snaps", "unlisted", "fill", "shell-config"],
+                    help='list snaps, re-read the diff files of a pool in a directory, or one of the commands for scripts (see the top of this file)')
+    parser.add_argument('names', nargs="*",
+                    help='for list: location, pool and image to list (all optional); for sync-dir: directory and pool; for snaps, unlisted and fill: location and pool; for shell-config: the config file')
+    args = parser.parse_args()
+
+    if args.command == "shell-config":
+        if len(args.names) != 1:
+            parser.error("shell-config needs a config file")
+        print_shell_config(args.names[0])
+        sys.exit(0)
+
+    if not args.catalog:
+        parser.error("%s needs --catalog" % args.command)
+    catalog = Catalog(args.catalog)
+    if args.command == "list":
+        print_snaps(catalog, *args.names[0:3])
+        sys.exit(0)
+    if len(args.names) != 2:
+        parser.error("%s needs two arguments" % args.command)
+    if args.command == "sync-dir":
+        sync_dir(catalog, *args.names)
+    elif args.command == "snaps":
+        print_listed_snaps(catalog, *args.names)
+    elif args.command == "unlisted":
+        for image in catalog.unlisted_images(*args.names):
+            print(image)
+    else:
+        fill(catalog, args.names[0], args.names[1], sys.stdin)
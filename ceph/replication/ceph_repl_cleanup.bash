@@ -1,12 +1,19 @@
 #!/bin/bash
 #
 # Remove all remote snaps except the latest that is on backup
-
-# TODO: make one ssh connection and reuse it
-
+#
+# usage: ceph_repl_cleanup.bash [-v] [-n] [-c CONFIG] [--catalog PATH]
+#
+#     -c CONFIG        the ceph_repl.py config to take the source pool and the destinations from (without it:
+#                      pool proxmox of cluster ceph, backed up to /data/ceph-repl and to pool backup-ceph-proxmox)
+#     --catalog PATH   the snapshot catalog ceph_repl.py uses (see ceph_repl_catalog.py); the source snaps and
+#                      what the backup has are read from it, and only the images it has no data for are listed
 
 verbose=0
 dryrun=0
+config=
+catalog=
+here="$(dirname "$0")"
 
 log_debug() {
     if [ "$verbose" != 0 ]; then
@@ -20,34 +27,137 @@ log_warn() {
     fi
 }
 
-for arg in "$@"; do
-    if [ "$arg" = "-v" ]; then
+while [ "$#" != 0 ]; do
+    if [ "$1" = "-v" ]; then
         verbose=1
-    elif [ "$arg" = "-n" ]; then
+    elif [ "$1" = "-n" ]; then
         dryrun=1
+    elif [ "$1" = "-c" ]; then
+        config="$2"
+        shift
+    elif [ "$1" = "--catalog" ]; then
+        catalog="$2"
+        shift
     fi
     shift
 done
 
-echo -n "reading snap list..."
-IFS=$'\n'
-snap_data=($(
-    ssh ceph1 '
-            for image in $(rbd ls proxmox); do
-                for snap in $(rbd snap ls proxmox/"$image" | awk '"'"'NR!=1 && $2 ~ /^replication-/ {print $2}'"'"' | sort -r); do
-                    echo "${image}@${snap}"
-                done
+if [ -n "$config" ]; then
+    shell_config="$("$here"/ceph_repl_catalog.py shell-config "$config")" || exit 1
+    eval "$shell_config"
+else
+    src_cluster=ceph
+    src_pool=proxmox
+    src_location=rbd:ceph
+    dest_locations=(dir:/data/ceph-repl rbd:ceph)
+    dest_pools=(proxmox backup-ceph-proxmox)
+    dest_directories=(/data/ceph-repl "")
+fi
+src_host="${src_cluster}1"
+
+catalog_cmd() {
+    "$here"/ceph_repl_catalog.py --catalog "$catalog" "$@"
+}
+
+# prints "image@" and then image@snap for each replication snap, of the images named on stdin, or of all the
+# images of the source pool if none are; over one ssh connection
+list_remote_snaps() {
+    ssh "$src_host" "pool=$(printf %q "$src_pool")"'
+            images=$(cat)
+            if [ -z "$images" ]; then
+                images=$(rbd ls "$pool")
+            fi
+            for image in $images; do
+                echo "${image}@"
+                rbd snap ls "$pool/$image" | awk '"'"'NR!=1 && $2 ~ /^replication-/ {print $2}'"'"' | sed "s/^/${image}@/"
             done
         '
-))
+}
+
+echo -n "reading snap list..."
+IFS=$'\n'
+if [ -n "$catalog" ]; then
+    snap_data=($(catalog_cmd snaps "$src_location" "$src_pool"))
+    if [ "${#snap_data[@]}" = 0 ]; then
+        # nothing listed yet: list the whole pool
+        listing=($(list_remote_snaps < /dev/null))
+    else
+        # only the images that need listing again, if any
+        unlisted=($(catalog_cmd unlisted "$src_location" "$src_pool"))
+        listing=()
+        if [ "${#unlisted[@]}" != 0 ]; then
+            listing=($(printf "%s\n" "${unlisted[@]}" | list_remote_snaps))
+        fi
+    fi
+    if [ "${#listing[@]}" != 0 ]; then
+        printf "%s\n" "${listing[@]}" | catalog_cmd fill "$src_location" "$src_pool"
+        snap_data=($(catalog_cmd snaps "$src_location" "$src_pool"))
+    fi
+else
+    snap_data=($(list_remote_snaps < /dev/null))
+fi
 echo "done"
 
+# what the backup has, from the catalog, as "destination index:image@snap" keys; images the catalog has no data
+# for are checked in the directory or listed in the pool (once per image) instead
+declare -A backup_snaps backup_images
+if [ -n "$catalog" ]; then
+    for i in "${!dest_locations[@]}"; do
+        for line in $(catalog_cmd snaps "${dest_locations[$i]}" "${dest_pools[$i]}"); do
+            backup_images["$i:${line%%@*}"]=1
+            backup_snaps["$i:$line"]=1
+        done
+    done
+fi
+
+# lists the snaps of an image in a backup pool into backup_snaps, unless the catalog did; the listing is kept in
+# backup_listing, to fill the catalog with
+backup_listing=()
+list_backup_pool() {
+    local i="$1" image="$2" snap
+    if [ -n "${backup_images["$i:$image"]}" ]; then
+        return
+    fi
+    backup_images["$i:$image"]=1
+    backup_listing+=("$i:${image}@")
+    for snap in $(rbd snap ls "${dest_pools[$i]}/${image}" | awk 'NR!=1{print $2}'); do
+        backup_snaps["$i:${image}@${snap}"]=1
+        backup_listing+=("$i:${image}@${snap}")
+    done
+}
+
+# whether destination i has the snap of the image; sets found to where
+has_backup() {
+    local i="$1" image="$2" snap="$3"
+    local directory="${dest_directories[$i]}"
+    if [ -n "$directory" ]; then
+        if [ -n "${backup_images["$i:$image"]}" ] && [ -z "${backup_snaps["$i:${image}@${snap}"]}" ]; then
+            return 1
+        fi
+        # the file is checked even if the catalog has it, since this one is kept instead of the others; the diff
+        # may be stored compressed (ceph_repl.py --compress-at-rest)
+        for f in "${directory}/${dest_pools[$i]}/${image}/${snap}"{,.lz4,.zst,.rbdx}; do
+            if [ -e "$f" ]; then
+                found="$f"
+                return 0
+            fi
+        done
+        return 1
+    fi
+    list_backup_pool "$i" "$image"
+    if [ -n "${backup_snaps["$i:${image}@${snap}"]}" ]; then
+        found="${dest_locations[$i]} ${dest_pools[$i]}/${image}@${snap}"
+        return 0
+    fi
+    return 1
+}
+
 list_images(){
     printf "%s\n" "${snap_data[@]}" | awk -F@ '{print $1}' | uniq
 }
 list_snaps(){
     local image="$1"
-    printf "%s\n" "${snap_data[@]}" | grep -E "^${image}@" | awk -F@ '{print $2}'
+    printf "%s\n" "${snap_data[@]}" | grep -F "${image}@" | awk -F@ '$1 == "'"$image"'" && $2 != "" {print $2}'
 }
 
 (
@@ -56,51 +166,78 @@ if [ "$dryrun" != 1 ] && ! flock -n 9; then
     exit 1
 fi
 
+removals=()
 for image in $(list_images); do
     log_debug "image = $image"
-    
-    # look for the newest remote snap that has a local copy, which we plan to keep, and remove others
-    remote_local_match=
-    for snap in $(list_snaps "$image" | sort -r); do
-        log_debug "    remote = ${image}@${snap}... "
-        if [ -e "/data/ceph-repl/proxmox/${image}/${snap}" ]; then
-            log_debug " local found: /data/ceph-repl/proxmox/${image}/${snap}"
-            remote_local_match="$snap"
-            break
-        elif rbd snap ls backup-ceph-proxmox/${image} | awk 'NR!=1{print $2}' | grep -q "$snap"; then
-            log_debug " local found: backup-ceph-proxmox/${image}@${snap}"
-            remote_local_match="$snap"
-            break
-        else
-            log_debug " local not found"
-        fi
+    snaps=($(list_snaps "$image" | sort -r))
+
+    # look for the newest remote snap that each destination has a copy of, which we plan to keep (the next run
+    # to that destination starts from it), and remove others
+    keep=()
+    for i in "${!dest_locations[@]}"; do
+        for snap in "${snaps[@]}"; do
+            log_debug "    remote = ${image}@${snap}... "
+            if has_backup "$i" "$image" "$snap"; then
+                log_debug " local found: $found"
+                keep+=("$snap")
+                break
+            else
+                log_debug " local not found"
+            fi
+        done
     done
-    
-    # build a list of non-matching remote snaps which we plan to remove; this excludes the one found above
-    # this assumes you want to keep only one remote snap, and remove all others, older or newer than backup
+
+    # build a list of non-matching remote snaps which we plan to remove; this excludes the ones found above
+    # this assumes you want to keep only one remote snap per destination, and remove all others, older or newer
+    # than backup
     list=()
-    for snap in $(list_snaps "$image" | sort -r); do
-        if [ "$snap" = "$remote_local_match" ]; then
+    for snap in "${snaps[@]}"; do
+        if printf "%s\n" "${keep[@]}" | grep -qxF "$snap"; then
+            continue
+        fi
+        resuming=
+        for directory in "${dest_directories[@]}"; do
+            if [ -n "$directory" ] && [ -e "${directory}/${src_pool}/${image}/.${snap}.tmp.checkpoint" ]; then
+                resuming=1
+            fi
+        done
+        if [ -n "$resuming" ]; then
+            # an interrupted transfer that ceph_repl.py will resume from this snap
+            log_debug "    keeping ${image}@${snap} for resuming"
             continue
         fi
         echo "    removing ${image}@${snap}"
         list+=("$snap")
     done
-    
+
     if [ "${#list[@]}" = 0 ]; then
         continue
     fi
 
-    # do the actual removal
     if [ "$dryrun" = 1 ]; then
         echo "echo DRY RUN not removing list = ${list[@]}"
     else
-        echo "${list[@]}" | ssh ceph1 "
-            for x in $(cat); do
-                rbd snap rm "proxmox/${image}@\${x}"
-            done
-            "
+        for snap in "${list[@]}"; do
+            removals+=("${image}@${snap}")
+        done
     fi
 done
-) 9>/var/run/ceph_repl.lock
 
+if [ -n "$catalog" ] && [ "${#backup_listing[@]}" != 0 ]; then
+    for i in "${!dest_locations[@]}"; do
+        printf "%s\n" "${backup_listing[@]}" | sed -n "s/^$i://p" | catalog_cmd fill "${dest_locations[$i]}" "${dest_pools[$i]}"
+    done
+fi
+
+# do the actual removal, for all the images together: in batches per image over one ssh connection each,
+# several images at a time, and paced by the snap trimming on the cluster; they are removed from the
+# catalog too
+if [ "${#removals[@]}" != 0 ]; then
+    catalog_args=()
+    if [ -n "$catalog" ]; then
+        catalog_args=(--catalog "$catalog" --location "$src_location")
+    fi
+    printf "%s\n" "${removals[@]}" | "$here"/ceph_rbd_snap_rm.py --host "$src_host" --pool "$src_pool" \
+        "${catalog_args[@]}"
+fi
+) 9>/var/run/ceph_repl.lock
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+#
+# compression codecs for replication streams and for diff files stored compressed at rest.
+#
+# A codec is only a pair of filter commands (stdin -> stdout), so the compressing side can run on
+# the far end of an ssh connection, and python never has to touch the data.
+
+import contextlib
+import io
+import os
+import re
+import subprocess
+import sys
+
+import ceph_rbd_diff_container
+
+
+class Codec:
+    def __init__(self, name, suffix, levels, default_level, auto_max_level, level=None, threads=None):
+        self.name = name
+        # file name suffix used when a diff is stored compressed
+        self.suffix = suffix
+        self.levels = levels
+        self.default_level = default_level
+        # highest level benchmark_command() tries; the slow levels are never worth it for a stream
+        self.auto_max_level = auto_max_level
+        self.level = level
+        self.threads = threads
+
+    def get_level(self):
+        if self.level is None:
+            return self.default_level
+        return self.level
+
+    def compress_command(self):
+        if self.name == "lz4":
+            return ["lz4", "-q", "-%s" % self.get_level(), "-c"]
+        ret = ["zstd", "-q", "-%s" % self.get_level(), "-c"]
+        if self.threads is not None:
+            ret += ["-T%s" % self.threads]
+        return ret
+
+    def decompress_command(self):
+        return [self.name, "-q", "-d", "-c"]
+
+    # runs the codec's built in benchmark on synthetic data; see parse_benchmark()
+    def benchmark_command(self):
+        ret = [self.name, "-q", "-i1", "-b%s" % self.levels[0], "-e%s" % self.auto_max_level]
+        if self.name == "zstd" and self.threads is not None:
+            ret += ["-T%s" % self.threads]
+        return ret
+
+    def __str__(self):
+        if self.name == "zstd" and self.threads is not None:
+            return "%s level %s threads %s" % (self.name, self.get_level(), self.threads)
+        return "%s level %s" % (self.name, self.get_level())
+
+
+# Diff files can also be stored as indexed containers (see ceph_rbd_diff_container.py, ceph_repl.py --container).
+# Those are only for files at rest, not for the stream. Merges and snap_file_reader() read them in process, through
+# the index where that helps; the filter commands are for the rest (eg. rbd merge-diff), which needs the v1 stream.
+class ContainerCodec(Codec):
+    def __init__(self, level=None):
+        Codec.__init__(self, "rbdx", container_suffix, list(range(0, 10)), 1, 1, level)
+
+    def container_command(self):
+        return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ceph_rbd_diff_container.py")]
+
+    def compress_command(self):
+        return self.container_command() + ["pack", "--level", str(self.get_level())]
+
+    def decompress_command(self):
+        return self.container_command() + ["export"]
+
+
+container_suffix = ".rbdx"
+
+# name -> (suffix, levels, default level, highest level to benchmark)
+# zstd levels above 19 need --ultra and a lot of memory, so they are left out.
+codec_table = {
+    "lz4": (".lz4", list(range(1, 13)), 1, 9),
+    "zstd": (".zst", list(range(1, 20)), 3, 12),
+}
+
+codec_names = ["none"] + sorted(codec_table)
+
+
+# returns a Codec, or None for "none"
+def get_codec(name, level=None, threads=None):
+    if name == "none":
+        return None
+    if name not in codec_table:
+        raise Exception("unknown compression codec \"%s\", expected one of %s" % (name, ", ".join(codec_names)))
+
+    suffix, levels, default_level, auto_max_level = codec_table[name]
+    if level is not None and level not in levels:
+        raise Exception("compression level %s out of range for %s (%s-%s)" % (level, name, levels[0], levels[-1]))
+    return Codec(name, suffix, levels, default_level, auto_max_level, level, threads)
+
+
+# returns the Codec a stored diff file was compressed with, based on its name, or None if it is not compressed
+def codec_for_file(path):
+    if path.endswith(container_suffix):
+        return ContainerCodec()
+    for name in codec_table:
+        if path.endswith(codec_table[name][0]):
+            return get_codec(name)
+    return None
+
+
+# returns the snapshot name for a stored diff file name, without any compression suffix
+def strip_suffix(name):
+    codec = codec_for_file(name)
+    if codec:
+        return name[0:-len(codec.suffix)]
+    return name
+
+
+# the names a stored diff file for snap_name can have: plain, compressed with each codec, or a container
+def snap_file_names(snap_name):
+    return [snap_name] + [snap_name + codec_table[name][0] for name in codec_table] + [snap_name + container_suffix]
+
+
+# returns the path of the stored diff file for snap_name in dirname, compressed or not, or None if there is none
+def find_snap_file(dirname, snap_name):
+    path = os.path.join(dirname, snap_name)
+    if os.path.exists(path):
+        return path
+    for suffix in [codec_table[name][0] for name in codec_table] + [container_suffix]:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return None
+
+
+# opens a stored diff file for reading, decompressing it on the fly if needed, eg.
+#     with snap_file_reader(path) as f:
+#         header = f.read(12)
+# reading only part of a compressed file is fine; the decompressor is killed when done
+@contextlib.contextmanager
+def snap_file_reader(path):
+    codec = codec_for_file(path)
+    if not codec:
+        with open(path, "rb") as f:
+            yield f
+        return
+    if path.endswith(container_suffix):
+        # read here, without running the export command
+        with open(path, "rb") as f:
+            yield io.BufferedReader(ceph_rbd_diff_container.ContainerStream(f), 1024*1024)
+        return
+
+    p = subprocess.Popen(codec.decompress_command() + [path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        yield p.stdout
+    finally:
+        p.stdout.close()
+        p.kill()
+        p.wait()
+
+
+# compresses or decompresses infile into outfile with the filter command pargs
+def filter_file(pargs, infile, outfile):
+    with open(infile, "rb") as fin, open(outfile, "wb") as fout:
+        p = subprocess.Popen(pargs, stdin=fin, stdout=fout, stderr=subprocess.PIPE)
+        err = p.communicate()[1]
+    if p.returncode != 0:
+        raise Exception("\"%s\" failed for \"%s\":\n%s" % (" ".join(pargs), infile, err.decode("utf-8")))
+
+
+# parses the output of benchmark_command()
+# returns a list of (level, ratio, compression speed in bytes/s)
+#
+# newer versions print "-3      2988763 (3.346)  97.70 MB/s  413.4 MB/s  Lorem ipsum"
+# older versions print " 3#Synthetic 50%     :  10000000 ->   4560720 (2.193),  49.9 MB/s ,2416.9 MB/s"
+benchmark_line_re = re.compile(r"^\s*-?(\d+)(?:#[^(]*|\s+\d+\s+)\(x?([\d.]+)\),?\s+([\d.]+)\s*MB/s")
+
+def parse_benchmark(output):
+    ret = []
+    for line in output.replace("\r", "\n").splitlines():
+        m = benchmark_line_re.match(line)
+        if m:
+            ret += [(int(m.group(1)), float(m.group(2)), float(m.group(3))*1000*1000)]
+    return ret
+
+
+# picks the level that gets the most uncompressed data through per second, given the link speed in bytes/s
+#
+# The stream goes as fast as the slower of compression and the link; the link carries compressed bytes,
+# so its speed counts ratio times. On a tie (everything faster than the link), prefer the better ratio.
+def pick_level(benchmarks, link_speed):
+    best = None
+    best_key = None
+    for level, ratio, speed in benchmarks:
+        key = (min(speed, link_speed * ratio), ratio)
+        if best_key is None or key > best_key:
+            best = level
+            best_key = key
+    return best
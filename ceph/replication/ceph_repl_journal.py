@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# summarizes the run journal written by ceph_repl.py (--journal): where the time of the last run went,
+# the slowest images, throughput per run, and images that got a lot slower than they used to be
+
+import argparse
+import collections
+import datetime
+import json
+import statistics
+
+from ceph_repl_util import format_bytes
+
+PHASES = ["snapshot_time", "metadata_time", "stream_time"]
+
+
+# returns the journal entries grouped by run, oldest run first, as a list of (run, entries)
+def load_runs(path):
+    runs = collections.OrderedDict()
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # eg. the last line of a run that was killed while writing
+                continue
+            runs.setdefault(entry.get("run"), []).append(entry)
+    return sorted(runs.items(), key=lambda item: item[0] or 0)
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def format_rate(entry):
+    if entry.get("mb_per_s") is None:
+        return "-"
+    return "%.1fMB/s" % entry["mb_per_s"]
+
+
+# MB/s of the streams of a run as a whole
+def run_rate(entries):
+    done = [e for e in entries if e["outcome"] == "ok" and e.get("stream_time")]
+    total = sum([e["bytes"] for e in done])
+    stream_time = sum([e["stream_time"] for e in done])
+    if not stream_time:
+        return None
+    return total / stream_time / 1000 / 1000
+
+
+def print_last_run(run, entries):
+    outcomes = collections.Counter([e["outcome"] for e in entries])
+    start = min([e["start"] for e in entries])
+    end = max([e["start"] + e["wall_time"] for e in entries])
+    print("last run %s: %s images (%s), %s in %s" % (format_time(run or start), len(entries),
+        ", ".join(["%s %s" % (count, outcome) for outcome, count in sorted(outcomes.items())]),
+        format_bytes(sum([e["bytes"] for e in entries])), format_duration(end - start)))
+
+    # in pipelined mode the snapshot and metadata phases overlap the previous stream, so these can add up
+    # to more than the wall time
+    phases = ["%s %s" % (phase.replace("_time", ""), format_duration(sum([e.get(phase) or 0 for e in entries])))
+        for phase in PHASES]
+    print("    time in phases: %s" % ", ".join(phases))
+
+    ratios = [e["compression_ratio"] for e in entries if e.get("compression_ratio")]
+    if ratios:
+        print("    compression ratio: median %.2f" % statistics.median(ratios))
+    for e in entries:
+        if e["outcome"] == "failed":
+            error = (e.get("error") or "").strip().splitlines()
+            print("    failed: %s: %s" % (e["image"], error[0] if error else "unknown error"))
+
+
+def print_slowest(entries, top):
+    print()
+    print("slowest images in the last run:")
+    done = [e for e in entries if e["outcome"] in ("ok", "failed")]
+    for e in sorted(done, key=lambda e: -e["wall_time"])[0:top]:
+        print("    %-40s %10s %10s  %-10s snapshot %s, metadata %s, stream %s%s" % (e["image"],
+            format_duration(e["wall_time"]), format_bytes(e["bytes"]), format_rate(e),
+            format_duration(e.get("snapshot_time") or 0), format_duration(e.get("metadata_time") or 0),
+            format_duration(e.get("stream_time") or 0), "" if e["outcome"] == "ok" else " (failed)"))
+
+
+def print_trend(runs):
+    print()
+    print("throughput per run:")
+    for run, entries in runs:
+        rate = run_rate(entries)
+        ok = len([e for e in entries if e["outcome"] == "ok"])
+        print("    %s  %4s ok of %4s  %10s  %s" % (format_time(run or entries[0]["start"]), ok, len(entries),
+            format_bytes(sum([e["bytes"] for e in entries])), "-" if rate is None else "%.1fMB/s" % rate))
+
+
+# images whose throughput in the last run is below factor times their median in the runs before
+# small streams are left out, since their rate is mostly per-image overhead
+def find_regressions(runs, factor, min_bytes, min_history=3):
+    last_run, last_entries = runs[-1]
+    previous = collections.defaultdict(list)
+    for run, entries in runs[0:-1]:
+        for e in entries:
+            if e["outcome"] == "ok" and e.get("mb_per_s") and e["bytes"] >= min_bytes:
+                previous[e["image"]] += [e["mb_per_s"]]
+
+    ret = []
+    for e in last_entries:
+        if e["outcome"] != "ok" or not e.get("mb_per_s") or e["bytes"] < min_bytes:
+            continue
+        rates = previous.get(e["image"], [])
+        if len(rates) < min_history:
+            continue
+        median = statistics.median(rates)
+        if e["mb_per_s"] < median * factor:
+            ret += [(e, median)]
+    return ret
+
+
+def print_regressions(regressions, factor):
+    print()
+    if not regressions:
+        print("no images slower than %s times their usual throughput" % factor)
+        return
+    print("images slower than %s times their usual throughput:" % factor)
+    for e, median in regressions:
+        print("    %-40s %s, usually %.1fMB/s" % (e["image"], format_rate(e), median))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the ceph_repl.py run journal.")
+    parser.add_argument('journal',
+                    help="journal file, as given to ceph_repl.py --journal")
+    parser.add_argument('--top', dest='top', action='store',
+                    type=int, default=10,
+                    help="how many of the slowest images to show (default 10)")
+    parser.add_argument('--runs', dest='runs', action='store',
+                    type=int, default=14,
+                    help="how many runs to show and compare to (default 14)")
+    parser.add_argument('--regression-factor', dest='regression_factor', action='store',
+                    type=float, default=0.5,
+                    help="report images whose throughput dropped below this fraction of their median (default 0.5)")
+    parser.add_argument('--min-bytes', dest='min_bytes', action='store',
+                    type=int, default=100*1000*1000,
+                    help="ignore streams smaller than this for regressions (default 100000000)")
+    args = parser.parse_args()
+
+    runs = load_runs(args.journal)
+    if not runs:
+        print("no runs in %s" % args.journal)
+        exit(0)
+    runs = runs[-args.runs:]
+
+    last_run, last_entries = runs[-1]
+    print_last_run(last_run, last_entries)
+    print_slowest(last_entries, args.top)
+    print_trend(runs)
+    print_regressions(find_regressions(runs, args.regression_factor, args.min_bytes), args.regression_factor)
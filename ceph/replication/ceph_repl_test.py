@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+#
+# checks the parts of ceph_repl.py that don't need a cluster, eg. writing a diff file with the observers that
+# make it resumable (Checkpoint, FileDigest)
+#
+#     python3 -m unittest ceph_repl_test
+
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import ceph_repl
+import ceph_rbd_diff
+import ceph_repl_compression
+import ceph_snaprotator_bench
+
+BLOCK = ceph_snaprotator_bench.BLOCK
+
+# ceph_repl.py sets this from --debug when run as a script
+ceph_repl.debug = False
+
+MISSING = object()
+
+
+# writes a diff of about size bytes to path, with extents of odd sizes so records don't line up with blocks;
+# returns its bytes
+def write_diff(path, size, seed):
+    rng = random.Random(seed)
+    data = ceph_snaprotator_bench.DataSource(rng)
+    extents = []
+    offset = 0
+    written = 0
+    while written < size:
+        length = rng.choice([BLOCK, 3 * BLOCK, 64 * BLOCK]) + rng.randrange(1, 512)
+        zero = rng.random() < 0.1
+        extents += [(offset, length, zero)]
+        if not zero:
+            written += length
+        offset += length + BLOCK
+    ceph_snaprotator_bench.write_diff(path, None, "replication-1", offset, extents, data)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class ReplTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="ceph_repl_test.")
+        self.saved = {}
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            if value is MISSING:
+                delattr(ceph_repl, name)
+            else:
+                setattr(ceph_repl, name, value)
+        shutil.rmtree(self.dir)
+
+    # sets a module global of ceph_repl for this test; some are only set by the script's main code
+    def patch(self, name, value):
+        if name not in self.saved:
+            self.saved[name] = getattr(ceph_repl, name, MISSING)
+        setattr(ceph_repl, name, value)
+
+
+# a clock for the module's time.time() and time.sleep(), so waiting takes no time
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += [seconds]
+        self.now += seconds
+
+
+class ThrottleTest(ReplTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        self.patch("time", self.clock)
+
+    def test_schedule(self):
+        throttle = ceph_repl.Throttle("10M,08:00-18:00=1M,22:00-06:00=50M")
+        self.assertEqual(throttle.get_rate(datetime.datetime(2026, 1, 1, 12, 0)), 1000*1000)
+        self.assertEqual(throttle.get_rate(datetime.datetime(2026, 1, 1, 18, 0)), 10*1000*1000)
+        # a window across midnight
+        self.assertEqual(throttle.get_rate(datetime.datetime(2026, 1, 1, 23, 30)), 50*1000*1000)
+        self.assertEqual(throttle.get_rate(datetime.datetime(2026, 1, 1, 5, 59)), 50*1000*1000)
+        self.assertEqual(ceph_repl.Throttle("").get_rate(datetime.datetime(2026, 1, 1, 12, 0)), 0)
+
+    def test_rate(self):
+        throttle = ceph_repl.Throttle("1M")
+        for i in range(10):
+            throttle.consume(500*1000)
+        # 5MB at 1MB/s; the bucket starts empty
+        self.assertAlmostEqual(sum(self.clock.slept), 5.0, places=3)
+
+    def test_burst_is_one_second(self):
+        throttle = ceph_repl.Throttle("1M")
+        self.clock.now += 3600
+        throttle.consume(3*1000*1000)
+        # an hour idle saves up one second's worth, not an hour's
+        self.assertAlmostEqual(sum(self.clock.slept), 2.0, places=3)
+
+    def test_unlimited(self):
+        throttle = ceph_repl.Throttle("0")
+        throttle.consume(10**12)
+        self.assertEqual(self.clock.slept, [])
+
+    def test_health_pause(self):
+        states = ["HEALTH_ERR", "HEALTH_ERR", "HEALTH_OK"]
+        self.patch("get_health", lambda: states.pop(0))
+        throttle = ceph_repl.Throttle("1M", pause_health=["HEALTH_ERR"], health_interval=30)
+        throttle.consume(1000*1000)
+        self.assertEqual(states, [])
+        # two checks found it in error, each followed by a wait; the pause doesn't count as saved up bandwidth
+        self.assertEqual(self.clock.slept[0:2], [30, 30])
+        self.assertAlmostEqual(sum(self.clock.slept[2:]), 1.0, places=3)
+        # not checked again until health_interval has passed
+        self.patch("get_health", lambda: self.fail("checked health too soon"))
+        throttle.consume(1)
+
+
+class DirectIOTest(ReplTestCase):
+    # the observers pread the file while the copy is going on, which O_DIRECT would refuse
+    def test_checkpoints_with_direct_io(self):
+        self.patch("CHECKPOINT_INTERVAL", 256*1024)
+        diff = write_diff(os.path.join(self.dir, "source"), 3*1024*1024, 1)
+        checkpoint_path = os.path.join(self.dir, "out.checkpoint")
+        with open(os.path.join(self.dir, "out"), "w+b") as f:
+            checkpoint = ceph_repl.Checkpoint(checkpoint_path, f, None, "replication-1")
+            digest = ceph_repl.FileDigest(f)
+            total = ceph_repl.copy_stream_direct(io.BytesIO(diff), f, 0, None, [checkpoint, digest])
+            digest.update(total)
+            self.assertEqual(total, len(diff))
+            f.seek(0)
+            self.assertEqual(f.read(), diff)
+
+        with open(checkpoint_path) as f:
+            saved = json.load(f)
+        self.assertTrue(0 < saved["offset"] < len(diff))
+        with open(os.path.join(self.dir, "source"), "rb") as f:
+            self.assertEqual(digest.result(), ceph_rbd_diff.digest_stream(f))
+
+
+class ResumeTest(ReplTestCase):
+    def setUp(self):
+        super().setUp()
+        self.source = os.path.join(self.dir, "source")
+        self.diff = write_diff(self.source, 2*1024*1024, 2)
+        self.tmp = os.path.join(self.dir, ".replication-1.tmp")
+        self.checkpoint_path = self.tmp + ".checkpoint"
+
+    # what an interrupted transfer leaves: the first cut bytes of the diff, and a checkpoint of them; returns
+    # the saved offset
+    def interrupt(self, cut):
+        with open(self.tmp, "w+b") as f:
+            checkpoint = ceph_repl.Checkpoint(self.checkpoint_path, f, None, "replication-1")
+            f.write(self.diff[0:cut])
+            checkpoint.save()
+        return ceph_repl.read_checkpoint(self.checkpoint_path)["offset"]
+
+    # does what repl_to_directory does to resume at offset, with tail_arg as the argument for tail -c; returns
+    # the Checkpoint and the number of bytes copied
+    def resume(self, offset, tail_arg):
+        p = subprocess.Popen(["tail", "-c", tail_arg, self.source], stdout=subprocess.PIPE)
+        with p.stdout, open(self.tmp, "r+b") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            checkpoint = ceph_repl.Checkpoint(self.checkpoint_path, f, None, "replication-1", offset)
+            total = ceph_repl.copy_stream(p.stdout, f, None, [checkpoint])
+            f.flush()
+            checkpoint.scanner.scan(offset + total)
+        self.assertEqual(p.wait(), 0)
+        return checkpoint, total
+
+    def test_checkpoint_is_at_a_record_boundary(self):
+        cut = len(self.diff) // 2 + 7
+        offset = self.interrupt(cut)
+        self.assertTrue(0 < offset <= cut)
+        # where the scanner of the whole diff finds the last complete record before the cut
+        with open(self.source, "rb") as f:
+            scanner = ceph_rbd_diff.RecordScanner(f.fileno())
+            scanner.scan(cut)
+        self.assertEqual(offset, scanner.complete)
+
+    def test_resume(self):
+        for cut in [len(ceph_rbd_diff.HEADER) + 3, len(self.diff) // 3, len(self.diff) - 1]:
+            offset = self.interrupt(cut)
+            # tail -c +N starts at byte N, counting from 1
+            checkpoint, total = self.resume(offset, "+%s" % (offset + 1))
+            self.assertTrue(checkpoint.scanner.ended, "cut = %s" % cut)
+            self.assertEqual(checkpoint.scanner.complete, offset + total)
+            with open(self.tmp, "rb") as f:
+                self.assertEqual(f.read(), self.diff, "cut = %s" % cut)
+
+    def test_resume_at_wrong_offset_is_caught(self):
+        offset = self.interrupt(len(self.diff) // 2)
+        # one byte early: the last byte before the checkpoint is repeated
+        try:
+            checkpoint, total = self.resume(offset, "+%s" % offset)
+        except Exception:
+            return
+        self.assertFalse(checkpoint.scanner.ended and checkpoint.scanner.complete == offset + total)
+
+
+class StopStreamsTest(ReplTestCase):
+    # what repl_to_directory does when writing the file fails: an endless compressed export, decompressed
+    # through the pump thread, is stopped without leaving anything running
+    @unittest.skipUnless(shutil.which("lz4"), "needs lz4")
+    def test_stop_streams(self):
+        self.patch("codec", ceph_repl_compression.get_codec("lz4"))
+        p1 = ceph_repl.stream_popen(["sh", "-c", "yes | lz4 -q -c"], stdout=subprocess.PIPE)
+        p2, pump = ceph_repl.start_decompressor(p1, ceph_repl.Throttle("1G"))
+        self.assertTrue(p2.stdout.read(1024*1024))
+        ceph_repl.stop_streams([p1, p2], pump)
+        self.assertIsNotNone(p1.returncode)
+        self.assertIsNotNone(p2.returncode)
+        self.assertFalse(pump.is_alive())
+        p2.stdout.close()
+
+
+class FailingFile:
+    def __init__(self, fail_after):
+        self.written = 0
+        self.fail_after = fail_after
+
+    def write(self, data):
+        if self.written >= self.fail_after:
+            raise OSError(28, "No space left on device")
+        self.written += len(data)
+
+
+class TeeStreamTest(ReplTestCase):
+    # once every sink has failed, an endless source isn't read any further
+    def test_stops_when_every_sink_failed(self):
+        p = subprocess.Popen(["yes"], stdout=subprocess.PIPE)
+        try:
+            files = [FailingFile(1024*1024), FailingFile(4*1024*1024)]
+            errors = [None, None]
+            total = ceph_repl.tee_stream(p.stdout, ["first", "second"], files, errors)
+            self.assertTrue(all(errors))
+            self.assertGreaterEqual(total, files[1].written)
+        finally:
+            ceph_repl.stop_streams([p])
+            p.stdout.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+#
+# small helpers shared by ceph_repl.py and the tools around it, so the tools don't have to import all of
+# ceph_repl.py for them
+
+
+# formats a number of bytes in powers of 1000, eg. "1.5MB"
+def format_bytes(count):
+    if count >= 1000 * 1000 * 1000 * 1000:
+        return "%sTB" % (int(float(count)/1000000000)/1000)
+    if count >= 1000 * 1000 * 1000:
+        return "%sGB" % (int(float(count)/1000000)/1000)
+    if count >= 1000 * 1000:
+        return "%sMB" % (int(float(count)/1000)/1000)
+    if count >= 1000:
+        return "%skB" % (int(float(count))/1000)
+    return "%sB" % count
@@ -1,13 +1,34 @@
 #!/usr/bin/env python3
 #
-# checks that every snapshot file's from-snap exists
+# checks that every snapshot file's from-snap exists (the files may be compressed, see ceph_repl.py --compress-at-rest)
+#
+# with --verify-digests, also reads every file once and checks it against the digests saved when it was
+# written (.<snap>.digest, see ceph_repl.py); files without saved digests are only reported in --info
+#
+# with --validate, instead walks every record of every file, several files at a time (--jobs N, default the
+# number of CPUs), and checks the records (see ceph_rbd_diff.DiffChecker) and that the files of each image form
+# an unbroken chain, each starting at the snap the one before it ends at; it reports corrupt and truncated files
+# and gaps in the chains, and exits with 1 if there were any. Plain files are mmapped, so only the record headers
+# are looked at; compressed ones are decompressed on the fly. Eg.
+#     ceph_snap_check.py --validate --jobs 8 /data/ceph-repl/*/*/*
 
+import argparse
 import sys
 import os
+import mmap
+import multiprocessing
+import time
 import traceback
 
+import ceph_rbd_diff
+import ceph_repl_compression
+from ceph_repl_util import format_bytes
+
 debug = False
 info = False
+verify_digests = False
+validate = False
+jobs = os.cpu_count() or 1
 
 def log_debug(text):
     if debug:
@@ -21,12 +42,28 @@ def log_warn(text):
     print("WARN: %s" % (text))
     
 def load_files():
-    files = []
-    for file in sys.argv[1:]:
-        if ".old" in file:
-            continue
-        files += [file]
-    return files
+    global debug, info, verify_digests, validate, jobs
+    parser = argparse.ArgumentParser(description="Check stored rbd diff files and the chains they form.")
+    parser.add_argument('--debug', dest='debug', action='store_true',
+                    help='enable debug level output')
+    parser.add_argument('--info', dest='info', action='store_true',
+                    help='also report the files that are ok')
+    parser.add_argument('--verify-digests', dest='verify_digests', action='store_true',
+                    help='read every file and check it against the digests saved when it was written')
+    parser.add_argument('--validate', dest='validate', action='store_true',
+                    help='walk every record of every file, and check that the files of each image form an unbroken chain')
+    parser.add_argument('-j', '--jobs', dest='jobs', action='store',
+                    type=int, default=jobs,
+                    help='with --validate, check this many files at the same time (default the number of CPUs, %s)' % jobs)
+    parser.add_argument('files', nargs='*',
+                    help='diff files to check; names with .old in them are skipped')
+    args = parser.parse_args()
+    debug = args.debug
+    info = args.info
+    verify_digests = args.verify_digests
+    validate = args.validate
+    jobs = args.jobs
+    return [file for file in args.files if ".old" not in file]
 
 def d(bytez):
     return bytez.decode('utf8')
@@ -39,7 +76,7 @@ def dint(bytez):
     return ret
     
 def parse_diff(file):
-    with open(file, "rb") as f:
+    with ceph_repl_compression.snap_file_reader(file) as f:
         # "rbd diff v"
         x = f.read(10)
         
@@ -84,8 +121,103 @@ def parse_diff(file):
         
         return [name1, name2]
     
+# returns True if the file matches its saved digests, or has none
+def verify_digest(file):
+    saved = ceph_rbd_diff.read_digest(file)
+    if not saved:
+        log_info("%s, no saved digests" % file)
+        return True
+
+    with ceph_repl_compression.snap_file_reader(file) as f:
+        actual = ceph_rbd_diff.digest_stream(f, saved["algorithm"])
+    problems = ceph_rbd_diff.compare_digests(saved, actual)
+    for problem in problems:
+        log_warn("%s, %s" % (file, problem))
+    if not problems:
+        log_info("%s, digests ok" % file)
+    return not problems
+
+# walks every record of file; returns (file, the DiffChecker result or None, the problem or None)
+def check_file(file):
+    checker = ceph_rbd_diff.DiffChecker()
+    try:
+        if ceph_repl_compression.codec_for_file(file):
+            with ceph_repl_compression.snap_file_reader(file) as f:
+                while True:
+                    buf = f.read(1024*1024)
+                    if not buf:
+                        break
+                    checker.feed(buf)
+        elif os.path.getsize(file):
+            with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, "madvise"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(m)
+                try:
+                    checker.feed(view)
+                finally:
+                    # the mmap can't be closed while a view of it exists
+                    view.release()
+        return file, checker.result(), None
+    except Exception as e:
+        return file, None, str(e)
+
+
+# returns the problems in the chain of an image, given the results of its files sorted by name
+def check_chain(results):
+    problems = []
+    prev = None
+    for file, result in results:
+        snap_name = ceph_repl_compression.strip_suffix(os.path.basename(file))
+        if result["to_snap"] != snap_name:
+            problems += ["%s, ends at snap %s, not at its own name" % (file, result["to_snap"])]
+        if prev is None:
+            if result["from_snap"]:
+                problems += ["%s, chain starts at %s, but there is no file for it" % (file, result["from_snap"])]
+        elif result["from_snap"] != prev["to_snap"]:
+            problems += ["%s, gap in the chain: starts at %s, but the file before it ends at %s"
+                % (file, result["from_snap"], prev["to_snap"])]
+        prev = result
+    return problems
+
+
+def validate_files(files):
+    start = time.time()
+    problems = 0
+    size = 0
+    # per image directory, the (file, result) of its files
+    images = {}
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(jobs) as pool:
+        for file, result, problem in pool.imap_unordered(check_file, files, chunksize=4):
+            if problem:
+                kind = "truncated" if "incomplete" in problem else "corrupt"
+                log_warn("%s, %s: %s" % (file, kind, problem))
+                problems += 1
+                continue
+            log_info("%s, ok, %s records, %s data" % (file, result["records"], format_bytes(result["data"])))
+            size += result["size"]
+            images.setdefault(os.path.dirname(file), []).append((file, result))
+
+    for dirname in sorted(images):
+        # a file that failed leaves a gap here too, so it's reported both ways
+        for problem in check_chain(sorted(images[dirname], key=lambda item: os.path.basename(item[0]))):
+            log_warn(problem)
+            problems += 1
+
+    elapsed = time.time() - start
+    print("validated %s files, %s in %.1fs (%s/s), %s problems" % (len(files), format_bytes(size), elapsed,
+        format_bytes(int(size / elapsed) if elapsed else 0), problems))
+    return problems
+
+
 files = load_files()
 
+if validate:
+    if validate_files(files):
+        exit(1)
+    exit(0)
+
 for file in files:
     dirname = os.path.dirname(file)
     try:
@@ -95,7 +227,7 @@ for file in files:
         continue
 
     if from_snap:
-        from_exists = os.path.exists( os.path.join(dirname, from_snap) )
+        from_exists = ceph_repl_compression.find_snap_file(dirname, from_snap) != None
         if from_exists:
             fn=log_info
         else:
@@ -103,5 +235,11 @@ for file in files:
         fn("%s, from_snap = %s, exists = %s" % (file, from_snap, from_exists))
     else:
         log_info("%s, from_snap = %s, first snap" % (file, from_snap))
+
+    if verify_digests:
+        try:
+            verify_digest(file)
+        except:
+            traceback.print_exc()
     
     
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# checks ceph_rbd_diff.DiffChecker on small diffs (see ceph_rbd_diff_test.make_diff) with one thing wrong each,
+# and ceph_snap_check.py --validate on an image directory with a corrupt or missing file in its chain
+#
+#     python3 -m unittest ceph_snap_check_test
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import ceph_rbd_diff
+import ceph_rbd_diff_test
+
+K = 1024
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ceph_snap_check.py")
+
+GOOD = ("s1", "s2", 64*K, [("w", 0, b"a" * 4*K), ("z", 8*K, 8*K), ("w", 16*K, b"b" * 4*K)])
+
+
+# feeds diff to a DiffChecker a few bytes at a time, so records are split across feeds; returns its result
+def check(diff, chunk=7):
+    checker = ceph_rbd_diff.DiffChecker()
+    for pos in range(0, len(diff), chunk):
+        checker.feed(diff[pos:pos + chunk])
+    return checker.result()
+
+
+class DiffCheckerTest(unittest.TestCase):
+    def test_good(self):
+        diff = ceph_rbd_diff_test.make_diff(*GOOD)
+        self.assertEqual(check(diff), {"from_snap": "s1", "to_snap": "s2", "image_size": 64*K,
+            "records": 7, "data": 8*K, "size": len(diff)})
+        # in one piece too, as a memoryview like the mmapped files are fed
+        self.assertEqual(check(memoryview(diff), len(diff)), check(diff))
+
+    def test_truncated(self):
+        diff = ceph_rbd_diff_test.make_diff(*GOOD)
+        # without the end record, in the middle of a record header, and in the middle of a record's data
+        for cut in [len(diff) - 1, len(diff) - 4*K - 5, len(diff) - 4*K + 5]:
+            with self.assertRaisesRegex(Exception, "incomplete", msg="cut = %s" % cut):
+                check(diff[0:cut])
+
+    def test_bad_records(self):
+        cases = [
+            ("overlapping", [("w", 0, b"a" * 4*K), ("z", 2*K, 4*K)]),
+            ("out of order", [("w", 16*K, b"a" * 4*K), ("w", 0, b"b" * 4*K)]),
+            ("past the end", [("w", 62*K, b"a" * 4*K)]),
+            ("empty", [("z", 4*K, 0)]),
+        ]
+        for name, records in cases:
+            with self.assertRaises(Exception, msg=name):
+                check(ceph_rbd_diff_test.make_diff("s1", "s2", 64*K, records))
+
+    def test_extent_before_size(self):
+        diff = ceph_rbd_diff_test.make_diff(*GOOD)
+        # the size record moved after the first extent
+        start = diff.index(b"s" + (64*K).to_bytes(8, "little"))
+        size_end = start + 9
+        extent_end = size_end + 17 + 4*K
+        moved = diff[0:start] + diff[size_end:extent_end] + diff[start:size_end] + diff[extent_end:]
+        with self.assertRaisesRegex(Exception, "before the image size"):
+            check(moved)
+
+    def test_unknown_tag(self):
+        diff = ceph_rbd_diff_test.make_diff(*GOOD)
+        with self.assertRaisesRegex(Exception, "unknown diff record tag"):
+            check(diff[0:-1] + b"x")
+
+    def test_trailing_data(self):
+        with self.assertRaisesRegex(Exception, "trailing data"):
+            check(ceph_rbd_diff_test.make_diff(*GOOD) + b"e")
+
+    def test_not_a_diff(self):
+        with self.assertRaises(Exception):
+            check(b"not a diff at all")
+
+
+class ValidateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="ceph_snap_check_test.")
+        self.image_path = os.path.join(self.dir, "vm-1")
+        os.makedirs(self.image_path)
+        self.paths = []
+        prev = None
+        for i in range(1, 4):
+            name = "replication-%s" % i
+            path = os.path.join(self.image_path, name)
+            with open(path, "wb") as f:
+                f.write(ceph_rbd_diff_test.make_diff(prev, name, 64*K, [("w", i * 4*K, b"%d" % i * 4*K)]))
+            self.paths += [path]
+            prev = name
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # runs ceph_snap_check.py --validate on the files; returns its exit status and output
+    def validate(self, paths):
+        p = subprocess.run([sys.executable, SCRIPT, "--validate", "--jobs", "2"] + paths,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        return p.returncode, p.stdout
+
+    def test_good_chain(self):
+        status, output = self.validate(self.paths)
+        self.assertEqual(status, 0, output)
+        self.assertIn("validated 3 files", output)
+        self.assertIn(", 0 problems", output)
+
+    def test_truncated_file(self):
+        with open(self.paths[1], "r+b") as f:
+            f.truncate(os.path.getsize(self.paths[1]) - 1)
+        status, output = self.validate(self.paths)
+        self.assertEqual(status, 1, output)
+        self.assertIn("%s, truncated" % self.paths[1], output)
+        # and the file after it no longer follows on from anything
+        self.assertIn("%s, gap in the chain" % self.paths[2], output)
+        self.assertIn(", 2 problems", output)
+
+    def test_corrupt_file(self):
+        with open(self.paths[0], "r+b") as f:
+            f.seek(len(ceph_rbd_diff.HEADER))
+            f.write(b"x")
+        status, output = self.validate(self.paths)
+        self.assertEqual(status, 1, output)
+        self.assertIn("%s, corrupt" % self.paths[0], output)
+
+    def test_missing_first_file(self):
+        status, output = self.validate(self.paths[1:])
+        self.assertEqual(status, 1, output)
+        self.assertIn("chain starts at replication-1", output)
+
+
+if __name__ == "__main__":
+    unittest.main()
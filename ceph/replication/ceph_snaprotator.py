@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 #
-# rotates snapshots to keep only a certain number of daily,weekly,monthly ones.
+# rotates snapshots to keep only a certain number of 20 minute, hourly, daily, weekly, monthly, etc. ones.
 # the algorithm keeps the oldest snapshot in each period
-#
-# TODO: make it save a day's worth of hourly snapshots, and an hour's worth of 20min snapshots
 
 import datetime
 import subprocess
@@ -13,9 +11,49 @@ import fcntl
 import os
 import collections
 import traceback
+import contextlib
+import io
+import multiprocessing
+import signal
+import sys
+import time
 
 from dateutil.relativedelta import relativedelta
 
+import ceph_rbd_diff
+import ceph_rbd_snap_rm
+import ceph_repl_catalog
+import ceph_repl_compression
+from ceph_repl_util import format_bytes
+
+# merge with a chain of rbd merge-diff processes instead of ceph_rbd_diff.merge_diffs (--rbd-merge-diff)
+use_rbd_merge_diff = False
+
+# rbd snaps that destroy_snaps() has queued for removal, as a list of (image path, list of snap names)
+pending_removals = []
+
+# with --jobs, a semaphore shared by the worker processes that limits how many of them merge or remove snaps
+# at the same time (--io-jobs)
+io_slots = None
+
+# the snapshot catalog shared with ceph_repl.py (see ceph_repl_catalog.py), or None; it's opened in each process
+# that uses it (see open_repl_catalog), since an sqlite connection can't be shared across a fork
+repl_catalog = None
+
+# the plan cache (--plan-cache), kept as json:
+#     { "<image path>": { "spec": the --spec it was rotated with,
+#                         "ino", "mtime_ns", "ctime_ns": of the image directory when rotating found nothing to
+#                         remove } }
+# The plan depends only on the snap names (their times), not on the clock or what is in the files, so as long as
+# no entry of the directory was added, removed or renamed (and the spec didn't change), rotating it would find
+# nothing to remove again, and the image is skipped without listing it. The ctime is there because tools that
+# copy directories (rsync -t, cp -p, tar) set the mtime back, but can't set the ctime.
+plan_cache = {}
+
+# a directory changed less than this many seconds before it was listed might change again within the same ctime
+# (on filesystems with coarse timestamps), so it isn't cached; this compares our clock with the file system's
+PLAN_CACHE_MIN_AGE = 2
+
 
 def log_debug(message):
     if args.debug:
@@ -54,7 +92,8 @@ def get_snaps(image_path):
         
         ret = []
         for snap in sorted(os.listdir(image_path)):
-            if ".tmp" in snap:
+            # temp files and sidecars like .<snap>.digest
+            if ".tmp" in snap or snap.startswith("."):
                 continue
             ret += [snap]
         
@@ -75,256 +114,521 @@ def get_snaps(image_path):
 
         raise Exception("Failed to list snaps of \"%s\":\n%s" % (image_path, read_file(p.stderr)))
 
-# just list all files, and then iterate until the snap_name is found, and return next one
-def get_next_snap(image_path, snap_name):
-    found = False
-    for n in sorted(os.listdir(image_path)):
-        #log_debug("        looking at \"%s\" and \"%s\"" % (n,snap_name))
-        if ".tmp" in n:
-            continue
-        if found:
-            return n
-        if n == snap_name:
-            found = True
-    
-# for rbd, this actually destroys snaps
-# (obsolete: for files, this uses the rbd merge-diff command)
-def destroy_snap(image_path, snap_name):
-    if image_path[0:1] == "/":
-        # THIS SECTION OBSOLETE - replaced by merge_snaps(...)
-        # file/directory storage
-        snap_file = os.path.join(image_path, snap_name)
-        next_snap = get_next_snap(image_path, snap_name)
-        
-        if not next_snap:
-            # we can't merge the last file, but we don't delete it either just in case there is a bug
-            return
-        next_file = os.path.join(image_path, next_snap)
+# returns the time in a snapshot name like replication-2020-01-31T00:20:00, or a diff file named after one
+def parse_snap_time(snap):
+    snapdate_str = ceph_repl_compression.strip_suffix(snap)
+    snapdate_str = snapdate_str[snapdate_str.find("-")+1:]
+    # same format as strptime "%Y-%m-%dT%H:%M:%S", but a lot faster for thousands of snaps
+    return datetime.datetime.fromisoformat(snapdate_str)
 
-        log_debug("in destroy_snap()")
-        log_debug("    %s" % snap_file)
-        log_debug("    %s" % next_file)
-        
-        args = ["rbd", "merge-diff", snap_file, next_file, next_file+".tmp"]
 
-        log_debug("args = %s"%args)
-        log_info("merging %s and %s" % (snap_name, next_snap))
-        
-        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        if( p.returncode == 0 ):
-            os.rename(next_file+".tmp", next_file)
-            os.remove(snap_file)
-            return
+# a snapshot (rbd) or diff file (directory storage) of an image, as listed in a SnapCatalog
+class Snap:
+    def __init__(self, name, time, size=None):
+        self.name = name
+        self.time = time
+        # file size, for directory storage only
+        self.size = size
+        self.prev = None
+        self.next = None
 
-        raise Exception("Failed to merge snap \"%s\" and \"%s\":\n%s" % (snap_file, next_file, read_file(p.stderr)))
-        
-    else:
-        snap_path = image_path + "@" + snap_name
-        args = ["rbd", "snap", "rm", snap_path]
+    def __str__(self):
+        return self.name
 
-        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        if( p.returncode == 0 ):
-            return
 
-        raise Exception("Failed to destroy snap \"%s\":\n%s" % (snap_path, read_file(p.stderr)))
+# All the snaps of an image, listed once and sorted, with their times parsed and their neighbours linked,
+# so rotation can plan and group everything without listing the directory again.
+#
+# With the snapshot catalog shared with ceph_repl.py (repl_catalog), the snaps are read from there if the image
+# was listed before (see ceph_repl_catalog.py); otherwise the image is listed, and the catalog filled in.
+class SnapCatalog:
+    def __init__(self, image_path):
+        self.image_path = image_path
+        self.snaps = []
+        if image_path[0:1] == "/":
+            rows = catalog_listed_snaps(image_path)
+            if rows is not None and all([row["file"] for row in rows]):
+                for row in rows:
+                    self.snaps += [Snap(row["file"], parse_snap_time(row["file"]), row["size"])]
+            else:
+                entries = [e for e in os.scandir(image_path) if not (".tmp" in e.name or e.name.startswith("."))]
+                for entry in sorted(entries, key=lambda e: e.name):
+                    self.snaps += [Snap(entry.name, parse_snap_time(entry.name), entry.stat().st_size)]
+                catalog_listing(image_path, self.snaps)
+        else:
+            rows = catalog_listed_snaps(image_path)
+            if rows is not None:
+                names = [row["snap"] for row in rows]
+            else:
+                names = get_snaps(image_path)
+                catalog_listing(image_path, [Snap(name, None) for name in names])
+            for name in names:
+                self.snaps += [Snap(name, parse_snap_time(name))]
+
+        self.by_name = {}
+        prev = None
+        for snap in self.snaps:
+            self.by_name[snap.name] = snap
+            snap.prev = prev
+            if prev:
+                prev.next = snap
+            prev = snap
+
+    def __len__(self):
+        return len(self.snaps)
+
+    def __iter__(self):
+        return iter(self.snaps)
+
+    def names(self):
+        return [snap.name for snap in self.snaps]
+
+    # the name of the snap after snap_name, or None if it is the last one
+    def next_name(self, snap_name):
+        snap = self.by_name[snap_name].next
+        return snap.name if snap else None
+
+    # the size of the diff file of snap_name; the catalog doesn't always know it
+    def size(self, snap_name):
+        snap = self.by_name[snap_name]
+        if snap.size is None:
+            snap.size = os.path.getsize(os.path.join(self.image_path, snap_name))
+        return snap.size
+
 
 def make_merge_snaps_tmp(image_path):
     name = os.path.basename(image_path)
     path = os.path.dirname(image_path)
     return os.path.join(path, "."+name+".merge_snaps.tmp")
     
+# the merge can't read compressed files, so those are decompressed to temp files first; containers are read
+# through their index by ceph_rbd_diff.merge_diffs, so they are only unpacked for rbd merge-diff
+# returns the list of paths to merge, and the list of temp files to remove afterwards
+def decompress_group(image_path, group):
+    paths = []
+    tmp_files = []
+    for snap_name in group:
+        snap_file = os.path.join(image_path, snap_name)
+        codec = ceph_repl_compression.codec_for_file(snap_name)
+        if codec and not use_rbd_merge_diff and snap_name.endswith(ceph_repl_compression.container_suffix):
+            codec = None
+        if codec:
+            tmp_file = os.path.join(image_path, "." + snap_name + ".decompressed.tmp")
+            log_debug("decompressing %s" % snap_name)
+            tmp_files += [tmp_file]
+            ceph_repl_compression.filter_file(codec.decompress_command(), snap_file, tmp_file)
+            snap_file = tmp_file
+        paths += [snap_file]
+    return paths, tmp_files
+
 # for directory storage, merges a group of snap files together
 def merge_snaps(image_path, group, outfile=None, remove_merged=True):
     print("merging group %s into %s" % (group[0:-1], group[-1]))
 
+    tmp_files = []
+    try:
+        paths, tmp_files = decompress_group(image_path, group)
+        merge_snap_paths(image_path, group, paths, outfile, remove_merged)
+    finally:
+        for tmp_file in tmp_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+def merge_snap_paths(image_path, group, paths, outfile, remove_merged):
+    last_out = make_merge_snaps_tmp(os.path.join(image_path, group[-1]))
+    if use_rbd_merge_diff:
+        rbd_merge_diff(paths, last_out)
+    else:
+        try:
+            ceph_rbd_diff.merge_diffs(paths, last_out)
+        except:
+            if os.path.exists(last_out):
+                os.remove(last_out)
+            raise
+
+    update_digest = outfile == None
+    if outfile == None:
+        outfile = group[-1]
+    out_path = os.path.join(image_path, outfile)
+    codec = ceph_repl_compression.codec_for_file(out_path)
+    if update_digest:
+        # the old digest is for the file being replaced; a plain merged file gets a new one while
+        # it's still in the page cache
+        if codec:
+            ceph_rbd_diff.remove_digest(out_path)
+        else:
+            with open(last_out, "rb") as f:
+                ceph_rbd_diff.write_digest(out_path, ceph_rbd_diff.digest_stream(f))
+    if codec:
+        # keep the merged file compressed like the one it replaces
+        compressed_out = last_out + codec.suffix
+        try:
+            ceph_repl_compression.filter_file(codec.compress_command(), last_out, compressed_out)
+        finally:
+            os.remove(last_out)
+        last_out = compressed_out
+    os.rename(last_out, out_path)
+    if remove_merged:
+        for snap_name in group[0:-1]:
+            snap_file = os.path.join(image_path, snap_name)
+            os.remove(snap_file)
+            ceph_rbd_diff.remove_digest(snap_file)
+
+# merges the files in paths into last_out with a chain of rbd merge-diff processes, one per pair
+# (the old way; ceph_rbd_diff.merge_diffs gives the same output in one pass)
+def rbd_merge_diff(paths, last_out):
     p = None
     
-    first_snap_path = os.path.join(image_path, group[0])
-    second_snap_path = os.path.join(image_path, group[1])
-    last_out = None
-    if len(group) == 2:
-        last_out = make_merge_snaps_tmp(second_snap_path)
-        firstout = os.path.join(image_path, last_out)
+    first_snap_path = paths[0]
+    second_snap_path = paths[1]
+    if len(paths) == 2:
+        firstout = last_out
     else:
         firstout = "-"
     args = ["rbd", "merge-diff", first_snap_path, second_snap_path, firstout]
     p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
-    if len(group) > 3:
-        for snap_name in group[2:-1]:
-            snap_file = os.path.join(image_path, snap_name)
+    if len(paths) > 3:
+        for snap_file in paths[2:-1]:
             
             args = ["rbd", "merge-diff", "-", snap_file, "-"]
             p = subprocess.Popen(args, stdin=p.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    if len(group) > 2:
-        last_snap_file = os.path.join(image_path, group[-1])
-        last_out = make_merge_snaps_tmp(os.path.join(image_path, last_snap_file))
+    if len(paths) > 2:
+        last_snap_file = paths[-1]
         args = ["rbd", "merge-diff", "-", last_snap_file, last_out]
         p = subprocess.Popen(args, stdin=p.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         
     p.wait()
     if( p.returncode == 0 ):
-        if outfile == None:
-            outfile = group[-1]
-        out_path = os.path.join(image_path, outfile)
-        os.rename(last_out, out_path)
-        if remove_merged:
-            for snap_name in group[0:-1]:
-                snap_file = os.path.join(image_path, snap_name)
-                os.remove(snap_file)
         return
     raise Exception("Failed to merge snaps:\n%s" % (read_file(p.stderr)))
 
+# A group of diff files to merge: the last one is kept, and gets the merged diff of all of them.
+class MergeGroup:
+    def __init__(self, snaps):
+        self.snaps = snaps
+        self.read_bytes = 0
+        self.write_bytes = 0
+        # disk space the merge gives back: the files of the group, less the merged file
+        self.freed_bytes = 0
+        # False when the sizes are guesses
+        self.exact = True
+
+    def __str__(self):
+        return "%s into %s" % (self.snaps[0:-1], self.snaps[-1])
+
+    # Works out how many bytes the merge reads and writes. For plain files this is exact, from the record
+    # headers. Compressed files are decompressed to temp files, merged, and the result compressed again; for
+    # those the file sizes are used as a guess, and nothing is counted as freed.
+    def estimate(self, image_path, catalog):
+        size = sum([catalog.size(snap) for snap in self.snaps])
+        if any([ceph_repl_compression.codec_for_file(snap) for snap in self.snaps]):
+            self.read_bytes = size
+            self.write_bytes = size
+            self.exact = False
+        else:
+            paths = [os.path.join(image_path, snap) for snap in self.snaps]
+            self.read_bytes, self.write_bytes = ceph_rbd_diff.merge_cost(paths)
+        self.freed_bytes = max(0, size - self.write_bytes)
+
+    # disk space given back per byte of I/O; the more the diffs overwrite each other, the higher
+    def yield_ratio(self):
+        return self.freed_bytes / max(1, self.read_bytes + self.write_bytes)
+
+    def format_cost(self):
+        approx = "" if self.exact else "~"
+        return "reads %s%s, writes %s%s, frees %s%s" % (approx, format_bytes(self.read_bytes), approx,
+            format_bytes(self.write_bytes), approx, format_bytes(self.freed_bytes))
+
+
+# Returns the MergeGroups that remove the snaps (in order) from directory storage: each run of snaps to remove
+# is merged into the snap after it, since the diff of that snap must then start where the run started. So the
+# groups are fixed by what is removed; merging into any other snap would change what that snap restores to.
+def plan_merge_groups(snaps, catalog):
+    snaps_set = set(snaps)
+    groups = []
+    # the list of snaps to merge together; the last one in the list is not destroyed; other snaps merge into the last one
+    group = []
+    for snap_name in snaps:
+        # for all the snap names, we look for next snap...
+        next_snap = catalog.next_name(snap_name)
+
+        log_debug("snap_name = %s, next = %s, found = %s" % (snap_name, next_snap, next_snap in snaps_set))
+
+        group += [snap_name]
+        if next_snap in snaps_set:
+            # if the next snap is in snaps, then we join it together with that one
+            pass
+        else:
+            # if the next snap is not in snaps, we keep it separate
+            if next_snap:
+                group += [next_snap]
+            groups += [MergeGroup(group)]
+            group = []
+    return groups
+
+
 # for ceph storage, removes snaps listed in snaps
 # for directory storage, merges snaps together so that the ones listed in snaps are all gone; the original files are removed (including the one not listed that the listed ones are merged into), but a new file is made that is the merged version
-def destroy_snaps(image_path, snaps):
+# catalog is the SnapCatalog of the image, if the caller already has one; with dry_run, only the plan is printed
+def destroy_snaps(image_path, snaps, catalog=None, dry_run=False):
     if image_path[0:1] == "/":
-        # group together snaps, piping them all together in one operation
-        
         log_debug("in destroy_snaps, image_path = %s, snaps = %s" % (image_path, snaps))
-       
-        # the list of snaps to merge together; the last one in the list is not destroyed; other snaps merge into the last one
-        group = []
-        for snap_name in snaps:
-            # for all the snap names, we look for next snap...
-            snap_file = os.path.join(image_path, snap_name)
-            next_snap = get_next_snap(image_path, snap_name)
-            
-            log_debug("snap_name = %s, next = %s, found = %s" % (snap_name, next_snap, next_snap in snaps))
-            
-            group += [snap_name]
-            if next_snap in snaps:
-                # if the next snap is in snaps, then we join it together with that one
-                pass
-            else:
-                # if the next snap is not in snaps, we keep it separate
-                if next_snap:
-                    group += [next_snap]
-                try:
-                    merge_snaps(image_path, group)
-                except:
-                    log_error("failed to merge for image_path = %s, group = %s" % (image_path, group))
-                    traceback.print_exc()
-                group = []
-            
-            
+        if not catalog:
+            catalog = SnapCatalog(image_path)
+
+        # The groups don't share files, so they can be merged in any order. The merge reads every group's
+        # surviving data once and writes it once; what's left to choose is the order. The groups that free the
+        # most disk space per byte of I/O go first (diffs that overwrite the same extents), then the cheapest,
+        # so a run cut short has freed as much as it could.
+        groups = []
+        for group in plan_merge_groups(snaps, catalog):
+            try:
+                group.estimate(image_path, catalog)
+            except:
+                log_error("failed to read the diffs of image_path = %s, group = %s" % (image_path, group.snaps))
+                traceback.print_exc()
+                catalog_forget(image_path)
+                continue
+            groups += [group]
+        groups.sort(key=lambda group: (-group.yield_ratio(), group.write_bytes, group.read_bytes))
+        if groups:
+            log_info("merge plan: %s groups, %s" % (len(groups), total_cost(groups).format_cost()))
+
+        for group in groups:
+            if dry_run:
+                log_info("would merge group %s: %s" % (group, group.format_cost()))
+                continue
+            log_verbose("merging group %s: %s" % (group, group.format_cost()))
+            try:
+                with io_slot():
+                    merge_snaps(image_path, group.snaps)
+            except:
+                log_error("failed to merge for image_path = %s, group = %s" % (image_path, group.snaps))
+                traceback.print_exc()
+                # eg. a file the catalog has is gone; the next run lists the directory
+                catalog_forget(image_path)
+                continue
+            catalog_merge(image_path, group.snaps)
+
+    elif dry_run:
+        log_info("would delete %s snaps" % len(snaps))
     else:
-        for snap in snaps:
-            log_verbose("deleting snap \"%s\"" % snap)
-            destroy_snap(image_path, snap)
-    
+        # removed with the other images' snaps by remove_pending_snaps()
+        pending_removals.append((image_path, list(snaps)))
 
-class Spec:
-    def __init__(self, spec):
-        spec = args.spec.split(",")
-        self.daily = int(spec[0])
-        self.weekly = int(spec[1])
-        self.monthly = int(spec[2])
 
+# removes the rbd snaps queued by destroy_snaps(), in batches, several images at a time, paced by the
+# cluster's snap trimming (see ceph_rbd_snap_rm.py)
+def remove_pending_snaps():
+    global pending_removals
 
-def rotate(image_path, spec):
-    # datetime objects of previous snaps
-    prevdaily = None
-    prevweekly = None
-    prevmonthly = None
+    removals = pending_removals
+    pending_removals = []
+    if not removals:
+        return
+    location = ceph_repl_catalog.rbd_location(args.cluster)
+    # --rm-jobs is for the whole run, so it's shared by the workers that can be removing at the same time
+    rm_jobs = max(args.rm_jobs // (args.io_jobs or args.jobs), 1)
+    remover = ceph_rbd_snap_rm.SnapRemover(None, rm_jobs, args.rm_batch, args.max_snaptrim, repl_catalog, location)
+    with io_slot():
+        errors = remover.remove(removals)
+    if errors:
+        raise Exception("failed to remove snaps:\n%s" % "\n".join(errors))
 
-    maybekeepd=[]
-    maybekeepw=[]
-    maybekeepm=[]
 
-    daily = spec.daily
-    weekly = spec.weekly
-    monthly = spec.monthly
+def open_repl_catalog():
+    global repl_catalog
 
-    # Two passes... to ensure we don't delete old snapshots just because they're not old enough to be the oldest monthly one
-    # First pass, flag them as the monthly,weekly,daily intervals (oldest of that period)
-    log_debug("First pass... find candidates")
+    if not args.catalog or args.dry_run:
+        return
+    try:
+        repl_catalog = ceph_repl_catalog.Catalog(args.catalog)
+    except Exception as e:
+        log_error("could not open catalog %s, going on without it: %s" % (args.catalog, e))
 
-    daydelta = datetime.timedelta(days=1)
 
-    latest_snap = None
-    count_total = 0
-    for snap in get_snaps(image_path):
-        count_total += 1
-        snapdate_str = snap[snap.find("-")+1:]
+# returns the catalog key (location, pool, image) of image_path, a directory or an rbd image (pool/image)
+def catalog_key(image_path):
+    if image_path[0:1] == "/":
+        return ceph_repl_catalog.dir_key(image_path)
+    pool, image = image_path.rstrip("/").split("/", 1)
+    return ceph_repl_catalog.rbd_location(args.cluster), pool, image
 
-        snapdate = datetime.datetime.strptime(snapdate_str, "%Y-%m-%dT%H:%M:%S")
 
-        # with hour+minute+second trimmed, so it's rounded down
-        snapdate = snapdate.replace(hour=0, minute=0, second=0)
+# returns the snaps of image_path the catalog has (as dicts, oldest first), or None if it doesn't have them all
+# and the image has to be listed
+def catalog_listed_snaps(image_path):
+    if not repl_catalog:
+        return None
+    try:
+        return repl_catalog.listed_snaps(*catalog_key(image_path))
+    except Exception as e:
+        log_error("could not read catalog %s: %s" % (args.catalog, e))
+        return None
 
-        log_debug("snap = %s, snapdate = %s" % (snap, snapdate))
 
-        if not prevdaily or (snapdate - datetime.timedelta(days=1)) >= prevdaily:
-            # if this snap is at least a day before the previous "daily" snap
-            log_debug("    daily")
-            prevdaily = snapdate
-            maybekeepd += [snap]
+# records the Snaps found by listing image_path in the catalog, keeping the digests it already has
+def catalog_listing(image_path, snaps):
+    if not repl_catalog:
+        return
+    key = catalog_key(image_path)
+    try:
+        known = {}
+        for row in repl_catalog.snaps(*key):
+            known[row["snap"]] = row
+        rows = []
+        for snap in snaps:
+            name = ceph_repl_compression.strip_suffix(snap.name) if image_path[0:1] == "/" else snap.name
+            row = known.get(name) or {}
+            rows += [{"snap": name, "size": snap.size, "digest": row.get("digest"), "from_snap": row.get("from_snap"),
+                "file": snap.name if image_path[0:1] == "/" else None}]
+        repl_catalog.replace_image(key[0], key[1], key[2], rows)
+    except Exception as e:
+        log_error("could not update catalog %s: %s" % (args.catalog, e))
 
-        if not prevweekly or (snapdate - datetime.timedelta(days=7)) >= prevweekly:
-            # if this one is at least a week earlier
-            log_debug("    weekly")
-            prevweekly = snapdate
-            maybekeepw += [snap]
 
-        if not prevmonthly or (snapdate - relativedelta(months=1)) >= prevmonthly:
-            # if this one is at least a month earlier
-            log_debug("    monthly")
-            prevmonthly = snapdate
-            maybekeepm += [snap]
+def catalog_forget(image_path):
+    if not repl_catalog:
+        return
+    try:
+        repl_catalog.forget_image(*catalog_key(image_path))
+    except Exception as e:
+        log_error("could not update catalog %s: %s" % (args.catalog, e))
 
-        latest_snap = snap
-    keep = {}
 
-    log_debug("Second pass... keep only a few candidates")
+# records a merge of the diff files in group in the catalog: the merged ones are gone, and the last one was
+# rewritten (the merge wrote new digests for it, if it's not compressed)
+def catalog_merge(image_path, group):
+    if not repl_catalog:
+        return
+    location, pool, image = ceph_repl_catalog.dir_key(image_path)
+    out_path = os.path.join(image_path, group[-1])
+    digests = ceph_rbd_diff.read_digest(out_path) or {}
+    try:
+        repl_catalog.remove(location, pool, image, [ceph_repl_compression.strip_suffix(snap) for snap in group[0:-1]])
+        repl_catalog.add(location, pool, image, ceph_repl_compression.strip_suffix(group[-1]),
+            os.path.getsize(out_path), digests.get("digest"), digests.get("from_snap"), group[-1])
+    except Exception as e:
+        log_error("could not update catalog %s: %s" % (args.catalog, e))
+
+
+# a MergeGroup with the total cost of groups, for printing
+def total_cost(groups):
+    ret = MergeGroup([])
+    for group in groups:
+        ret.read_bytes += group.read_bytes
+        ret.write_bytes += group.write_bytes
+        ret.freed_bytes += group.freed_bytes
+        ret.exact = ret.exact and group.exact
+    return ret
+    
 
-    # Second pass, keep the newest few of each interval, based on limit settings
-    for idx in range(len(maybekeepd)-1, -1, -1):
-        snap = maybekeepd[idx]
-        log_debug("snap was %s" % snap)
+# minutes in the unit a tier rounds snap times down to; weekly and monthly tiers round to the day like daily
+ROUNDING = {"min": 1, "h": 60, "d": 24*60, "w": 24*60, "mo": 24*60}
 
-        if daily == 0:
-            break
 
-        # if we didn't find enough daily snapshots yet
-        log_debug("keeping %s as daily" % snap)
-        keep[snap] = "d"
-        daily -= 1
+# A retention tier, eg. "d:7": in the first pass, a snap is a candidate when it's at least a period after the
+# previous candidate (with times rounded down to the unit); then the newest count candidates are kept.
+#
+# name is the unit as written in the spec, and is what the kept snaps are labelled with.
+class Tier:
+    def __init__(self, name, unit, n, count):
+        self.name = name
+        self.unit = unit
+        self.n = n
+        self.count = count
+        self.rounding = ROUNDING[unit]
+        # the period in rounding units (months are done with relativedelta)
+        self.period = 7 * n if unit == "w" else n
+
+    # returns whether a snap whose rounded time is value starts a new period after the candidate at prev
+    def starts_period(self, value, prev):
+        if self.unit == "mo":
+            date = datetime.date.fromordinal(value) - relativedelta(months=self.n)
+            return date >= datetime.date.fromordinal(prev)
+        return value - self.period >= prev
+
+
+# The retention spec: a list of tiers, from the --spec argument.
+#
+# The old form is three counts, daily,weekly,monthly, eg. "7,4,6". The tier form is unit:count pairs, eg.
+# "20m:3,h:24,d:7,w:4,m:6", where the unit can have a number in front for longer periods ("2h", "20m"). The
+# units are h, d, w, m (month) and mo (month); with a number in front, m is minutes ("20m"), and min can be
+# written out ("20min").
+class Spec:
+    def __init__(self, spec):
+        self.tiers = []
+        if ":" not in spec:
+            for name, unit, count in zip(["d", "w", "m"], ["d", "w", "mo"], spec.split(",")):
+                self.tiers += [Tier(name, unit, 1, int(count))]
+            return
 
-    for idx in range(len(maybekeepw)-1, -1, -1):
-        snap = maybekeepw[idx]
-        log_debug("snap was %s" % snap)
+        for token in spec.split(","):
+            name, count = token.strip().split(":")
+            digits = len(name) - len(name.lstrip("0123456789"))
+            n = int(name[0:digits] or 1)
+            unit = name[digits:]
+            if unit == "m":
+                unit = "min" if digits else "mo"
+            if unit not in ROUNDING or n < 1:
+                raise Exception("unknown retention tier \"%s\" in spec \"%s\"" % (token, spec))
+            self.tiers += [Tier(name, unit, n, int(count))]
 
-        if weekly == 0:
-            break
 
-        # if we didn't find enough weekly snapshots yet
-        log_debug("keeping %s as weekly" % snap)
-        if snap in keep:
-            keep[snap] += ",w"
-        else:
-            keep[snap] = "w"
+# returns the plan cache entry for the image, if rotating it found nothing to remove, or None
+def rotate(image_path, spec):
+    # Two passes... to ensure we don't delete old snapshots just because they're not old enough to be the oldest monthly one
+    # First pass, flag the candidates of each tier (oldest of that period)
+    log_debug("First pass... find candidates")
 
-        weekly -= 1
+    # before listing, so a snap added while planning changes it
+    st = None
+    if image_path[0:1] == "/":
+        st = os.stat(image_path)
 
-    for idx in range(len(maybekeepm)-1, -1, -1):
-        snap = maybekeepm[idx]
-        log_debug("snap was %s" % snap)
+    catalog = SnapCatalog(image_path)
 
-        if monthly == 0:
-            break
+    # per tier: the rounded time of the previous candidate and of the previous snap, and the candidates
+    prev_candidate = [None] * len(spec.tiers)
+    prev_value = [None] * len(spec.tiers)
+    candidates = [[] for tier in spec.tiers]
 
-        # if we didn't find enough monthly snapshots yet
-        log_debug("keeping %s as monthly" % snap)
-        if snap in keep:
-            keep[snap] += ",m"
-        else:
-            keep[snap] = "m"
+    latest_snap = None
+    count_total = len(catalog)
+    for entry in catalog:
+        snap = entry.name
+        t = entry.time
+        minutes = t.toordinal() * 24 * 60 + t.hour * 60 + t.minute
+
+        log_debug("snap = %s, time = %s" % (snap, t))
+
+        for i, tier in enumerate(spec.tiers):
+            value = minutes // tier.rounding
+            if value == prev_value[i]:
+                # in the same rounded unit as the previous snap, which either was the candidate or wasn't far enough
+                # from it; so this one isn't either
+                continue
+            prev_value[i] = value
+            if prev_candidate[i] is None or tier.starts_period(value, prev_candidate[i]):
+                log_debug("    %s" % tier.name)
+                prev_candidate[i] = value
+                candidates[i] += [snap]
+
+        latest_snap = snap
+    keep = {}
 
-        monthly -= 1
+    log_debug("Second pass... keep only a few candidates")
+
+    # Second pass, keep the newest few of each tier, based on limit settings
+    for tier, tier_candidates in zip(spec.tiers, candidates):
+        for snap in tier_candidates[::-1][0:tier.count]:
+            log_debug("keeping %s as %s" % (snap, tier.name))
+            if snap in keep:
+                keep[snap] += "," + tier.name
+            else:
+                keep[snap] = tier.name
 
     # in addition to the time based logic, we also always keep the last snap
     if not latest_snap in keep:
@@ -342,7 +646,7 @@ def rotate(image_path, spec):
     count_keeping = 0
     count_deleting = 0
     snaps_to_destroy = []
-    for snap in get_snaps(image_path):
+    for snap in catalog.names():
         log_debug("snap = %s" % snap)
 
         if snap in keep:
@@ -350,12 +654,70 @@ def rotate(image_path, spec):
             count_keeping += 1
         else:
             log_verbose("queueing deletion of snap \"%s\"" % snap)
-            if not args.dry_run:
-                snaps_to_destroy += [snap]
+            snaps_to_destroy += [snap]
             count_deleting += 1
     log_info("keeping %s and deleting %s snapshots out of %s" %(count_keeping, count_deleting, count_total))
-    destroy_snaps(image_path, snaps_to_destroy)
-    
+    destroy_snaps(image_path, snaps_to_destroy, catalog, args.dry_run)
+
+    # after removing snaps, the next run checks whether the rest still need nothing removed
+    if st and not snaps_to_destroy and time.time() - st.st_ctime_ns / 1e9 >= PLAN_CACHE_MIN_AGE:
+        return {"spec": args.spec, "ino": st.st_ino, "mtime_ns": st.st_mtime_ns, "ctime_ns": st.st_ctime_ns}
+    return None
+
+
+def load_plan_cache():
+    global plan_cache
+
+    if not args.plan_cache:
+        return
+    try:
+        with open(args.plan_cache, "r") as f:
+            plan_cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        plan_cache = {}
+
+
+def save_plan_cache():
+    if not args.plan_cache or args.dry_run:
+        return
+    try:
+        dirname = os.path.dirname(args.plan_cache)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(args.plan_cache + ".tmp", "w") as f:
+            json.dump(plan_cache, f, indent=1, sort_keys=True)
+        os.rename(args.plan_cache + ".tmp", args.plan_cache)
+    except Exception as e:
+        log_error("could not save plan cache to %s: %s" % (args.plan_cache, e))
+
+
+# returns whether the plan cache says the image needs nothing removed
+def plan_unchanged(image_path):
+    entry = plan_cache.get(image_path)
+    if not entry or entry.get("spec") != args.spec:
+        return False
+    try:
+        st = os.stat(image_path)
+    except OSError:
+        return False
+    return [st.st_ino, st.st_mtime_ns, st.st_ctime_ns] == [entry.get("ino"), entry.get("mtime_ns"), entry.get("ctime_ns")]
+
+
+# rotates an image, unless the plan cache says it needs nothing removed; returns its plan cache entry, or None
+def rotate_cached(image_path, spec):
+    if plan_unchanged(image_path):
+        log_verbose("skipping %s, nothing changed since it last needed nothing removed" % image_path)
+        return plan_cache[image_path]
+    return rotate(image_path, spec)
+
+
+def update_plan_cache(image_path, entry):
+    if entry:
+        plan_cache[image_path] = entry
+    else:
+        plan_cache.pop(image_path, None)
+
+
 def get_images(pool):
     if pool[0:1] == "/":
         return sorted(os.listdir(pool))
@@ -373,24 +735,109 @@ def get_images(pool):
         raise Exception("Failed to get list of rbd images in pool %s:\n%s" % (pool, read_file(p.stderr)))
 
 
-def run(spec):
+# waits for a free io slot, if --jobs limits them
+@contextlib.contextmanager
+def io_slot():
+    if io_slots is None:
+        yield
+    else:
+        with io_slots:
+            yield
+
+
+def init_worker(slots):
+    global io_slots
+    io_slots = slots
+    open_repl_catalog()
+    # the parent gets ctrl+c too, and terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# rotates one image in a worker process, collecting its output so it can be printed in one piece
+# returns (image_path, output, whether it failed, plan cache entry)
+def rotate_job(job):
+    image_path, spec = job
+    out = io.StringIO()
+    failed = False
+    entry = None
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            log_info("rotating image %s" % image_path)
+            entry = rotate_cached(image_path, spec)
+            remove_pending_snaps()
+        except Exception:
+            traceback.print_exc()
+            failed = True
+            entry = None
+    return image_path, out.getvalue(), failed, entry
+
+
+# returns the image paths to rotate, with pools (trailing slash) listed
+def get_image_paths():
+    ret = []
     for image_path in args.image_paths:
         if image_path.endswith("/"):
             for image in get_images(image_path[0:-1]):
                 if image.endswith(".old"):
                     continue
-                log_info("rotating image %s" % image_path + image)
-                rotate(image_path + image, spec)
-                
+                ret += [image_path + image]
         else:
-            # an image name
-            rotate(image_path, spec)
+            ret += [image_path]
+    return ret
+
+
+# rotates args.jobs images at a time in worker processes; each image's output is printed when it's done
+def run_parallel(spec):
+    # fork, so the workers get args like the main process
+    ctx = multiprocessing.get_context("fork")
+    slots = ctx.BoundedSemaphore(args.io_jobs or args.jobs)
+    failed = []
+    with ctx.Pool(args.jobs, initializer=init_worker, initargs=(slots,)) as pool:
+        jobs = [(image_path, spec) for image_path in get_image_paths()]
+        for image_path, output, image_failed, entry in pool.imap_unordered(rotate_job, jobs):
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            update_plan_cache(image_path, entry)
+            if image_failed:
+                failed += [image_path]
+    if failed:
+        raise Exception("failed to rotate %s" % ", ".join(failed))
+
+
+def run(spec):
+    load_plan_cache()
+    try:
+        if args.jobs > 1:
+            run_parallel(spec)
+        else:
+            run_serial(spec)
+    finally:
+        save_plan_cache()
+
+
+def run_serial(spec):
+    open_repl_catalog()
+    try:
+        for image_path in args.image_paths:
+            if image_path.endswith("/"):
+                for image in get_images(image_path[0:-1]):
+                    if image.endswith(".old"):
+                        continue
+                    log_info("rotating image %s" % image_path + image)
+                    update_plan_cache(image_path + image, rotate_cached(image_path + image, spec))
+                    
+            else:
+                # an image name
+                update_plan_cache(image_path, rotate_cached(image_path, spec))
+    finally:
+        # the rbd snaps of all the images go together, so several images' snaps are removed at a time
+        remove_pending_snaps()
 
 
 if __name__ == "__main__":
     global args, spec
 
-    parser = argparse.ArgumentParser(description="Clean up old Ceph RBD snapshots, keeping only a certain number of daily,weekly,monthly ones.")
+    parser = argparse.ArgumentParser(description="Clean up old Ceph RBD snapshots, keeping only a certain number of 20 minute, hourly, daily, weekly, monthly, etc. ones.")
 
     parser.add_argument('--debug', dest='debug', action='store_const',
                     const=True, default=False,
@@ -406,11 +853,39 @@ if __name__ == "__main__":
                     help='disable locking, which means multiple instances can run at the same time (recommended only for testing or dry run)')
     parser.add_argument('-s', '--spec', action='store', 
                     default="7,4,6",
-                    help='comma separated daily, weekly, monthly counts to keep (default 7,4,6).')
+                    help='comma separated daily, weekly, monthly counts to keep (default 7,4,6), or tiers of unit:count, eg. 20m:3,h:24,d:7,w:4,m:6 (units: Nm or Nmin minutes, h, d, w, m or mo months, optionally with a number in front, eg. 2h).')
+    parser.add_argument('--rbd-merge-diff', dest='rbd_merge_diff', action='store_const',
+                    const=True, default=False,
+                    help='merge diff files with a chain of rbd merge-diff processes instead of the built-in one pass merge')
+    parser.add_argument('-j', '--jobs', dest='jobs', action='store',
+                    type=int, default=1,
+                    help='rotate this many images at the same time, each in its own process (default 1)')
+    parser.add_argument('--io-jobs', dest='io_jobs', action='store',
+                    type=int, default=None,
+                    help='with --jobs, merge or remove snaps for at most this many images at the same time (default the same as --jobs)')
+    parser.add_argument('--rm-jobs', dest='rm_jobs', action='store',
+                    type=int, default=ceph_rbd_snap_rm.JOBS,
+                    help='remove rbd snaps of this many images at the same time (default %s); with --jobs, this is divided between the workers, each getting at least 1' % ceph_rbd_snap_rm.JOBS)
+    parser.add_argument('--rm-batch', dest='rm_batch', action='store',
+                    type=int, default=ceph_rbd_snap_rm.BATCH_SIZE,
+                    help='remove up to this many rbd snaps of an image with one command (default %s)' % ceph_rbd_snap_rm.BATCH_SIZE)
+    parser.add_argument('--max-snaptrim', dest='max_snaptrim', action='store',
+                    type=int, default=ceph_rbd_snap_rm.MAX_SNAPTRIM_PGS,
+                    help='before removing more rbd snaps, wait while more PGs than this are trimming snaps; 0 to not wait (default %s)' % ceph_rbd_snap_rm.MAX_SNAPTRIM_PGS)
+    parser.add_argument('--catalog', dest='catalog', action='store',
+                    default=None,
+                    help='read snaps from and record merged and removed snaps in this snapshot catalog, the one given to ceph_repl.py --catalog (see ceph_repl_catalog.py; default none)')
+    parser.add_argument('--cluster', dest='cluster', action='store',
+                    default="ceph",
+                    help='cluster name of the rbd images in the catalog, as in the ceph_repl.py config (default ceph)')
+    parser.add_argument('--plan-cache', dest='plan_cache', action='store',
+                    default=None,
+                    help='remember which image directories needed nothing removed in this file, eg. /var/lib/ceph_repl/snaprotator_plans.json, and skip them while they don\'t change (default none)')
     parser.add_argument('image_paths', metavar='image_paths', type=str, nargs='+',
                     help='rbd image paths(s) to clean up, eg. rbd/vm-101-disk1, or pool name(s) with trailing slash, eg. rbd/')
 
     args = parser.parse_args()
+    use_rbd_merge_diff = args.rbd_merge_diff
     spec = Spec(args.spec)
 
     got_lock = False
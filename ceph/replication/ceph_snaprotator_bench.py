@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+#
+# measures what rotation costs, without a ceph cluster: writes a synthetic chain of "rbd diff v1" files for an
+# image (by default 1000 snaps over 12 months), then rotates a copy of it with each merge engine and reports the
+# wall time, the bytes read and written, and the number of processes started
+#
+#     ceph_snaprotator_bench.py --snaps 1000 --months 12 --engine native --engine rbd
+#
+# The engines are ceph_rbd_diff.merge_diffs ("native") and the old chain of rbd merge-diff processes ("rbd");
+# for that one, a stub rbd command that does the merge with ceph_rbd_diff is put in front of PATH, so it
+# doesn't need ceph either.
+#
+# The bytes are what the rotator read and wrote (rchar and wchar in /proc/self/io, so copy_file_range counts
+# too), plus what each stub rbd merge-diff read from its inputs and wrote to its output, as the real one would.
+# Whether that comes from the disk or the page cache depends on the machine; --cold flushes the copy and drops
+# it from the cache before each rotation.
+#
+# The diffs follow roughly what VM images do: the first is a full export of the allocated part of the image,
+# and each later one rewrites a few extents, mostly in a small hot region (logs, databases), some anywhere,
+# with sizes from 4kB up to 4MB (most small), and the odd discarded (zero) extent.
+
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import random
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import ceph_rbd_diff
+import ceph_snaprotator
+from ceph_repl_util import format_bytes
+
+BLOCK = 4096
+MAX_EXTENT = 4*1024*1024
+# fraction of the image that gets most of the writes, and how much of the writes
+HOT_FRACTION = 0.05
+HOT_WRITES = 0.8
+ZERO_EXTENTS = 0.03
+# the stub rbd merge-diff appends "<read> <written>" to the file named here
+STATS_ENV = "CEPH_SNAPROTATOR_BENCH_STATS"
+
+
+def parse_size(value):
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+    value = value.strip().lower().rstrip("ib")
+    if value and value[-1] in units:
+        return int(float(value[0:-1]) * units[value[-1]])
+    return int(value)
+
+
+# random data to take extents from; slicing it is a lot faster than making new random bytes for each extent
+class DataSource:
+    def __init__(self, rng):
+        self.buf = bytes(rng.getrandbits(8) for i in range(64*1024)) * (2 * MAX_EXTENT // (64*1024))
+        self.rng = rng
+
+    def get(self, length):
+        pos = self.rng.randrange(0, MAX_EXTENT) // BLOCK * BLOCK
+        return memoryview(self.buf)[pos:pos + length]
+
+
+# returns sorted, disjoint (offset, length, zero) extents that add up to about change bytes
+def make_extents(rng, image_size, hot_start, hot_size, change):
+    extents = []
+    total = 0
+    while total < change:
+        # pareto: mostly a few blocks, now and then up to MAX_EXTENT
+        length = min(MAX_EXTENT, int(rng.paretovariate(1.2)) * BLOCK)
+        if rng.random() < HOT_WRITES:
+            offset = hot_start + rng.randrange(0, max(hot_size - length, BLOCK))
+        else:
+            offset = rng.randrange(0, max(image_size - length, BLOCK))
+        offset = offset // BLOCK * BLOCK
+        length = min(length, image_size - offset)
+        extents += [(offset, length, rng.random() < ZERO_EXTENTS)]
+        total += length
+
+    # rbd export-diff gives each byte once, in order; where extents overlap, the later one wins here
+    extents.sort()
+    ret = []
+    for offset, length, zero in extents:
+        if ret and offset < ret[-1][0] + ret[-1][1]:
+            prev_offset, prev_length, prev_zero = ret[-1]
+            end = max(prev_offset + prev_length, offset + length)
+            ret[-1] = (prev_offset, end - prev_offset, zero)
+        else:
+            ret += [(offset, length, zero)]
+    return ret
+
+
+def write_diff(path, from_snap, to_snap, image_size, extents, data):
+    with open(path, "wb") as f:
+        f.write(ceph_rbd_diff.HEADER)
+        for tag, name in [(b"f", from_snap), (b"t", to_snap)]:
+            if name:
+                name = name.encode("utf-8")
+                f.write(tag + struct.pack("<I", len(name)) + name)
+        f.write(b"s" + struct.pack("<Q", image_size))
+        for offset, length, zero in extents:
+            if zero:
+                f.write(b"z" + struct.pack("<QQ", offset, length))
+                continue
+            f.write(b"w" + struct.pack("<QQ", offset, length))
+            f.write(data.get(length))
+        f.write(b"e")
+
+
+# writes the diff chain of an image to image_path, one file per snap, named like ceph_repl.py names them;
+# returns the total size
+def generate_chain(image_path, snaps, months, image_size, base, change, seed):
+    rng = random.Random(seed)
+    data = DataSource(rng)
+    os.makedirs(image_path)
+
+    end = datetime.datetime(2020, 1, 1) + datetime.timedelta(days=30 * months)
+    interval = datetime.timedelta(days=30 * months) / snaps
+    hot_size = max(int(image_size * HOT_FRACTION) // BLOCK * BLOCK, BLOCK)
+    hot_start = rng.randrange(0, image_size - hot_size + 1) // BLOCK * BLOCK
+
+    total = 0
+    prev = None
+    for i in range(snaps):
+        # snaps are made on a schedule, but take a varying time to get to
+        t = end - interval * (snaps - i) + datetime.timedelta(seconds=rng.randrange(0, 600))
+        name = "replication-%s" % t.strftime("%Y-%m-%dT%H:%M:%S")
+        if prev is None:
+            # the allocated part of the image, in whole objects
+            extents = [(offset, min(MAX_EXTENT, image_size - offset), False)
+                for offset in range(0, min(base, image_size), MAX_EXTENT)]
+        else:
+            extents = make_extents(rng, image_size, hot_start, hot_size, rng.lognormvariate(0, 1) * change)
+        path = os.path.join(image_path, name)
+        write_diff(path, prev, name, image_size, extents, data)
+        total += os.path.getsize(path)
+        prev = name
+    return total
+
+
+def read_proc_io():
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+# flushes the files in image_path and drops them from the page cache, so the rotation reads them from disk
+def drop_cache(image_path):
+    for entry in os.scandir(image_path):
+        fd = os.open(entry.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+# counts the processes the rotator starts
+class CountingPopen(subprocess.Popen):
+    count = 0
+
+    def __init__(self, *pargs, **kwargs):
+        CountingPopen.count += 1
+        super().__init__(*pargs, **kwargs)
+
+
+# makes a bin directory with an rbd command that runs this script as the stub
+def make_stub_bin(tmp_dir):
+    bin_dir = os.path.join(tmp_dir, "bin")
+    os.makedirs(bin_dir)
+    rbd = os.path.join(bin_dir, "rbd")
+    with open(rbd, "w") as f:
+        f.write("#!/bin/sh\nexec %s --rbd-stub \"$@\"\n" % " ".join(shlex.quote(arg) for arg in [sys.executable, os.path.abspath(__file__)]))
+    os.chmod(rbd, 0o755)
+    return bin_dir
+
+
+# the stub: "rbd merge-diff first second out", where first and out can be "-"; the stdin diff is spooled to a
+# temp file first (ceph_rbd_diff.merge_diffs needs to seek), but only the stream is counted
+def rbd_stub(pargs):
+    if pargs[0:1] != ["merge-diff"] or len(pargs) != 4:
+        sys.stderr.write("the benchmark stub only does rbd merge-diff FIRST SECOND OUT\n")
+        return 1
+    first, second, out = pargs[1:]
+    tmp_dir = os.path.dirname(os.path.abspath(second))
+    tmp_files = []
+    try:
+        if first == "-":
+            fd, first = tempfile.mkstemp(dir=tmp_dir, prefix=".bench-in-")
+            tmp_files += [first]
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(sys.stdin.buffer, f, 1024*1024)
+        out_path = out
+        if out == "-":
+            fd, out_path = tempfile.mkstemp(dir=tmp_dir, prefix=".bench-out-")
+            os.close(fd)
+            tmp_files += [out_path]
+        ceph_rbd_diff.merge_diffs([first, second], out_path)
+        read = os.path.getsize(first) + os.path.getsize(second)
+        written = os.path.getsize(out_path)
+        if out == "-":
+            with open(out_path, "rb") as f:
+                shutil.copyfileobj(f, sys.stdout.buffer, 1024*1024)
+    except Exception as e:
+        sys.stderr.write("rbd merge-diff: %s\n" % e)
+        return 1
+    finally:
+        for path in tmp_files:
+            os.remove(path)
+    if os.environ.get(STATS_ENV):
+        with open(os.environ[STATS_ENV], "a") as f:
+            f.write("%s %s\n" % (read, written))
+    return 0
+
+
+# rotates a copy of the chain in source with engine; returns a dict of what it cost
+def run_engine(engine, source, tmp_dir, spec, mode, cold):
+    image_path = os.path.join(tmp_dir, engine, "pool", os.path.basename(source))
+    shutil.copytree(source, image_path)
+    if cold:
+        drop_cache(image_path)
+    stats_path = os.path.join(tmp_dir, engine + ".stats")
+    open(stats_path, "w").close()
+
+    old_path = os.environ["PATH"]
+    ceph_snaprotator.use_rbd_merge_diff = engine == "rbd"
+    if engine == "rbd":
+        os.environ["PATH"] = make_stub_bin(os.path.join(tmp_dir, engine)) + os.pathsep + old_path
+        os.environ[STATS_ENV] = stats_path
+    CountingPopen.count = 0
+    old_popen = subprocess.Popen
+    subprocess.Popen = CountingPopen
+    out = io.StringIO()
+    before = read_proc_io()
+    start = time.monotonic()
+    try:
+        with contextlib.redirect_stdout(out):
+            if mode == "rotate":
+                ceph_snaprotator.rotate(image_path, spec)
+            else:
+                snaps = ceph_snaprotator.SnapCatalog(image_path).names()
+                ceph_snaprotator.merge_snaps(image_path, snaps)
+    finally:
+        wall = time.monotonic() - start
+        after = read_proc_io()
+        subprocess.Popen = old_popen
+        os.environ["PATH"] = old_path
+        os.environ.pop(STATS_ENV, None)
+    if args.verbose:
+        sys.stdout.write(out.getvalue())
+
+    ret = {"wall": wall, "processes": CountingPopen.count, "read": None, "written": None}
+    if before and after:
+        ret["read"] = after[0] - before[0]
+        ret["written"] = after[1] - before[1]
+        with open(stats_path, "r") as f:
+            for line in f:
+                read, written = line.split()
+                ret["read"] += int(read)
+                ret["written"] += int(written)
+    if "ERROR" in out.getvalue():
+        ret["error"] = [line for line in out.getvalue().splitlines() if "ERROR" in line][0]
+    ret["snaps"] = len(ceph_snaprotator.SnapCatalog(image_path))
+    ret["size"] = sum([entry.stat().st_size for entry in os.scandir(image_path) if not entry.name.startswith(".")])
+    return ret
+
+
+def print_result(engine, result, snaps, size):
+    read = "-" if result["read"] is None else format_bytes(result["read"])
+    written = "-" if result["written"] is None else format_bytes(result["written"])
+    print("%-8s %8.2fs  read %10s  written %10s  %5s processes  %s -> %s snaps, %s -> %s%s" % (engine,
+        result["wall"], read, written, result["processes"], snaps, result["snaps"], format_bytes(size),
+        format_bytes(result["size"]), "  (%s)" % result["error"] if result.get("error") else ""))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--rbd-stub"]:
+        exit(rbd_stub(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description="Benchmark snapshot rotation on a synthetic diff chain.")
+    parser.add_argument('--snaps', dest='snaps', action='store',
+                    type=int, default=1000,
+                    help='number of snaps (diff files) to generate (default 1000)')
+    parser.add_argument('--months', dest='months', action='store',
+                    type=int, default=12,
+                    help='the snaps are spread over this many months (default 12)')
+    parser.add_argument('--image-size', dest='image_size', action='store',
+                    type=parse_size, default=parse_size("1G"),
+                    help='image size (default 1G)')
+    parser.add_argument('--base', dest='base', action='store',
+                    type=parse_size, default=parse_size("64M"),
+                    help='allocated part of the image, which the first diff has (default 64M)')
+    parser.add_argument('--change', dest='change', action='store',
+                    type=parse_size, default=parse_size("512k"),
+                    help='median amount written between snaps (default 512k)')
+    parser.add_argument('--seed', dest='seed', action='store',
+                    type=int, default=1,
+                    help='random seed, so runs can be compared (default 1)')
+    parser.add_argument('-s', '--spec', dest='spec', action='store',
+                    default="7,4,6",
+                    help='retention spec, as for ceph_snaprotator.py (default 7,4,6)')
+    parser.add_argument('--mode', dest='mode', choices=["rotate", "merge-all"], default="rotate",
+                    help='rotate the image, or merge the whole chain into its last diff (default rotate)')
+    parser.add_argument('--engine', dest='engines', action='append', choices=["native", "rbd"],
+                    help='merge engine to run; can be given more than once (default both)')
+    parser.add_argument('--cold', dest='cold', action='store_const',
+                    const=True, default=False,
+                    help='drop the copy of the chain from the page cache before each rotation')
+    parser.add_argument('--dir', dest='dir', action='store',
+                    default=None,
+                    help='directory for the temp files (default the system temp directory)')
+    parser.add_argument('--keep', dest='keep', action='store_const',
+                    const=True, default=False,
+                    help='keep the temp directory, to look at or rerun on')
+    parser.add_argument('--verbose', '-v', dest='verbose', action='store_const',
+                    const=True, default=False,
+                    help='show the rotator\'s output')
+    args = parser.parse_args()
+
+    # what the rotator's functions expect from its command line
+    ceph_snaprotator.args = argparse.Namespace(debug=False, verbose=args.verbose, dry_run=False, catalog="", spec=args.spec)
+    spec = ceph_snaprotator.Spec(args.spec)
+
+    tmp_dir = tempfile.mkdtemp(prefix="ceph_snaprotator_bench.", dir=args.dir)
+    try:
+        source = os.path.join(tmp_dir, "source", "vm-1-disk-0")
+        start = time.monotonic()
+        size = generate_chain(source, args.snaps, args.months, args.image_size, args.base, args.change, args.seed)
+        print("generated %s snaps, %s, in %.2fs in %s" % (args.snaps, format_bytes(size), time.monotonic() - start,
+            source))
+
+        for engine in args.engines or ["native", "rbd"]:
+            print_result(engine, run_engine(engine, source, tmp_dir, spec, args.mode, args.cold), args.snaps, size)
+    finally:
+        if args.keep:
+            print("kept %s" % tmp_dir)
+        else:
+            shutil.rmtree(tmp_dir)
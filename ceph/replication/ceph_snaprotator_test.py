@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# checks the retention spec of ceph_snaprotator.py (--spec) and which snaps rotate() keeps, on image
+# directories of empty files; nothing is merged or removed
+#
+#     python3 -m unittest ceph_snaprotator_test
+
+import argparse
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import ceph_snaprotator
+
+
+class SpecTest(unittest.TestCase):
+    def tiers(self, spec):
+        return [(tier.name, tier.unit, tier.n, tier.count) for tier in ceph_snaprotator.Spec(spec).tiers]
+
+    def test_old_form(self):
+        self.assertEqual(self.tiers("7,4,6"), [("d", "d", 1, 7), ("w", "w", 1, 4), ("m", "mo", 1, 6)])
+        # fewer counts leave out the longer tiers
+        self.assertEqual(self.tiers("7,4"), [("d", "d", 1, 7), ("w", "w", 1, 4)])
+
+    def test_tier_form(self):
+        self.assertEqual(self.tiers("20m:3,2h:24,d:7,w:4,m:6"),
+            [("20m", "min", 20, 3), ("2h", "h", 2, 24), ("d", "d", 1, 7), ("w", "w", 1, 4), ("m", "mo", 1, 6)])
+        self.assertEqual(self.tiers("30min:2, mo:12, 3mo:4"),
+            [("30min", "min", 30, 2), ("mo", "mo", 1, 12), ("3mo", "mo", 3, 4)])
+
+    def test_periods(self):
+        tiers = ceph_snaprotator.Spec("20m:1,2h:1,d:1,2w:1").tiers
+        self.assertEqual([(tier.rounding, tier.period) for tier in tiers], [(1, 20), (60, 2), (24*60, 1), (24*60, 14)])
+
+    def test_bad_tiers(self):
+        for spec in ["x:3", "0h:3", "h", "h:x"]:
+            with self.assertRaises(Exception, msg=spec):
+                ceph_snaprotator.Spec(spec)
+
+
+# an image directory of empty files, and rotate() without destroy_snaps()
+class ImageDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="ceph_snaprotator_test.")
+        self.image_path = os.path.join(self.dir, "vm-1")
+        os.makedirs(self.image_path)
+        # 4 days of snaps at 5, 25 and 45 minutes past every hour
+        start = datetime.datetime(2026, 3, 1)
+        self.times = [start + datetime.timedelta(hours=h, minutes=m) for h in range(4 * 24) for m in [5, 25, 45]]
+        for t in self.times:
+            open(os.path.join(self.image_path, self.name(t)), "w").close()
+
+        self.saved = (getattr(ceph_snaprotator, "args", None), ceph_snaprotator.destroy_snaps)
+        ceph_snaprotator.destroy_snaps = self.destroy_snaps
+        self.destroyed = None
+
+    def tearDown(self):
+        ceph_snaprotator.args, ceph_snaprotator.destroy_snaps = self.saved
+        shutil.rmtree(self.dir)
+
+    def name(self, t):
+        return "replication-%s" % t.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def destroy_snaps(self, image_path, snaps, catalog=None, dry_run=False):
+        self.destroyed = snaps
+
+    # returns the names of the snaps rotate() keeps with spec
+    def kept(self, spec):
+        ceph_snaprotator.args = argparse.Namespace(debug=False, verbose=False, dry_run=True, catalog="", spec=spec)
+        ceph_snaprotator.rotate(self.image_path, ceph_snaprotator.Spec(spec))
+        return sorted(set(self.name(t) for t in self.times) - set(self.destroyed))
+
+
+class RotateTest(ImageDirTestCase):
+    def test_hours_and_days(self):
+        last = self.times[-1]
+        expected = set()
+        # the first snap of each of the last 5 hours, and of each of the last 3 days
+        for h in range(5):
+            expected.add(self.name(last.replace(minute=5) - datetime.timedelta(hours=h)))
+        for d in range(3):
+            expected.add(self.name(last.replace(hour=0, minute=5) - datetime.timedelta(days=d)))
+        # and always the latest
+        expected.add(self.name(last))
+        self.assertEqual(self.kept("h:5,d:3"), sorted(expected))
+
+    def test_minutes(self):
+        # every snap is 20 minutes after the one before, so the last 4 are 40 minute candidates every other snap
+        names = [self.name(t) for t in self.times]
+        self.assertEqual(self.kept("40m:4"), sorted(names[-8::2] + names[-1:]))
+
+    def test_old_form_is_daily_and_weekly(self):
+        self.assertEqual(self.kept("2,1"), self.kept("d:2,w:1"))
+
+
+
+class PlanCacheTest(ImageDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.saved_cache = (ceph_snaprotator.plan_cache, ceph_snaprotator.PLAN_CACHE_MIN_AGE, ceph_snaprotator.rotate)
+        ceph_snaprotator.plan_cache = {}
+        # the directory was only just made
+        ceph_snaprotator.PLAN_CACHE_MIN_AGE = 0
+        self.spec = "20m:1000"
+        ceph_snaprotator.args = argparse.Namespace(debug=False, verbose=False, dry_run=True, catalog="",
+            spec=self.spec)
+        self.rotated = 0
+
+    def tearDown(self):
+        ceph_snaprotator.plan_cache, ceph_snaprotator.PLAN_CACHE_MIN_AGE, ceph_snaprotator.rotate = self.saved_cache
+        super().tearDown()
+
+    # rotates the image like run() does, counting the times it is really rotated
+    def rotate_cached(self):
+        ceph_snaprotator.update_plan_cache(self.image_path,
+            ceph_snaprotator.rotate_cached(self.image_path, ceph_snaprotator.Spec(ceph_snaprotator.args.spec)))
+
+    def count_rotations(self):
+        rotate = self.saved_cache[2]
+
+        def counting_rotate(image_path, spec):
+            self.rotated += 1
+            return rotate(image_path, spec)
+        ceph_snaprotator.rotate = counting_rotate
+
+    def test_hit(self):
+        self.count_rotations()
+        self.rotate_cached()
+        # the spec keeps every snap
+        self.assertEqual(self.destroyed, [])
+        self.assertIn(self.image_path, ceph_snaprotator.plan_cache)
+        self.rotate_cached()
+        self.rotate_cached()
+        self.assertEqual(self.rotated, 1)
+
+    def test_rewriting_a_file_keeps_the_entry(self):
+        self.count_rotations()
+        self.rotate_cached()
+        # the plan only depends on the names
+        with open(os.path.join(self.image_path, self.name(self.times[0])), "w") as f:
+            f.write("rewritten")
+        self.rotate_cached()
+        self.assertEqual(self.rotated, 1)
+
+    def test_new_snap(self):
+        self.count_rotations()
+        self.rotate_cached()
+        open(os.path.join(self.image_path, self.name(self.times[-1] + datetime.timedelta(minutes=20))), "w").close()
+        self.rotate_cached()
+        self.assertEqual(self.rotated, 2)
+
+    def test_mtime_set_back(self):
+        self.count_rotations()
+        self.rotate_cached()
+        st = os.stat(self.image_path)
+        os.remove(os.path.join(self.image_path, self.name(self.times[5])))
+        # like rsync -t or cp -p would
+        os.utime(self.image_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.rotate_cached()
+        self.assertEqual(self.rotated, 2)
+
+    def test_spec_changed(self):
+        self.count_rotations()
+        self.rotate_cached()
+        ceph_snaprotator.args.spec = "h:1000"
+        self.rotate_cached()
+        self.assertEqual(self.rotated, 2)
+
+    def test_not_cached_when_removing(self):
+        ceph_snaprotator.args.spec = "h:5"
+        self.rotate_cached()
+        self.assertTrue(self.destroyed)
+        self.assertNotIn(self.image_path, ceph_snaprotator.plan_cache)
+
+    def test_not_cached_when_just_changed(self):
+        ceph_snaprotator.PLAN_CACHE_MIN_AGE = 3600
+        self.rotate_cached()
+        self.assertNotIn(self.image_path, ceph_snaprotator.plan_cache)
+
+
+if __name__ == "__main__":
+    unittest.main()